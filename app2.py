@@ -1,6 +1,6 @@
 import os
 import json
-from typing import List, Dict, Any, Union, Optional
+from typing import List, Dict, Any, Union, Optional, Tuple, Iterable, Iterator
 import datetime
 import inspect
 import re
@@ -13,22 +13,28 @@ from chromadb.utils import embedding_functions
 import numpy as np
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+import httpx
 from urllib.parse import urlparse
-import markdownify  # pip install markdownify
-from xml.etree import ElementTree as ET
 import tiktoken  # Add tiktoken for token counting
 from werkzeug.utils import secure_filename
 import psutil
 import threading
-from collections import deque
+import asyncio
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import uuid
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import hashlib
 import secrets
+import sqlite3
+from file_extractor import can_extract, iter_text, text_format
+from html_extractor import extract_page
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from sse_stream import SSEStream, StreamMetrics
 
 # Configure logging
 logging.basicConfig(
@@ -48,10 +54,13 @@ CORS(app)
 MAX_CONTEXT_WINDOW = 163840  # Maximum context window size
 SAFETY_BUFFER = 0.15  # 15% safety buffer
 DEFAULT_MAX_TOKENS = 4096  # Default max tokens for generation
+CONTEXT_INPUT_BUDGET = 32768  # Default token budget for the messages sent upstream
+MIN_TRUNCATED_MESSAGE_TOKENS = 64  # Smallest slice of an older message worth keeping
+TRUNCATION_MARKER = "\n[...truncated]"
 
 # Add to existing imports and configurations
 UPLOAD_FOLDER = 'uploads'
-ALLOWED_EXTENSIONS = {'txt', 'pdf', 'doc', 'docx', 'md'}
+ALLOWED_EXTENSIONS = {'txt', 'pdf', 'docx', 'md'}
 
 # Create uploads directory if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -59,11 +68,101 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 # Add settings file path
 SETTINGS_FILE = 'settings.json'
 
+# Constants for conversation session management
+SESSION_MAX_COUNT = 1000  # Maximum number of sessions kept in memory
+SESSION_MAX_BYTES = 2 * 1024 * 1024  # Per-session history cap (2 MB)
+SESSION_STORE_MAX_BYTES = 256 * 1024 * 1024  # Total history cap across sessions (256 MB)
+SESSION_IDLE_TTL = 3600  # Drop sessions idle for more than 1 hour
+SESSION_LOCK_TIMEOUT = 30  # Seconds to wait for a busy session before giving up
+
+# Token count cache size (number of distinct texts)
+TOKEN_CACHE_SIZE = 10000
+
+# Shared HTTP connection pool settings
+HTTP_MAX_CONNECTIONS_PER_HOST = 20  # Pooled connections kept per upstream host
+HTTP_MAX_HOSTS = 32  # Number of per-host pools kept for crawling
+HTTP_KEEPALIVE_EXPIRY = 30.0  # Seconds an idle keep-alive connection is kept open
+
+# Web crawler settings
+CRAWL_MAX_CONCURRENCY = 8  # Pages fetched at once across all crawls
+CRAWL_PER_HOST_LIMIT = 2  # Concurrent requests to a single host
+CRAWL_PER_HOST_DELAY = 0.5  # Minimum seconds between requests to the same host
+CRAWL_TIMEOUT = 10  # Seconds before a page fetch times out
+CRAWL_CACHE_DB = 'crawl_cache.db'  # SQLite file with validators and content of crawled pages
+
+# Completion cache settings
+COMPLETION_CACHE_SIZE = 1000  # Completions kept in memory
+COMPLETION_CACHE_TTL = 3600  # Seconds a cached completion stays valid
+COMPLETION_CACHE_DB = os.environ.get("COMPLETION_CACHE_DB")  # SQLite file for the optional disk tier
+CACHED_STREAM_CHUNK_SIZE = 64  # Characters per chunk when replaying a cached completion
+
+# Semantic response cache settings
+SEMANTIC_CACHE_SIZE = 5000  # Answers kept in the semantic cache collection
+SEMANTIC_CACHE_THRESHOLD = 0.92  # Minimum cosine similarity to serve a cached answer
+SEMANTIC_CACHE_TOOLS = {"search_knowledge"}  # Tools whose answers are safe to reuse
+
+# Knowledge base chunking settings
+CHUNK_MAX_TOKENS = 400  # Maximum tokens per stored chunk
+CHUNK_OVERLAP_TOKENS = 50  # Tokens repeated from the end of the previous chunk
+CHUNK_STREAM_WINDOW = 64 * 1024  # Characters of a streamed document held before they are chunked
+KNOWLEDGE_BASE_DIR = os.environ.get("KNOWLEDGE_BASE_DIR", "knowledge_base")  # ChromaDB data directory; empty keeps it in memory
+
+# Embedding cache settings
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "embedding_cache")  # Directory of the memory-mapped vector file; empty keeps it in memory
+EMBEDDING_CACHE_MAX_ENTRIES = 1000000  # Vectors stored before the cache stops growing
+
+# Background ingestion settings
+INGEST_BATCH_CHARS = 512 * 1024  # Pending text that triggers a batch right away
+INGEST_BATCH_WINDOW = 0.25  # Seconds to wait for more documents before embedding a batch
+INGEST_FLUSH_TIMEOUT = 60  # Seconds a read waits for pending writes before querying anyway
+INGEST_STREAM_PENDING_BATCHES = 2  # Batches of a streamed document queued or embedding at once
+
+# Retrieval settings
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid")
+RETRIEVAL_MODE = "hybrid"  # Default: vector and BM25 results merged by reciprocal-rank fusion
+HYBRID_CANDIDATE_FACTOR = 4  # Candidates fetched from each retriever per requested result
+LEXICAL_INDEX_BUILD_BATCH = 1000  # Documents read per page when building the in-process indexes
+LEXICAL_INDEX_BUILD_RETRIES = 5  # Failed pages retried before the index build gives up
+LEXICAL_INDEX_BUILD_RETRY_DELAY = 2.0  # Seconds before the first retry; doubled on each further failure
+METADATA_INDEX_FIELDS = ("source", "url", "host", "title", "format", "parent_id")  # Metadata fields indexed for filters
+METADATA_SCAN_LIMIT = 2000  # Filtered sets up to this size are searched exactly in-process
+
+# Automatic retrieval (auto-RAG) settings
+AUTO_RAG_ENABLED = True  # Retrieve knowledge for every message without waiting for a tool call
+AUTO_RAG_RESULTS = 5  # Chunks retrieved per message
+AUTO_RAG_TOKEN_BUDGET = 1500  # Tokens of retrieved context injected into the prompt
+AUTO_RAG_MIN_SIMILARITY = 0.35  # Minimum cosine similarity for a chunk to be injected
+AUTO_RAG_MIN_LEXICAL_SCORE = 3.0  # Minimum BM25 score for chunks found only by the lexical index
+AUTO_RAG_TIMEOUT = 2.0  # Seconds to wait for retrieval before answering without it
+AUTO_RAG_WORKERS = 4  # Threads running retrieval alongside request preparation
+DOCUMENT_CONTEXT_RESULTS = 8  # Chunks retrieved when a message is about specific documents, e.g. an upload
+DOCUMENT_CONTEXT_TOKEN_BUDGET = 3000  # Tokens of those chunks injected into the prompt
+DOCUMENT_CONTEXT_TIMEOUT = 30.0  # Seconds to wait for them; the answer depends on them
+
+# Tool execution settings
+TOOL_MAX_WORKERS = 8  # Tool calls running at once across all agents
+TOOL_MAX_CALLS_PER_TURN = 8  # Tool calls accepted from a single model response
+MAX_TOOL_ITERATIONS = 3  # Rounds of tool calls per message before the model must answer
+TOOL_EVENT_RESULT_CHARS = 1000  # Characters of a tool result included in its tool_result event
+
+# Streaming output settings
+SSE_COALESCE_WINDOW = 0.02  # Seconds token text may be held to send it with the next tokens
+SSE_COALESCE_CHARS = 256  # Held token text that is sent right away
+TOOL_LIMIT_NOTICE = ("Tool call limit reached for this message. Answer with the information "
+                     "gathered so far and do not request more tools.")
+
+# Default rate limits, shared with the ASGI entry point
+DEFAULT_RATE_LIMITS = ["200 per day", "50 per hour"]
+KNOWLEDGE_SEARCH_RATE_LIMIT = "600 per minute"  # Direct retrieval is cheap, so it gets its own limit
+KNOWLEDGE_SEARCH_MAX_QUERIES = 64  # Queries accepted in one /knowledge/search request
+KNOWLEDGE_SEARCH_MAX_RESULTS = 50  # Largest n_results accepted by /knowledge/search
+WHERE_FIELD_OPERATORS = ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin")  # Operators accepted on metadata fields in where filters
+
 # Initialize rate limiter
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
-    default_limits=["200 per day", "50 per hour"]
+    default_limits=DEFAULT_RATE_LIMITS
 )
 
 # Add debug token management
@@ -282,7 +381,19 @@ def get_debug_metrics():
         if not token or not debug_token_manager.validate_token(token):
             return jsonify({'error': 'Invalid or expired debug token'}), 401
         
-        return jsonify(debug_log.get_metrics())
+        return jsonify({
+            **debug_log.get_metrics(),
+            'sessions': session_store.get_stats(),
+            'token_cache': token_counter.get_stats(),
+            'http_pool': http_pool.get_stats(),
+            'completion_cache': completion_cache.get_stats(),
+            'semantic_cache': semantic_cache.get_stats(),
+            'crawl_cache': crawl_cache.get_stats(),
+            'embedding_cache': embedding_cache.get_stats(),
+            'ingestion': ingestion_queue.get_stats(),
+            'knowledge_base': agent.rag.get_stats(),
+            'sse_streams': stream_metrics.get_stats()
+        })
     except Exception as e:
         logger.error(f"Error getting debug metrics: {e}")
         return jsonify({'error': str(e)}), 500
@@ -340,6 +451,274 @@ def save_settings(settings):
 # Initialize settings
 current_settings = load_settings()
 
+class TokenCounter:
+    def __init__(self, max_entries: int = TOKEN_CACHE_SIZE):
+        """Count tokens with one shared encoder and a cache keyed by content hash.
+        
+        Args:
+            max_entries: Maximum number of cached token counts
+        """
+        self.max_entries = max_entries
+        self.cache: "OrderedDict[bytes, int]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._encoder = None
+        self._encoder_loaded = False
+    
+    @property
+    def encoder(self):
+        """The tiktoken encoder, loaded on first use and shared by all callers."""
+        if not self._encoder_loaded:
+            with self.lock:
+                if not self._encoder_loaded:
+                    try:
+                        self._encoder = tiktoken.get_encoding("cl100k_base")  # Use cl100k_base for most models
+                    except Exception as e:
+                        logger.warning(f"Failed to initialize tokenizer: {e}. Using fallback token counting.")
+                        self._encoder = None
+                    self._encoder_loaded = True
+        return self._encoder
+    
+    def count(self, text: str) -> int:
+        """Count the tokens in a text, reusing the cached count for identical content."""
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        with self.lock:
+            tokens = self.cache.get(key)
+            if tokens is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return tokens
+            self.misses += 1
+        
+        encoder = self.encoder
+        if encoder:
+            tokens = len(encoder.encode(text))
+        else:
+            # Fallback: rough estimate (4 chars ≈ 1 token)
+            tokens = len(text) // 4
+        
+        with self.lock:
+            self.cache[key] = tokens
+            if len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return tokens
+    
+    def count_message(self, message: Dict[str, str]) -> int:
+        """Count tokens in a message object, including message structure overhead."""
+        return self.count(message["role"]) + self.count(message["content"]) + 4  # +4 for message structure
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get token cache statistics for debug metrics."""
+        with self.lock:
+            return {
+                'entries': len(self.cache),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+# Initialize the shared token counter
+token_counter = TokenCounter()
+
+class HTTPClientPool:
+    def __init__(self, max_connections_per_host: int = HTTP_MAX_CONNECTIONS_PER_HOST,
+                 max_hosts: int = HTTP_MAX_HOSTS, keepalive_expiry: float = HTTP_KEEPALIVE_EXPIRY):
+        """Process-wide pooled HTTP clients, reused across settings reloads.
+        
+        The LLM clients talk to a single host through httpx, so their connection
+        limit is the per-host limit. The crawler uses a requests session with one
+        connection pool per host.
+        
+        Args:
+            max_connections_per_host: Maximum pooled connections per host
+            max_hosts: Maximum number of per-host pools kept by the crawler session
+            keepalive_expiry: Seconds an idle keep-alive connection is kept open
+        """
+        self.lock = threading.Lock()
+        self.stats = {
+            'llm': {'requests': 0, 'new_connections': 0},
+            'crawler': {'requests': 0, 'new_connections': 0}
+        }
+        
+        limits = httpx.Limits(
+            max_connections=max_connections_per_host,
+            max_keepalive_connections=max_connections_per_host,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.llm_client = httpx.Client(limits=limits, event_hooks={'request': [self._trace_llm_request]})
+        self.async_llm_client = httpx.AsyncClient(limits=limits, event_hooks={'request': [self._atrace_llm_request]})
+        
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_hosts, pool_maxsize=max_connections_per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.hooks['response'].append(self._count_crawler_request)
+        self._adapter = adapter
+    
+    def _record(self, client: str, key: str):
+        """Increment a pool counter."""
+        with self.lock:
+            self.stats[client][key] += 1
+    
+    def _on_llm_trace(self, event_name: str, info: Dict[str, Any]):
+        """httpcore trace callback that counts newly opened connections."""
+        if event_name == "connection.connect_tcp.complete":
+            self._record('llm', 'new_connections')
+    
+    async def _aon_llm_trace(self, event_name: str, info: Dict[str, Any]):
+        """Async variant of _on_llm_trace for the async client."""
+        self._on_llm_trace(event_name, info)
+    
+    def _trace_llm_request(self, request: httpx.Request):
+        """Count an LLM request and watch it for new TCP connections."""
+        self._record('llm', 'requests')
+        request.extensions['trace'] = self._on_llm_trace
+    
+    async def _atrace_llm_request(self, request: httpx.Request):
+        """Async variant of _trace_llm_request for the async client."""
+        self._record('llm', 'requests')
+        request.extensions['trace'] = self._aon_llm_trace
+    
+    def _count_crawler_request(self, response, *args, **kwargs):
+        """requests response hook that counts crawler requests."""
+        self._record('crawler', 'requests')
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get pool hit/miss statistics for debug metrics.
+        
+        A hit is a request served over an already open connection, a miss is a
+        request that had to open a new one.
+        """
+        # urllib3 tracks connections opened by each per-host pool
+        crawler_connections = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                crawler_connections += pool.num_connections
+        
+        with self.lock:
+            self.stats['crawler']['new_connections'] = crawler_connections
+            stats = {}
+            for client, counts in self.stats.items():
+                stats[client] = {
+                    'requests': counts['requests'],
+                    'hits': max(counts['requests'] - counts['new_connections'], 0),
+                    'misses': counts['new_connections']
+                }
+            return stats
+
+# Initialize the shared HTTP connection pool
+http_pool = HTTPClientPool()
+
+class CompletionCache:
+    def __init__(self, max_entries: int = COMPLETION_CACHE_SIZE, ttl: int = COMPLETION_CACHE_TTL,
+                 db_path: Optional[str] = COMPLETION_CACHE_DB):
+        """Exact-match cache of LLM completions with an in-memory LRU and optional SQLite tier.
+        
+        Args:
+            max_entries: Maximum number of completions kept in memory
+            ttl: Seconds a cached completion stays valid
+            db_path: Path of the SQLite file for the disk tier, or None to keep it in memory only
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (response, expires_at)
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+        
+        self.db = None
+        if db_path:
+            try:
+                self.db = sqlite3.connect(db_path, check_same_thread=False)
+                self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS completions "
+                    "(key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                self.db.execute("CREATE INDEX IF NOT EXISTS completions_expiry ON completions (expires_at)")
+                self.db.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to open completion cache database {db_path}: {e}. Using memory only.")
+                self.db = None
+    
+    @staticmethod
+    def make_key(model: str, temperature: float, max_tokens: int, messages: List[Dict[str, str]]) -> str:
+        """Hash the parameters that determine a completion."""
+        payload = json.dumps({
+            'model': model,
+            'temperature': temperature,
+            'max_tokens': max_tokens,
+            'messages': [[message["role"], message["content"]] for message in messages]
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Look up a completion, checking memory first and then the disk tier."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[0]
+                del self.entries[key]
+            
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT response, expires_at FROM completions WHERE key = ? AND expires_at > ?",
+                    (key, now)
+                ).fetchone()
+                if row is not None:
+                    self._store_in_memory(key, row[0], row[1])
+                    self.stats['disk_hits'] += 1
+                    return row[0]
+            
+            self.stats['misses'] += 1
+            return None
+    
+    def set(self, key: str, response: str):
+        """Store a completion in memory and, if enabled, on disk."""
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            self._store_in_memory(key, response, expires_at)
+            if self.db is not None:
+                try:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO completions (key, response, expires_at) VALUES (?, ?, ?)",
+                        (key, response, expires_at)
+                    )
+                    self.db.execute("DELETE FROM completions WHERE expires_at <= ?", (time.time(),))
+                    self.db.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"Error writing completion cache: {e}")
+    
+    def _store_in_memory(self, key: str, response: str, expires_at: float):
+        """Insert into the memory tier, evicting the least recently used entry if full.
+
+        Must be called with self.lock held.
+        """
+        self.entries[key] = (response, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get completion cache statistics for debug metrics."""
+        with self.lock:
+            return {
+                **self.stats,
+                'entries': len(self.entries),
+                'disk_enabled': self.db is not None
+            }
+
+# Initialize the completion cache, shared by all LLM instances
+completion_cache = CompletionCache()
+
+def split_cached_response(response: str) -> List[str]:
+    """Split a cached answer into chunks for streaming it back."""
+    return [response[i:i + CACHED_STREAM_CHUNK_SIZE] for i in range(0, len(response), CACHED_STREAM_CHUNK_SIZE)]
+
 class OpenRouterLLM:
     def __init__(self, api_key: Optional[str] = None, 
                  model: str = "deepseek/deepseek-r1:free"):
@@ -354,9 +733,18 @@ class OpenRouterLLM:
             raise ValueError("OpenRouter API key not found. Set OPENROUTER_API_KEY environment variable or pass api_key.")
         
         self.model = model
+        # Both clients share the process-wide connection pool, so recreating the
+        # LLM on a settings change keeps the open upstream connections
         self.client = OpenAI(
             base_url="https://openrouter.ai/api/v1",
-            api_key=self.api_key
+            api_key=self.api_key,
+            http_client=http_pool.llm_client
+        )
+        # Async client for the asyncio serving path (see asgi.py)
+        self.async_client = AsyncOpenAI(
+            base_url="https://openrouter.ai/api/v1",
+            api_key=self.api_key,
+            http_client=http_pool.async_llm_client
         )
         
         # Headers for OpenRouter
@@ -365,12 +753,8 @@ class OpenRouterLLM:
             "X-Title": "AI Agent Example"
         }
         
-        # Initialize tokenizer
-        try:
-            self.tokenizer = tiktoken.get_encoding("cl100k_base")  # Use cl100k_base for most models
-        except Exception as e:
-            logger.warning(f"Failed to initialize tokenizer: {e}. Using fallback token counting.")
-            self.tokenizer = None
+        # Share the process-wide tokenizer
+        self.tokenizer = token_counter.encoder
     
     def _count_tokens(self, text: str) -> int:
         """Count the number of tokens in a text string.
@@ -381,11 +765,7 @@ class OpenRouterLLM:
         Returns:
             Number of tokens
         """
-        if self.tokenizer:
-            return len(self.tokenizer.encode(text))
-        else:
-            # Fallback: rough estimate (4 chars ≈ 1 token)
-            return len(text) // 4
+        return token_counter.count(text)
     
     def _count_message_tokens(self, message: Dict[str, str]) -> int:
         """Count tokens in a message object.
@@ -396,12 +776,28 @@ class OpenRouterLLM:
         Returns:
             Number of tokens
         """
-        # Count role and content
-        role_tokens = self._count_tokens(message["role"])
-        content_tokens = self._count_tokens(message["content"])
+        return token_counter.count_message(message)
+    
+    def _truncate_to_tokens(self, text: str, max_tokens: int) -> str:
+        """Truncate text to at most max_tokens tokens, marking the cut.
+        
+        Args:
+            text: The text to truncate
+            max_tokens: Maximum number of tokens to keep, including the marker
+            
+        Returns:
+            The original text if it fits, otherwise its leading tokens plus TRUNCATION_MARKER
+        """
+        if self._count_tokens(text) <= max_tokens:
+            return text
         
-        # Add tokens for message structure (approximate)
-        return role_tokens + content_tokens + 4  # +4 for message structure
+        keep_tokens = max(max_tokens - self._count_tokens(TRUNCATION_MARKER), 0)
+        if self.tokenizer:
+            tokens = self.tokenizer.encode(text)
+            return self.tokenizer.decode(tokens[:keep_tokens]) + TRUNCATION_MARKER
+        else:
+            # Fallback: rough estimate (4 chars ≈ 1 token)
+            return text[:keep_tokens * 4] + TRUNCATION_MARKER
     
     def _calculate_max_tokens(self, messages: List[Dict[str, str]], requested_max: Optional[int] = None) -> int:
         """Calculate the maximum number of tokens that can be generated.
@@ -425,9 +821,11 @@ class OpenRouterLLM:
             return min(requested_max, available_tokens)
         return min(DEFAULT_MAX_TOKENS, available_tokens)
     
-    def _handle_streaming_response(self, messages: List[Dict[str, str]], temperature: float, max_tokens: int):
+    def _handle_streaming_response(self, messages: List[Dict[str, str]], temperature: float, max_tokens: int,
+                                   cache_key: Optional[str] = None):
         """Handle streaming response from OpenRouter API using OpenAI client."""
         def generate_chunks():
+            stream = None
             try:
                 stream = self.client.chat.completions.create(
                     extra_headers=self.extra_headers,
@@ -438,9 +836,15 @@ class OpenRouterLLM:
                     stream=True
                 )
                 
+                parts = []
                 for chunk in stream:
                     if chunk.choices[0].delta.content is not None:
+                        parts.append(chunk.choices[0].delta.content)
                         yield chunk.choices[0].delta.content
+                
+                # Only complete streams are cached
+                if cache_key:
+                    completion_cache.set(cache_key, "".join(parts))
                         
             except Exception as e:
                 error_msg = str(e)
@@ -454,10 +858,16 @@ class OpenRouterLLM:
                         'timestamp': datetime.datetime.now().isoformat()
                     })
                 yield f" [Error: {error_msg}]"
+            finally:
+                # Dropping the connection stops generation upstream when the consumer
+                # closes the stream early (e.g. once a tool call has been read)
+                if stream is not None:
+                    stream.response.close()
         
         return generate_chunks()
     
-    def generate(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 100000, stream: bool = False):
+    def generate(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 100000, stream: bool = False,
+                 use_cache: bool = True):
         """Generate a response using the LLM.
         
         Args:
@@ -465,23 +875,29 @@ class OpenRouterLLM:
             temperature: Controls randomness (0 to 1)
             max_tokens: Maximum number of tokens to generate
             stream: Whether to stream the response
+            use_cache: Whether to answer from the completion cache; when False the
+                request goes upstream and its answer replaces any cached one
             
         Returns:
             The LLM response text (string) or generator (if streaming)
         """
         try:
             # Calculate safe max_tokens based on context window
-            input_tokens = sum(len(msg["content"].split()) for msg in messages)  # Rough estimate
-            available_tokens = MAX_CONTEXT_WINDOW - input_tokens
-            safe_max_tokens = min(max_tokens, int(available_tokens * 0.85))  # 15% safety buffer
+            safe_max_tokens = self._calculate_max_tokens(messages, max_tokens)
             
             if safe_max_tokens <= 0:
                 raise ValueError("Input messages exceed maximum context window size")
             
             logger.debug(f"Using max_tokens: {safe_max_tokens} (requested: {max_tokens})")
             
+            cache_key = completion_cache.make_key(self.model, temperature, safe_max_tokens, messages)
+            cached = completion_cache.get(cache_key) if use_cache else None
+            if cached is not None:
+                logger.debug("Serving completion from cache")
+                return iter(split_cached_response(cached)) if stream else cached
+            
             if stream:
-                return self._handle_streaming_response(messages, temperature, safe_max_tokens)
+                return self._handle_streaming_response(messages, temperature, safe_max_tokens, cache_key)
             else:
                 completion = self.client.chat.completions.create(
                     extra_headers=self.extra_headers,
@@ -491,7 +907,10 @@ class OpenRouterLLM:
                     max_tokens=safe_max_tokens,
                     stream=False
                 )
-                return completion.choices[0].message.content
+                response = completion.choices[0].message.content
+                if response is not None:
+                    completion_cache.set(cache_key, response)
+                return response
                 
         except Exception as e:
             error_msg = str(e)
@@ -510,6 +929,116 @@ class OpenRouterLLM:
                 return error_generator()
             else:
                 return f"Error generating response: {error_msg}"
+    
+    def _handle_async_streaming_response(self, messages: List[Dict[str, str]], temperature: float, max_tokens: int,
+                                         cache_key: Optional[str] = None):
+        """Handle streaming response from OpenRouter API using the async OpenAI client."""
+        async def generate_chunks():
+            stream = None
+            try:
+                stream = await self.async_client.chat.completions.create(
+                    extra_headers=self.extra_headers,
+                    model=self.model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=True
+                )
+                
+                parts = []
+                async for chunk in stream:
+                    if chunk.choices[0].delta.content is not None:
+                        parts.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+                
+                if cache_key:
+                    completion_cache.set(cache_key, "".join(parts))
+                        
+            except Exception as e:
+                error_msg = str(e)
+                logger.error(f"Error in async streaming response: {error_msg}")
+                if current_settings.get('debugMode', False):
+                    debug_log.metrics['total_errors'] += 1
+                    debug_log.add_log('error', {
+                        'error': error_msg,
+                        'type': 'llm_streaming_error',
+                        'model': self.model,
+                        'timestamp': datetime.datetime.now().isoformat()
+                    })
+                yield f" [Error: {error_msg}]"
+            finally:
+                if stream is not None:
+                    await stream.response.aclose()
+        
+        return generate_chunks()
+    
+    async def agenerate(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 100000, stream: bool = False,
+                        use_cache: bool = True):
+        """Generate a response using the LLM without blocking the event loop.
+        
+        Args:
+            messages: List of message objects with role and content
+            temperature: Controls randomness (0 to 1)
+            max_tokens: Maximum number of tokens to generate
+            stream: Whether to stream the response
+            use_cache: Whether to answer from the completion cache
+            
+        Returns:
+            The LLM response text (string) or async generator (if streaming)
+        """
+        try:
+            # Calculate safe max_tokens based on context window
+            safe_max_tokens = self._calculate_max_tokens(messages, max_tokens)
+            
+            if safe_max_tokens <= 0:
+                raise ValueError("Input messages exceed maximum context window size")
+            
+            logger.debug(f"Using max_tokens: {safe_max_tokens} (requested: {max_tokens})")
+            
+            cache_key = completion_cache.make_key(self.model, temperature, safe_max_tokens, messages)
+            cached = completion_cache.get(cache_key) if use_cache else None
+            if cached is not None:
+                logger.debug("Serving completion from cache")
+                if stream:
+                    async def cached_generator():
+                        for chunk in split_cached_response(cached):
+                            yield chunk
+                    return cached_generator()
+                return cached
+            
+            if stream:
+                return self._handle_async_streaming_response(messages, temperature, safe_max_tokens, cache_key)
+            else:
+                completion = await self.async_client.chat.completions.create(
+                    extra_headers=self.extra_headers,
+                    model=self.model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=safe_max_tokens,
+                    stream=False
+                )
+                response = completion.choices[0].message.content
+                if response is not None:
+                    completion_cache.set(cache_key, response)
+                return response
+                
+        except Exception as e:
+            error_msg = str(e)
+            logger.error(f"Error calling OpenRouter API: {error_msg}")
+            if current_settings.get('debugMode', False):
+                debug_log.metrics['total_errors'] += 1
+                debug_log.add_log('error', {
+                    'error': error_msg,
+                    'type': 'llm_api_error',
+                    'model': self.model,
+                    'timestamp': datetime.datetime.now().isoformat()
+                })
+            if stream:
+                async def error_generator():
+                    yield f"Error generating response: {error_msg}"
+                return error_generator()
+            else:
+                return f"Error generating response: {error_msg}"
 
 
 class Tool:
@@ -543,151 +1072,1788 @@ class Tool:
         """Execute the tool function with the provided arguments."""
         return self.function(*args, **kwargs)
 
-class WebCrawler:
-    def __init__(self, user_agent: str = "AI Agent Web Crawler/1.0"):
-        self.user_agent = user_agent
-        self.headers = {"User-Agent": user_agent}
+class CrawlCache:
+    def __init__(self, db_path: str = CRAWL_CACHE_DB):
+        """Persistent cache of crawled pages for conditional re-crawls.
         
-    def crawl(self, urls: List[str], output_format: str = "markdown") -> List[dict]:
-        """Crawl URLs and convert content to specified format.
+        Stores the ETag/Last-Modified validators, a hash of the raw body and the
+        converted content of each (url, format) pair.
         
         Args:
-            urls: List of URLs to crawl
-            output_format: Output format (markdown or xml)
-            
-        Returns:
-            List of dictionaries with content and metadata
+            db_path: Path of the SQLite file
         """
-        results = []
-        
-        for url in urls:
-            try:
-                # Basic URL validation
-                parsed = urlparse(url)
-                if not parsed.scheme or not parsed.netloc:
-                    raise ValueError(f"Invalid URL: {url}")
-                
-                # Fetch page content
-                response = requests.get(url, headers=self.headers, timeout=10)
-                response.raise_for_status()
-                
-                # Parse HTML
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                # Remove unwanted elements
-                for element in soup(['script', 'style', 'nav', 'footer']):
-                    element.decompose()
-                
-                # Convert to target format
-                if output_format.lower() == "markdown":
-                    content = markdownify.markdownify(str(soup.body), heading_style="ATX")
-                elif output_format.lower() == "xml":
-                    root = ET.Element("page")
-                    ET.SubElement(root, "url").text = url
-                    ET.SubElement(root, "title").text = soup.title.string if soup.title else ""
-                    ET.SubElement(root, "content").text = soup.get_text()
-                    content = ET.tostring(root, encoding='unicode')
-                else:
-                    raise ValueError(f"Unsupported format: {output_format}")
-                
-                results.append({
-                    "url": url,
-                    "content": content, 
-                    "title": soup.title.string if soup.title else ""
-                })
-                
-            except Exception as e:
-                logger.error(f"Error crawling {url}: {e}")
-                results.append({
-                    "url": url,
-                    "content": f"Error crawling {url}: {str(e)}",
-                    "title": ""
-                })
-                
-        return results
+        self.lock = threading.Lock()
+        self.stats = {'not_modified': 0, 'unchanged': 0, 'changed': 0}
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS crawl_cache ("
+            "url TEXT NOT NULL, format TEXT NOT NULL, etag TEXT, last_modified TEXT, "
+            "content_hash TEXT NOT NULL, title TEXT, content TEXT NOT NULL, fetched_at REAL NOT NULL, "
+            "PRIMARY KEY (url, format))"
+        )
+        self.db.commit()
+    
+    def get(self, url: str, output_format: str) -> Optional[Dict[str, Any]]:
+        """Get the cached entry for a URL and format, if any."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT etag, last_modified, content_hash, title, content FROM crawl_cache WHERE url = ? AND format = ?",
+                (url, output_format)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "etag": row[0],
+            "last_modified": row[1],
+            "content_hash": row[2],
+            "title": row[3],
+            "content": row[4]
+        }
+    
+    def set(self, url: str, output_format: str, etag: Optional[str], last_modified: Optional[str],
+            content_hash: str, title: str, content: str):
+        """Store or replace the entry for a URL and format."""
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO crawl_cache "
+                "(url, format, etag, last_modified, content_hash, title, content, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, output_format, etag, last_modified, content_hash, title, content, time.time())
+            )
+            self.db.commit()
+    
+    def record(self, outcome: str):
+        """Count a re-crawl outcome: not_modified, unchanged or changed."""
+        with self.lock:
+            self.stats[outcome] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get crawl cache statistics for debug metrics."""
+        with self.lock:
+            return dict(self.stats)
 
+# Initialize the crawl cache
+crawl_cache = CrawlCache()
 
-class RAGSystem:
-    def __init__(self, collection_name: str = "agent_knowledge"):
-        """Initialize the RAG system with ChromaDB for vector storage.
+
+class WebCrawler:
+    def __init__(self, user_agent: str = "AI Agent Web Crawler/1.0", max_concurrency: int = CRAWL_MAX_CONCURRENCY,
+                 per_host_limit: int = CRAWL_PER_HOST_LIMIT, per_host_delay: float = CRAWL_PER_HOST_DELAY):
+        """Initialize the web crawler.
         
         Args:
-            collection_name: Name for the ChromaDB collection
+            user_agent: User-Agent header sent with every request
+            max_concurrency: Maximum number of pages fetched at once across all crawls
+            per_host_limit: Maximum number of concurrent requests to a single host
+            per_host_delay: Minimum seconds between the starts of requests to the same host
         """
-        # Initialize ChromaDB client
-        self.client = chromadb.Client()
-        
-        # Use Sentence Transformers for embeddings
-        self.embedding_function = embedding_functions.DefaultEmbeddingFunction()
-        
-        # Create or get collection
-        self.collection = self.client.get_or_create_collection(
-            name=collection_name,
-            embedding_function=self.embedding_function
-        )
+        self.user_agent = user_agent
+        self.headers = {"User-Agent": user_agent}
+        self.per_host_limit = per_host_limit
+        self.per_host_delay = per_host_delay
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="crawler")
+        self._hosts_lock = threading.Lock()
+        self._host_slots: Dict[str, threading.Semaphore] = {}
+        self._host_next_request: Dict[str, float] = {}
     
-    def add_documents(self, documents: List[str], metadatas: Optional[List[Dict[str, Any]]] = None, ids: Optional[List[str]] = None):
-        """Add documents to the vector store.
+    def _wait_for_host(self, host: str) -> threading.Semaphore:
+        """Block until a request to host is allowed by the per-host limit and delay.
         
-        Args:
-            documents: List of text documents to add
-            metadatas: Optional metadata for each document
-            ids: Optional IDs for each document (will be auto-generated if not provided)
+        Returns:
+            The host's semaphore, which the caller must release after the request
         """
-        if ids is None:
-            # Generate IDs based on timestamp and document hash
-            ids = [f"doc_{i}_{int(time.time())}" for i in range(len(documents))]
+        with self._hosts_lock:
+            slots = self._host_slots.setdefault(host, threading.Semaphore(self.per_host_limit))
+        slots.acquire()
         
-        if metadatas is None:
-            metadatas = [{"source": "user_input"} for _ in documents]
-        
-        self.collection.add(
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids
-        )
-        logger.info(f"Added {len(documents)} documents to RAG system")
+        # Reserve the next start time for this host
+        with self._hosts_lock:
+            now = time.monotonic()
+            start_at = max(self._host_next_request.get(host, now), now)
+            self._host_next_request[host] = start_at + self.per_host_delay
+        if start_at > now:
+            time.sleep(start_at - now)
+        return slots
     
-    def query(self, query_text: str, n_results: int = 3) -> List[Dict[str, Any]]:
-        """Retrieve relevant documents based on a query.
+    def _crawl_one(self, url: str, output_format: str) -> dict:
+        """Fetch a single URL and convert its content to the specified format."""
+        try:
+            # Basic URL validation
+            parsed = urlparse(url)
+            if not parsed.scheme or not parsed.netloc:
+                raise ValueError(f"Invalid URL: {url}")
+            
+            output_format = output_format.lower()
+            
+            # Revalidate previously crawled pages with a conditional request
+            cached = crawl_cache.get(url, output_format)
+            headers = dict(self.headers)
+            if cached:
+                if cached["etag"]:
+                    headers["If-None-Match"] = cached["etag"]
+                if cached["last_modified"]:
+                    headers["If-Modified-Since"] = cached["last_modified"]
+            
+            # Fetch page content, politely
+            slots = self._wait_for_host(parsed.netloc.lower())
+            try:
+                response = http_pool.session.get(url, headers=headers, timeout=CRAWL_TIMEOUT)
+            finally:
+                slots.release()
+            response.raise_for_status()
+            
+            # Skip parsing and conversion when the page has not changed
+            if cached and response.status_code == 304:
+                crawl_cache.record('not_modified')
+                return {"url": url, "content": cached["content"], "title": cached["title"], "unchanged": True}
+            
+            content_hash = hashlib.sha256(response.content).hexdigest()
+            if cached and cached["content_hash"] == content_hash:
+                crawl_cache.record('unchanged')
+                crawl_cache.set(url, output_format, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                                content_hash, cached["title"], cached["content"])
+                return {"url": url, "content": cached["content"], "title": cached["title"], "unchanged": True}
+            
+            # Parse once, strip boilerplate and convert to the target format
+            title, content = extract_page(response.text, url, output_format)
+            
+            if cached:
+                crawl_cache.record('changed')
+            crawl_cache.set(url, output_format, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                            content_hash, title, content)
+            
+            return {
+                "url": url,
+                "content": content, 
+                "title": title,
+                "unchanged": False
+            }
+            
+        except Exception as e:
+            logger.error(f"Error crawling {url}: {e}")
+            return {
+                "url": url,
+                "content": f"Error crawling {url}: {str(e)}",
+                "title": ""
+            }
+        
+    def crawl(self, urls: List[str], output_format: str = "markdown") -> List[dict]:
+        """Crawl URLs concurrently and convert content to specified format.
         
         Args:
-            query_text: The text to search for similar documents
-            n_results: Number of results to return
+            urls: List of URLs to crawl
+            output_format: Output format (markdown, xml or text)
             
         Returns:
-            List of results including document text and metadata
+            List of dictionaries with content and metadata, in the same order as urls
         """
-        results = self.collection.query(
-            query_texts=[query_text],
-            n_results=n_results
-        )
-        
-        # Format results for easier consumption
-        formatted_results = []
-        if results["documents"]:
-            for i, doc in enumerate(results["documents"][0]):  # First query's results
-                formatted_results.append({
-                    "document": doc,
-                    "metadata": results["metadatas"][0][i] if results["metadatas"] else {},
-                    "id": results["ids"][0][i],
-                    "distance": results["distances"][0][i] if "distances" in results else None
-                })
-        
-        return formatted_results
+        # Every fetch, even a single one, goes through the shared pool so
+        # max_concurrency holds across requests; map() keeps input order
+        return list(self.executor.map(lambda url: self._crawl_one(url, output_format), urls))
 
+# Shared crawler so the concurrency and per-host limits apply across all agents
+web_crawler = WebCrawler()
+
+
+class EmbeddingCache:
+    KEY_SIZE = 16  # Bytes of the blake2b content hash
+    RECORD_SIZE = KEY_SIZE + 4  # Content hash + little-endian uint32 row number
+    MIN_CAPACITY = 1024  # Rows the vector file is first sized for
+
+    def __init__(self, embedding_function=None, directory: Optional[str] = EMBEDDING_CACHE_DIR,
+                 max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        """Embedding function wrapper that only embeds texts it has not seen before.
+
+        Vectors are stored as float32 rows of a memory-mapped file
+        (vectors.f32). index.bin is an append-only log of (content hash, row)
+        records, loaded into a dict on startup. The directory must not be
+        shared by several processes.
 
-class Agent:
-    def __init__(self, llm: OpenRouterLLM, system_prompt: Optional[str] = None):
-        """Initialize an agent with an LLM, tools, and RAG system.
-        
         Args:
-            llm: The language model to use for reasoning
-            system_prompt: Optional system prompt to define agent behavior
+            embedding_function: Embedding function to wrap (defaults to ChromaDB's DefaultEmbeddingFunction)
+            directory: Directory for the vector and index files; in-memory only if empty
+            max_entries: Maximum number of cached vectors
         """
-        self.llm = llm
+        self.embedding_function = embedding_function or embedding_functions.DefaultEmbeddingFunction()
+        self.namespace = type(self.embedding_function).__name__.encode('utf-8')
+        self.directory = directory
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.index: Dict[bytes, int] = {}
+        self.vectors = None
+        self.capacity = 0
+        self.dim = None
+        self.index_file = None
+        self.hits = 0
+        self.misses = 0
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.vectors_path = os.path.join(directory, "vectors.f32")
+            self.index_path = os.path.join(directory, "index.bin")
+            self.meta_path = os.path.join(directory, "meta.json")
+            self._load()
+
+    def _load(self):
+        """Reopen the vector file and rebuild the index from the record log."""
+        try:
+            with open(self.meta_path, 'r') as f:
+                self.dim = json.load(f)["dim"]
+            with open(self.index_path, 'rb') as f:
+                raw = f.read()
+        except (OSError, ValueError, KeyError):
+            self.dim = None
+            return
+
+        capacity = os.path.getsize(self.vectors_path) // (self.dim * 4) if os.path.exists(self.vectors_path) else 0
+        # Records are only appended after their vector is flushed; ignore any torn tail
+        for start in range(0, len(raw) - len(raw) % self.RECORD_SIZE, self.RECORD_SIZE):
+            row = int.from_bytes(raw[start + self.KEY_SIZE:start + self.RECORD_SIZE], 'little')
+            if row < capacity:
+                self.index[raw[start:start + self.KEY_SIZE]] = row
+        if capacity:
+            self.capacity = capacity
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        logger.info(f"Loaded {len(self.index)} cached embeddings from {self.directory}")
+
+    def _reset(self, dim: int):
+        """Start an empty cache for vectors of the given dimension."""
+        self.index = {}
+        self.vectors = None
+        self.capacity = 0
+        self.dim = dim
+        if self.directory:
+            if self.index_file:
+                self.index_file.close()
+                self.index_file = None
+            for path in (self.vectors_path, self.index_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            with open(self.meta_path, 'w') as f:
+                json.dump({"dim": dim}, f)
+
+    def _ensure_capacity(self, rows: int):
+        """Grow the vector storage to hold at least the given number of rows."""
+        if rows <= self.capacity:
+            return
+        capacity = max(rows, self.capacity * 2, self.MIN_CAPACITY)
+        if not self.directory:
+            vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+            if self.vectors is not None:
+                vectors[:self.capacity] = self.vectors
+            self.vectors = vectors
+        else:
+            if self.vectors is not None:
+                self.vectors.flush()
+                self.vectors = None
+            with open(self.vectors_path, 'ab') as f:
+                f.truncate(capacity * self.dim * 4)
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        self.capacity = capacity
+
+    def _store(self, keys: List[bytes], embeddings: np.ndarray):
+        """Append new vectors and their index records."""
+        if self.dim != embeddings.shape[1]:
+            if self.dim is not None:
+                logger.warning(f"Embedding dimension changed from {self.dim} to {embeddings.shape[1]}, clearing embedding cache")
+            self._reset(embeddings.shape[1])
+
+        new_rows = []
+        for key, vector in zip(keys, embeddings):
+            if key in self.index or len(self.index) >= self.max_entries:
+                continue
+            row = len(self.index)
+            self._ensure_capacity(row + 1)
+            self.vectors[row] = vector
+            self.index[key] = row
+            new_rows.append((key, row))
+        if not new_rows or not self.directory:
+            return
+
+        self.vectors.flush()
+        if self.index_file is None:
+            self.index_file = open(self.index_path, 'ab')
+        self.index_file.write(b"".join(key + row.to_bytes(4, 'little') for key, row in new_rows))
+        self.index_file.flush()
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.blake2b(self.namespace + b"\0" + text.encode('utf-8'), digest_size=self.KEY_SIZE).digest()
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        """Embed texts, computing only the ones missing from the cache."""
+        keys = [self._key(text) for text in input]
+        results: List[Optional[List[float]]] = [None] * len(input)
+        missing: Dict[bytes, List[int]] = {}
+        with self.lock:
+            for i, key in enumerate(keys):
+                row = self.index.get(key)
+                if row is not None:
+                    results[i] = self.vectors[row].tolist()
+                    self.hits += 1
+                else:
+                    missing.setdefault(key, []).append(i)
+                    self.misses += 1
+
+        if missing:
+            missing_keys = list(missing)
+            # Embed each distinct missing text once, outside the lock
+            embeddings = np.asarray(
+                self.embedding_function([input[missing[key][0]] for key in missing_keys]),
+                dtype=np.float32
+            )
+            for key, vector in zip(missing_keys, embeddings):
+                for i in missing[key]:
+                    results[i] = vector.tolist()
+            with self.lock:
+                self._store(missing_keys, embeddings)
+        return results
+
+    def embed_query(self, input: List[str]) -> List[List[float]]:
+        return self(input)
+
+    def embed_documents(self, input: List[str]) -> List[List[float]]:
+        return self(input)
+
+    def __getattr__(self, name):
+        # Expose the wrapped function's name and config to ChromaDB
+        if name == "embedding_function":
+            raise AttributeError(name)
+        return getattr(self.embedding_function, name)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get embedding cache statistics for debug metrics."""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.index),
+                'max_entries': self.max_entries,
+                'dimension': self.dim,
+                'bytes': self.capacity * (self.dim or 0) * 4,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'persistent': bool(self.directory)
+            }
+
+
+# Initialize the embedding cache shared by every RAG system and the semantic cache
+embedding_cache = EmbeddingCache()
+
+
+class DocumentChunker:
+    HEADING_PATTERN = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$')
+    PARAGRAPH_BREAK = re.compile(r'\n[ \t]*\n')
+    WHITESPACE = re.compile(r'\s+')
+
+    def __init__(self, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
+        """Split documents into token-sized chunks before they are embedded.
+
+        Args:
+            max_tokens: Maximum tokens per chunk
+            overlap_tokens: Tokens carried over from the end of the previous chunk
+        """
+        if max_tokens <= 0 or not 0 <= overlap_tokens < max_tokens:
+            raise ValueError("Chunk overlap must be smaller than the chunk size")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+
+    def _count(self, text: str) -> int:
+        # Chunk pieces are not worth a slot in the shared token cache
+        encoder = token_counter.encoder
+        return len(encoder.encode(text)) if encoder else len(text) // 4
+
+    def _sections(self, text: str, markdown: bool, state: Optional[Dict[str, Any]] = None) -> List[tuple]:
+        """Split a document at markdown headings outside code fences.
+
+        Args:
+            text: The document text
+            markdown: Whether to split at headings at all
+            state: Enclosing headings and code fence state, carried from one
+                piece of a streamed document to the next and updated here
+
+        Returns:
+            List of (start offset, end offset, heading path) tuples
+        """
+        if not markdown:
+            return [(0, len(text), "")]
+
+        state = state if state is not None else {}
+        sections = []
+        headings: List[tuple] = state.get('headings', [])  # (level, title) of the enclosing headings
+        start = 0
+        path = " > ".join(title for _, title in headings)
+        offset = 0
+        in_fence = state.get('in_fence', False)
+        for line in text.splitlines(keepends=True):
+            stripped = line.strip()
+            if stripped.startswith("```") or stripped.startswith("~~~"):
+                in_fence = not in_fence
+            match = None if in_fence else self.HEADING_PATTERN.match(stripped)
+            if match:
+                if offset > start:
+                    sections.append((start, offset, path))
+                level = len(match.group(1))
+                headings = [h for h in headings if h[0] < level] + [(level, match.group(2))]
+                path = " > ".join(title for _, title in headings)
+                start = offset
+            offset += len(line)
+        if len(text) > start:
+            sections.append((start, len(text), path))
+        state['headings'] = headings
+        state['in_fence'] = in_fence
+        return sections
+
+    def _units(self, text: str, start: int, end: int) -> List[tuple]:
+        """Split a section into paragraphs, lines or windows that fit in one chunk.
+
+        Returns:
+            List of (start offset, end offset, tokens) tuples
+        """
+        units = []
+        pieces = []
+        position = start
+        for match in self.PARAGRAPH_BREAK.finditer(text, start, end):
+            pieces.append((position, match.start()))
+            position = match.end()
+        pieces.append((position, end))
+
+        for piece_start, piece_end in pieces:
+            if not text[piece_start:piece_end].strip():
+                continue
+            tokens = self._count(text[piece_start:piece_end])
+            if tokens <= self.max_tokens:
+                units.append((piece_start, piece_end, tokens))
+                continue
+            # Oversized paragraph: fall back to lines, then to fixed-size windows
+            line_start = piece_start
+            for line in text[piece_start:piece_end].splitlines(keepends=True):
+                line_end = line_start + len(line)
+                if line.strip():
+                    line_tokens = self._count(line)
+                    if line_tokens <= self.max_tokens:
+                        units.append((line_start, line_end, line_tokens))
+                    else:
+                        units.extend(self._windows(text, line_start, line_end, line_tokens))
+                line_start = line_end
+        return units
+
+    def _windows(self, text: str, start: int, end: int, tokens: int) -> List[tuple]:
+        """Cut a run of text without breaks into windows of at most max_tokens."""
+        windows = []
+        step = max(1, int((end - start) * self.max_tokens / tokens))
+        position = start
+        while position < end:
+            window_end = min(position + step, end)
+            window_tokens = self._count(text[position:window_end])
+            while window_tokens > self.max_tokens and window_end - position > 1:
+                window_end = position + max(1, int((window_end - position) * 0.9))
+                window_tokens = self._count(text[position:window_end])
+            windows.append((position, window_end, window_tokens))
+            position = window_end
+        return windows
+
+    def chunk(self, text: str, markdown: bool = True, state: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Split a document into overlapping chunks that never cross a heading.
+
+        Args:
+            text: The document text
+            markdown: Whether to split at markdown headings first
+            state: Heading state carried over from the previous piece of a
+                streamed document (see chunk_stream)
+
+        Returns:
+            List of chunks with their text, character offset in the document,
+            heading path and token count
+        """
+        chunks = []
+        for section_start, section_end, path in self._sections(text, markdown, state):
+            units = self._units(text, section_start, section_end)
+            current: List[tuple] = []
+            current_tokens = 0
+            for unit in units:
+                # +1 approximates the separator between units
+                if current and current_tokens + unit[2] + 1 > self.max_tokens:
+                    chunks.append(self._make_chunk(text, current, path))
+                    # Carry trailing units over as overlap, never the whole chunk
+                    overlap: List[tuple] = []
+                    overlap_tokens = 0
+                    budget = min(self.overlap_tokens, self.max_tokens - unit[2] - 1)
+                    for previous in reversed(current[1:]):
+                        if overlap_tokens + previous[2] + 1 > budget:
+                            break
+                        overlap.insert(0, previous)
+                        overlap_tokens += previous[2] + 1
+                    # Fill the rest of the budget with the last words of the unit before them
+                    tail = self._tail(text, current[len(current) - len(overlap) - 1], budget - overlap_tokens - 1)
+                    if tail:
+                        overlap.insert(0, tail)
+                        overlap_tokens += tail[2] + 1
+                    current = overlap
+                    current_tokens = overlap_tokens
+                current.append(unit)
+                current_tokens += unit[2] + 1
+            if current:
+                chunks.append(self._make_chunk(text, current, path))
+        return chunks
+
+    def _tail(self, text: str, unit: tuple, tokens: int) -> Optional[tuple]:
+        """The last whole words of a unit that fit in tokens, as a unit; None if none fit."""
+        start, end, unit_tokens = unit
+        if tokens <= 0 or unit_tokens <= 0:
+            return None
+        # Start from a proportional estimate and move forward to a word boundary until it fits
+        position = max(start, end - int((end - start) * tokens / unit_tokens))
+        while position < end:
+            boundary = self.WHITESPACE.search(text, position, end)
+            if boundary is None:
+                return None
+            position = boundary.end()
+            if position >= end:
+                return None
+            tail_tokens = self._count(text[position:end])
+            if tail_tokens <= tokens:
+                return (position, end, tail_tokens)
+            position += max(1, (end - position) // 10)
+        return None
+
+    def _stream_cut(self, text: str, markdown: bool) -> int:
+        """Where to cut a window of a streamed document.
+
+        After the last paragraph break (or line break), but before any
+        headings that end the window, so a heading stays with its content.
+        0 if the window is nothing but headings.
+        """
+        cut = text.rfind("\n\n") + 2
+        if cut < 2:
+            cut = text.rfind("\n") + 1 or len(text)
+        if not markdown:
+            return cut
+        position = cut
+        while position > 0:
+            end = position
+            while end > 0 and text[end - 1].isspace():
+                end -= 1
+            line_start = text.rfind("\n", 0, end) + 1
+            if end == 0 or not self.HEADING_PATTERN.match(text[line_start:end].strip()):
+                break
+            position = line_start
+        return position
+
+    def chunk_stream(self, pieces: Iterable[str], markdown: bool = True,
+                     window: int = CHUNK_STREAM_WINDOW) -> Iterator[Dict[str, Any]]:
+        """Chunk a document that arrives in pieces, holding about window characters at a time.
+
+        Text is cut at the last paragraph break (or line break) of each
+        window, before any headings that end it, and chunked like chunk().
+        Heading paths carry across the cuts and offsets are relative to the
+        whole document; chunks do not overlap across a cut.
+
+        Args:
+            pieces: The document text, in order
+            markdown: Whether to split at markdown headings first
+            window: Characters collected before a part of the text is chunked
+
+        Yields:
+            Chunks, as returned by chunk()
+        """
+        state: Dict[str, Any] = {}
+        held: List[str] = []
+        held_chars = 0
+        base = 0
+        for piece in pieces:
+            held.append(piece)
+            held_chars += len(piece)
+            if held_chars < window:
+                continue
+            text = "".join(held)
+            cut = self._stream_cut(text, markdown)
+            if not cut:
+                continue  # Only headings so far: hold them until their content arrives
+            for chunk in self.chunk(text[:cut], markdown, state):
+                yield {**chunk, "offset": base + chunk["offset"]}
+            base += cut
+            held = [text[cut:]]
+            held_chars = len(held[0])
+        text = "".join(held)
+        if text.strip():
+            for chunk in self.chunk(text, markdown, state):
+                yield {**chunk, "offset": base + chunk["offset"]}
+
+    def _make_chunk(self, text: str, units: List[tuple], path: str) -> Dict[str, Any]:
+        start, end = units[0][0], units[-1][1]
+        raw = text[start:end]
+        return {
+            "text": raw.strip(),
+            "offset": start + len(raw) - len(raw.lstrip()),
+            "section": path,
+            "tokens": sum(unit[2] for unit in units)
+        }
+
+
+class MetadataIndex:
+    def __init__(self, fields: tuple = METADATA_INDEX_FIELDS):
+        """In-process index from metadata values to document ids.
+        
+        Resolves equality, $eq, $in, $and and $or filters on the indexed
+        fields to id sets, so selective filters do not scan the collection.
+        
+        Args:
+            fields: Metadata fields to index
+        """
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.values: Dict[str, Dict[Any, set]] = {field: {} for field in fields}
+        self.entries: Dict[str, tuple] = {}  # id -> indexed values, for removal
+        self.version = 0  # Bumped whenever documents are added, updated or removed
+    
+    def add(self, ids: List[str], metadatas: List[Dict[str, Any]], replace: bool = True):
+        """Index documents.
+        
+        Args:
+            ids: Document ids
+            metadatas: Metadata of each document
+            replace: Replace the values of ids that are already indexed;
+                otherwise those ids are left as they are
+        """
+        with self.lock:
+            self.version += 1
+            for doc_id, metadata in zip(ids, metadatas):
+                if doc_id in self.entries and not replace:
+                    continue
+                self._remove(doc_id)
+                values = tuple((metadata or {}).get(field) for field in self.fields)
+                for field, value in zip(self.fields, values):
+                    if value is not None:
+                        self.values[field].setdefault(value, set()).add(doc_id)
+                self.entries[doc_id] = values
+    
+    def remove(self, ids: List[str]):
+        """Drop documents from the index."""
+        with self.lock:
+            self.version += 1
+            for doc_id in ids:
+                self._remove(doc_id)
+    
+    def _remove(self, doc_id: str):
+        values = self.entries.pop(doc_id, None)
+        if values is None:
+            return
+        for field, value in zip(self.fields, values):
+            if value is None:
+                continue
+            ids = self.values[field].get(value)
+            if ids is not None:
+                ids.discard(doc_id)
+                if not ids:
+                    del self.values[field][value]
+    
+    def resolve(self, where: Optional[Dict[str, Any]]) -> Optional[set]:
+        """Ids matching a ChromaDB where filter, or None if the filter cannot be answered from the index."""
+        if not where:
+            return None
+        with self.lock:
+            try:
+                result = self._resolve(where)
+            except TypeError:  # Unhashable filter values
+                return None
+            return set(result) if result is not None else None
+    
+    def _resolve(self, where: Dict[str, Any]) -> Optional[set]:
+        matches = []
+        for key, condition in where.items():
+            if key in ("$and", "$or"):
+                if not isinstance(condition, list) or not condition:
+                    return None
+                parts = [self._resolve(part) if isinstance(part, dict) else None for part in condition]
+                if any(part is None for part in parts):
+                    return None
+                matches.append(set.intersection(*parts) if key == "$and" else set.union(*parts))
+            elif key in self.values:
+                if isinstance(condition, dict):
+                    if len(condition) != 1:
+                        return None
+                    operator, value = next(iter(condition.items()))
+                    if operator == "$eq":
+                        matches.append(self.values[key].get(value, set()))
+                    elif operator == "$in" and isinstance(value, list):
+                        matches.append(set().union(*(self.values[key].get(v, set()) for v in value)))
+                    else:
+                        return None
+                else:
+                    matches.append(self.values[key].get(condition, set()))
+            else:
+                return None
+        if not matches:
+            return None
+        matches.sort(key=len)
+        return matches[0].intersection(*matches[1:])
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get index size for debug metrics."""
+        with self.lock:
+            return {
+                'documents': len(self.entries),
+                'distinct_values': {field: len(values) for field, values in self.values.items()}
+            }
+
+
+class RAGSystem:
+    # Lexical and metadata indexes shared by every RAG system on the same collection
+    _indexes: Dict[tuple, tuple] = {}
+    _index_errors: Dict[tuple, str] = {}  # Last error of each index build that has not succeeded
+    _indexes_lock = threading.Lock()
+    
+    def __init__(self, collection_name: str = "agent_knowledge", chunker: Optional[DocumentChunker] = None,
+                 persist_directory: Optional[str] = KNOWLEDGE_BASE_DIR, embedding_function=None):
+        """Initialize the RAG system with ChromaDB for vector storage.
+        
+        Args:
+            collection_name: Name for the ChromaDB collection
+            chunker: Splits documents into chunks before they are stored
+            persist_directory: Directory the knowledge base is stored in and
+                reopened from on startup; in-memory only if empty
+            embedding_function: Embedding function (defaults to the shared embedding cache)
+        """
+        self.chunker = chunker or DocumentChunker()
+
+        # Initialize ChromaDB client
+        if persist_directory:
+            os.makedirs(persist_directory, exist_ok=True)
+            self.client = chromadb.PersistentClient(path=persist_directory)
+        else:
+            self.client = chromadb.Client()
+        
+        # Use Sentence Transformers for embeddings, through the shared cache
+        self.embedding_function = embedding_function or embedding_cache
+        
+        # Create or get collection
+        self.collection = self.client.get_or_create_collection(
+            name=collection_name,
+            embedding_function=self.embedding_function
+        )
+        
+        # Build the lexical and metadata indexes in the background so startup does not wait on them
+        key = (persist_directory or "", collection_name)
+        with RAGSystem._indexes_lock:
+            entry = RAGSystem._indexes.get(key)
+            build = entry is None
+            if build:
+                entry = RAGSystem._indexes[key] = (BM25Index(), MetadataIndex(), threading.Event())
+        self.lexical_index, self.metadata_index, self.indexes_ready = entry
+        self._index_key = key
+        if build:
+            threading.Thread(target=self._build_indexes, daemon=True).start()
+    
+    def _build_indexes(self):
+        """Index every stored document; documents added meanwhile are indexed directly.
+        
+        A page that fails is retried with a growing delay. After
+        LEXICAL_INDEX_BUILD_RETRIES failures the build gives up, retrieval keeps
+        using the vector store alone and the error is reported by get_stats.
+        """
+        start_time = time.time()
+        offset = 0
+        failures = 0
+        while True:
+            try:
+                page = self.collection.get(include=["documents", "metadatas"], limit=LEXICAL_INDEX_BUILD_BATCH, offset=offset)
+                if not page["ids"]:
+                    break
+                self.lexical_index.add(page["ids"], page["documents"])
+                # Keep ids indexed meanwhile: their metadata may be newer than this page
+                self.metadata_index.add(page["ids"], page["metadatas"], replace=False)
+                offset += len(page["ids"])
+            except Exception as e:
+                failures += 1
+                RAGSystem._index_errors[self._index_key] = str(e)
+                if failures > LEXICAL_INDEX_BUILD_RETRIES:
+                    logger.error(f"Gave up building knowledge base indexes after {failures} attempts: {e}")
+                    return
+                delay = LEXICAL_INDEX_BUILD_RETRY_DELAY * 2 ** (failures - 1)
+                logger.warning(f"Error building knowledge base indexes, retrying in {delay:.0f}s: {e}")
+                time.sleep(delay)
+        RAGSystem._index_errors.pop(self._index_key, None)
+        self.indexes_ready.set()
+        logger.info(f"Built lexical and metadata indexes over {len(self.lexical_index)} documents in {time.time() - start_time:.2f}s")
+    
+    @property
+    def version(self) -> int:
+        """Counter that changes whenever the stored documents change.
+        
+        Answers built on the knowledge base are only valid for the version
+        they were generated at.
+        """
+        return self.metadata_index.version
+    
+    @staticmethod
+    def content_id(text: str, parent_id: Optional[str] = None) -> str:
+        """Content-addressed ID for a stored document, or for a chunk within its parent.
+        
+        Chunk IDs include the parent, so a text shared by two documents is
+        stored once per document and upserting one never rewrites or prunes
+        the other's copy; the embedding cache still embeds it only once.
+        """
+        key = text if parent_id is None else f"{parent_id}\n{text}"
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+    
+    def add_documents(self, documents: List[str], metadatas: Optional[List[Dict[str, Any]]] = None, ids: Optional[List[str]] = None, chunk: bool = True, upsert: bool = False) -> Dict[str, int]:
+        """Add documents to the vector store.
+        
+        Stored IDs are hashes of the stored text (chunks: of their parent and
+        text), so re-adding a document never embeds it again: texts that are
+        already stored for it are skipped, or with upsert only get their
+        metadata updated.
+        
+        Args:
+            documents: List of text documents to add
+            metadatas: Optional metadata for each document
+            ids: Optional parent IDs for each document (content hashes if not provided)
+            chunk: Whether to split documents into chunks first; each chunk is
+                stored with its parent's metadata plus parent_id, chunk_index,
+                chunk_count, offset and section
+            upsert: Update the metadata of texts that are already stored and
+                delete chunks a re-added parent no longer contains
+        
+        Returns:
+            Counts of inserted, updated, skipped and deleted documents
+        """
+        return self.write_documents(*self.prepare_documents(documents, metadatas, ids, chunk), upsert=upsert)
+    
+    def prepare_documents(self, documents: List[str], metadatas: Optional[List[Dict[str, Any]]] = None,
+                          ids: Optional[List[str]] = None, chunk: bool = True):
+        """Fill in default metadata and IDs and split documents into chunks.
+        
+        Returns:
+            Tuple of (texts, metadatas, ids, parent IDs); parent IDs are empty
+            when the documents are stored unchunked
+        """
+        if ids is None:
+            ids = [self.content_id(document) for document in documents]
+        
+        if metadatas is None:
+            metadatas = [{"source": "user_input"} for _ in documents]
+        
+        if not chunk:
+            return documents, metadatas, ids, []
+        return (*self._chunk_documents(documents, metadatas, ids), ids)
+    
+    def write_documents(self, documents: List[str], metadatas: List[Dict[str, Any]], ids: List[str],
+                        parent_ids: List[str], upsert: bool = False,
+                        embeddings: Optional[Dict[str, List[float]]] = None) -> Dict[str, int]:
+        """Store prepared documents, embedding only texts that are not stored yet.
+        
+        Args:
+            documents: Texts from prepare_documents
+            metadatas: Metadata for each text
+            ids: Content-hash ID of each text
+            parent_ids: Parents whose stale chunks are deleted on upsert
+            upsert: Update the metadata of stored texts and delete stale chunks
+            embeddings: Optional precomputed embeddings by ID
+        
+        Returns:
+            Counts of inserted, updated, skipped and deleted documents
+        """
+        counts = {"inserted": 0, "updated": 0, "skipped": 0, "deleted": 0}
+        
+        # Keep the first copy of texts that appear more than once in the batch
+        batch: Dict[str, tuple] = {}
+        for document, metadata, doc_id in zip(documents, metadatas, ids):
+            if doc_id in batch:
+                counts["skipped"] += 1
+            else:
+                batch[doc_id] = (document, metadata)
+        
+        existing = {}
+        if batch:
+            stored = self.collection.get(ids=list(batch), include=["metadatas"])
+            existing = dict(zip(stored["ids"], stored["metadatas"] or [{}] * len(stored["ids"])))
+        
+        new_ids = [doc_id for doc_id in batch if doc_id not in existing]
+        if new_ids:
+            if embeddings is not None and all(doc_id in embeddings for doc_id in new_ids):
+                self.collection.add(
+                    documents=[batch[doc_id][0] for doc_id in new_ids],
+                    metadatas=[batch[doc_id][1] for doc_id in new_ids],
+                    embeddings=[embeddings[doc_id] for doc_id in new_ids],
+                    ids=new_ids
+                )
+            else:
+                self.collection.add(
+                    documents=[batch[doc_id][0] for doc_id in new_ids],
+                    metadatas=[batch[doc_id][1] for doc_id in new_ids],
+                    ids=new_ids
+                )
+            self.lexical_index.add(new_ids, [batch[doc_id][0] for doc_id in new_ids])
+            self.metadata_index.add(new_ids, [batch[doc_id][1] for doc_id in new_ids])
+            counts["inserted"] = len(new_ids)
+        
+        changed_ids = []
+        for doc_id, metadata in existing.items():
+            if upsert and metadata != batch[doc_id][1]:
+                changed_ids.append(doc_id)
+            else:
+                counts["skipped"] += 1
+        if changed_ids:
+            # Same text, so only the metadata changes and nothing is re-embedded
+            self.collection.update(ids=changed_ids, metadatas=[batch[doc_id][1] for doc_id in changed_ids])
+            self.metadata_index.add(changed_ids, [batch[doc_id][1] for doc_id in changed_ids])
+            counts["updated"] = len(changed_ids)
+        
+        if upsert:
+            for parent_id in parent_ids:
+                stored_ids = self.metadata_index.resolve({"parent_id": parent_id}) if self.indexes_ready.is_set() else None
+                if stored_ids is None:
+                    stored_ids = self.collection.get(where={"parent_id": parent_id}, include=[])["ids"]
+                stale_ids = [doc_id for doc_id in stored_ids if doc_id not in batch]
+                if stale_ids:
+                    self.collection.delete(ids=stale_ids)
+                    self.lexical_index.remove(stale_ids)
+                    self.metadata_index.remove(stale_ids)
+                    counts["deleted"] += len(stale_ids)
+        
+        logger.info(
+            f"Added documents to RAG system: {counts['inserted']} inserted, {counts['updated']} updated, "
+            f"{counts['skipped']} skipped, {counts['deleted']} deleted"
+        )
+        return counts
+    
+    def _chunk_documents(self, documents: List[str], metadatas: List[Dict[str, Any]], ids: List[str]):
+        """Expand documents into chunks with parent-document metadata.
+        
+        Returns:
+            Tuple of (chunk texts, chunk metadatas, chunk ids)
+        """
+        chunk_documents, chunk_metadatas, chunk_ids = [], [], []
+        for document, metadata, parent_id in zip(documents, metadatas, ids):
+            markdown = metadata.get("format", "markdown") == "markdown"
+            chunks = self.chunker.chunk(document, markdown=markdown)
+            for index, chunk in enumerate(chunks):
+                chunk_documents.append(chunk["text"])
+                chunk_metadatas.append({
+                    **metadata,
+                    "parent_id": parent_id,
+                    "chunk_index": index,
+                    "chunk_count": len(chunks),
+                    "offset": chunk["offset"],
+                    "section": chunk["section"]
+                })
+                chunk_ids.append(self.content_id(chunk["text"], parent_id))
+        return chunk_documents, chunk_metadatas, chunk_ids
+    
+    def has_documents(self, where: Dict[str, Any]) -> bool:
+        """Check whether any stored document matches a metadata filter."""
+        results = self.collection.get(where=where, limit=1, include=[])
+        return bool(results["ids"])
+    
+    def has_source_url(self, url: str) -> bool:
+        """Check whether any stored document came from the given URL."""
+        return self.has_documents({"url": url})
+    
+    def query(self, query_text: str, n_results: int = 3, where: Optional[Dict[str, Any]] = None,
+              mode: str = RETRIEVAL_MODE) -> List[Dict[str, Any]]:
+        """Retrieve relevant documents based on a query.
+        
+        Args:
+            query_text: The text to search for similar documents
+            n_results: Number of results to return
+            where: Optional ChromaDB metadata filter, e.g. {"source": "web_crawl"}
+            mode: vector, lexical (BM25) or hybrid
+            
+        Returns:
+            List of results including document text and metadata
+        """
+        return self.query_many([query_text], n_results=n_results, where=where, mode=mode)[0]
+    
+    def query_many(self, query_texts: List[str], n_results: int = 3,
+                   where: Optional[Dict[str, Any]] = None, mode: str = RETRIEVAL_MODE) -> List[List[Dict[str, Any]]]:
+        """Retrieve relevant documents for several queries, embedded and searched in one call.
+        
+        Filters on indexed metadata fields are resolved to id sets in-process;
+        when few documents match, they are ranked exactly without going
+        through the vector index.
+        
+        Args:
+            query_texts: The texts to search for similar documents
+            n_results: Number of results to return per query
+            where: Optional ChromaDB metadata filter applied to every query
+            mode: vector (embeddings only), lexical (BM25 only) or hybrid
+                (both, merged by reciprocal-rank fusion); lexical and hybrid
+                fall back to vector while the BM25 index is still being built
+            
+        Returns:
+            One list of results per query, each including document text and metadata
+        """
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unsupported retrieval mode: {mode}")
+        if not query_texts:
+            return []
+        ready = self.indexes_ready.is_set()
+        if mode != "vector" and not ready:
+            logger.info("Lexical index is still being built, using vector retrieval")
+            mode = "vector"
+        
+        allowed = self.metadata_index.resolve(where) if where and ready else None
+        if allowed is not None and not allowed:
+            return [[] for _ in query_texts]
+        
+        vector_results = [[] for _ in query_texts]
+        if mode != "lexical":
+            n_vector = n_results * HYBRID_CANDIDATE_FACTOR if mode == "hybrid" else n_results
+            if allowed is not None and len(allowed) <= METADATA_SCAN_LIMIT:
+                vector_results = self._scan_query(query_texts, n_vector, allowed)
+            else:
+                vector_results = self._vector_query(query_texts, n_vector, where)
+        if mode == "vector":
+            return vector_results
+        
+        n_lexical = n_results * HYBRID_CANDIDATE_FACTOR if mode == "hybrid" else n_results
+        lexical_hits = [self.lexical_index.search(text, n_lexical, allowed=allowed) for text in query_texts]
+        
+        # Load the lexical hits the vector search did not return; the filter is
+        # already applied when the metadata index answered it
+        known = {result["id"]: result for results in vector_results for result in results}
+        missing = list({doc_id for hits in lexical_hits for doc_id, _ in hits if doc_id not in known})
+        if missing:
+            stored = self.collection.get(
+                ids=missing,
+                where=(where or None) if allowed is None else None,
+                include=["documents", "metadatas"]
+            )
+            for i, doc_id in enumerate(stored["ids"]):
+                known[doc_id] = {
+                    "document": stored["documents"][i],
+                    "metadata": stored["metadatas"][i] if stored.get("metadatas") else {},
+                    "id": doc_id,
+                    "distance": None
+                }
+        
+        formatted_results = []
+        for results, hits in zip(vector_results, lexical_hits):
+            scores = {doc_id: score for doc_id, score in hits}
+            lexical_ids = [doc_id for doc_id, _ in hits if doc_id in known]
+            if mode == "hybrid":
+                ranked = [doc_id for doc_id, _ in reciprocal_rank_fusion([[r["id"] for r in results], lexical_ids])]
+            else:
+                ranked = lexical_ids
+            formatted_results.append([
+                {**known[doc_id], "lexical_score": scores.get(doc_id)}
+                for doc_id in ranked[:n_results]
+            ])
+        return formatted_results
+    
+    def _scan_query(self, query_texts: List[str], n_results: int, ids: set) -> List[List[Dict[str, Any]]]:
+        """Exact embedding search over a small set of documents, using the collection's distance."""
+        stored = self.collection.get(ids=list(ids), include=["embeddings", "documents", "metadatas"])
+        if not len(stored["ids"]):
+            return [[] for _ in query_texts]
+        
+        vectors = np.asarray(stored["embeddings"], dtype=np.float32)
+        queries = np.asarray(self.embedding_function(query_texts), dtype=np.float32)
+        space = (self.collection.metadata or {}).get("hnsw:space", "l2")
+        if space == "cosine":
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+            distances = 1.0 - queries @ vectors.T
+        elif space == "ip":
+            distances = 1.0 - queries @ vectors.T
+        else:
+            # Squared L2, like ChromaDB's default space
+            distances = (queries ** 2).sum(axis=1)[:, None] + (vectors ** 2).sum(axis=1)[None, :] - 2 * queries @ vectors.T
+        
+        formatted_results = []
+        for row in distances:
+            order = np.argsort(row, kind='stable')[:n_results]
+            formatted_results.append([{
+                "document": stored["documents"][i],
+                "metadata": stored["metadatas"][i] if stored.get("metadatas") else {},
+                "id": stored["ids"][i],
+                "distance": float(row[i])
+            } for i in order])
+        return formatted_results
+    
+    def _vector_query(self, query_texts: List[str], n_results: int,
+                      where: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+        """Embedding search for several queries in one ChromaDB call."""
+        results = self.collection.query(
+            query_texts=query_texts,
+            n_results=n_results,
+            where=where or None
+        )
+        
+        # Format results for easier consumption
+        formatted_results = []
+        for q in range(len(query_texts)):
+            query_results = []
+            documents = results["documents"][q] if results.get("documents") else []
+            for i, doc in enumerate(documents):
+                query_results.append({
+                    "document": doc,
+                    "metadata": results["metadatas"][q][i] if results.get("metadatas") else {},
+                    "id": results["ids"][q][i],
+                    "distance": results["distances"][q][i] if results.get("distances") else None
+                })
+            formatted_results.append(query_results)
+        
+        return formatted_results
+    
+    def similarity(self, result: Dict[str, Any]) -> Optional[float]:
+        """Cosine similarity of a query result, or None if it has no vector distance."""
+        distance = result.get("distance")
+        if distance is None:
+            return None
+        space = (self.collection.metadata or {}).get("hnsw:space", "l2")
+        if space == "l2":
+            # Squared L2 between unit-length embeddings is 2 - 2 * cosine
+            return 1.0 - distance / 2.0
+        return 1.0 - distance
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get knowledge base statistics for debug metrics."""
+        return {
+            'documents': self.collection.count(),
+            'indexes_ready': self.indexes_ready.is_set(),
+            'index_error': RAGSystem._index_errors.get(self._index_key),
+            'lexical_index': self.lexical_index.get_stats(),
+            'metadata_index': self.metadata_index.get_stats()
+        }
+
+
+class IngestionQueue:
+    def __init__(self, batch_chars: int = INGEST_BATCH_CHARS, batch_window: float = INGEST_BATCH_WINDOW):
+        """Add documents to RAG systems from a background worker in large embedding batches.
+        
+        A batch is taken once batch_chars of text are pending, batch_window
+        seconds after its first document arrived, or as soon as someone flushes.
+        All new chunks of a batch are embedded in one call.
+        
+        Args:
+            batch_chars: Pending characters that trigger a batch immediately
+            batch_window: Seconds to wait for more documents
+        """
+        self.batch_chars = batch_chars
+        self.batch_window = batch_window
+        self.pending: deque = deque()
+        self.pending_chars = 0
+        self.submitted = 0
+        self.completed = 0
+        self.flush_waiters = 0
+        self.condition = threading.Condition()
+        self.stats = {'batches': 0, 'documents': 0, 'chunks_embedded': 0, 'errors': 0, 'last_batch_seconds': 0.0}
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+    
+    def submit(self, rag: "RAGSystem", documents: List[str], metadatas: Optional[List[Dict[str, Any]]] = None,
+               ids: Optional[List[str]] = None, chunk: bool = True, upsert: bool = False) -> Future:
+        """Queue documents for RAGSystem.add_documents.
+        
+        Returns:
+            Future resolving to the add_documents counts; await it with
+            asyncio.wrap_future from async code
+        """
+        future = Future()
+        with self.condition:
+            self.pending.append({
+                'rag': rag,
+                'args': (documents, metadatas, ids, chunk),
+                'upsert': upsert,
+                'future': future
+            })
+            self.pending_chars += sum(len(document) for document in documents)
+            self.submitted += 1
+            self.condition.notify_all()
+        return future
+    
+    def submit_stream(self, rag: "RAGSystem", pieces: Iterable[str], metadata: Dict[str, Any], parent_id: str,
+                      max_pending: int = INGEST_STREAM_PENDING_BATCHES) -> Dict[str, int]:
+        """Chunk and store a document that arrives in pieces, such as a large upload.
+        
+        Chunks are queued in batches of about batch_chars as they are produced,
+        and reading stops while max_pending batches are waiting, so memory use
+        does not depend on the document size. Chunks get the metadata plus
+        parent_id, chunk_index, offset and section; chunk_count is not known
+        while streaming and is left out. Blocks until every chunk is stored.
+        
+        Chunk ids are scoped to parent_id, so the document only ever adds its
+        own chunks; a repeated chunk keeps its first copy, and chunks of other
+        documents with the same text are left alone.
+        
+        Args:
+            rag: RAG system to add the document to
+            pieces: The document text, in order
+            metadata: Metadata shared by every chunk
+            parent_id: ID of the document, stored as parent_id of its chunks
+            max_pending: Batches queued or being embedded at once
+        
+        Returns:
+            Counts of inserted, updated, skipped and deleted chunks, plus the
+            number of chunks read
+        """
+        markdown = metadata.get("format", "markdown") == "markdown"
+        totals = {"inserted": 0, "updated": 0, "skipped": 0, "deleted": 0, "chunks": 0}
+        pending: deque = deque()
+        texts, metadatas, ids = [], [], []
+        batch_chars = 0
+        
+        def collect(future: Future):
+            for key, value in future.result().items():
+                totals[key] += value
+        
+        for chunk in rag.chunker.chunk_stream(pieces, markdown=markdown):
+            texts.append(chunk["text"])
+            metadatas.append({
+                **metadata,
+                "parent_id": parent_id,
+                "chunk_index": totals["chunks"],
+                "offset": chunk["offset"],
+                "section": chunk["section"]
+            })
+            ids.append(rag.content_id(chunk["text"], parent_id))
+            totals["chunks"] += 1
+            batch_chars += len(chunk["text"])
+            if batch_chars >= self.batch_chars:
+                pending.append(self.submit(rag, texts, metadatas, ids, chunk=False))
+                texts, metadatas, ids = [], [], []
+                batch_chars = 0
+                while len(pending) > max_pending:
+                    collect(pending.popleft())
+        if texts:
+            pending.append(self.submit(rag, texts, metadatas, ids, chunk=False))
+            self.flush(timeout=None)
+        while pending:
+            collect(pending.popleft())
+        return totals
+    
+    def flush(self, timeout: Optional[float] = INGEST_FLUSH_TIMEOUT) -> bool:
+        """Wait until everything submitted so far is stored.
+        
+        Returns:
+            True if the queue caught up before the timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            target = self.submitted
+            if self.completed >= target:
+                return True
+            self.flush_waiters += 1
+            self.condition.notify_all()
+            try:
+                while self.completed < target:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                return True
+            finally:
+                self.flush_waiters -= 1
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                deadline = time.monotonic() + self.batch_window
+                while self.pending_chars < self.batch_chars and not self.flush_waiters:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                jobs = list(self.pending)
+                self.pending.clear()
+                self.pending_chars = 0
+            
+            start_time = time.time()
+            try:
+                self._process(jobs)
+            except Exception as e:
+                logger.error(f"Error in ingestion batch: {e}")
+            finally:
+                with self.condition:
+                    self.stats['batches'] += 1
+                    self.stats['last_batch_seconds'] = time.time() - start_time
+                    self.completed += len(jobs)
+                    self.condition.notify_all()
+    
+    def _process(self, jobs: List[Dict[str, Any]]):
+        """Embed the new chunks of a batch in one call per RAG system, then store each job."""
+        by_rag: Dict[int, List[Dict[str, Any]]] = {}
+        for job in jobs:
+            by_rag.setdefault(id(job['rag']), []).append(job)
+        
+        for rag_jobs in by_rag.values():
+            rag = rag_jobs[0]['rag']
+            embeddings = None
+            try:
+                for job in rag_jobs:
+                    job['prepared'] = rag.prepare_documents(*job['args'])
+                texts = {}
+                for job in rag_jobs:
+                    texts.update(zip(job['prepared'][2], job['prepared'][0]))
+                if texts:
+                    stored = set(rag.collection.get(ids=list(texts), include=[])["ids"])
+                    missing = [doc_id for doc_id in texts if doc_id not in stored]
+                    if missing:
+                        vectors = rag.embedding_function([texts[doc_id] for doc_id in missing])
+                        embeddings = dict(zip(missing, vectors))
+                        with self.condition:
+                            self.stats['chunks_embedded'] += len(missing)
+            except Exception as e:
+                logger.error(f"Error embedding ingestion batch: {e}")
+                with self.condition:
+                    self.stats['errors'] += 1
+                # Jobs are still stored one by one below, embedding as they go
+            
+            for job in rag_jobs:
+                try:
+                    prepared = job.get('prepared') or rag.prepare_documents(*job['args'])
+                    counts = rag.write_documents(*prepared, upsert=job['upsert'], embeddings=embeddings)
+                    with self.condition:
+                        self.stats['documents'] += len(job['args'][0])
+                    job['future'].set_result(counts)
+                except Exception as e:
+                    logger.error(f"Error adding documents to RAG system: {e}")
+                    with self.condition:
+                        self.stats['errors'] += 1
+                    job['future'].set_exception(e)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get queue depth and throughput for debug metrics."""
+        with self.condition:
+            return {
+                'queue_depth': len(self.pending),
+                'pending_chars': self.pending_chars,
+                'in_flight': self.submitted - self.completed,
+                **self.stats
+            }
+
+
+# Initialize the background ingestion queue
+ingestion_queue = IngestionQueue()
+
+
+class SemanticCache:
+    def __init__(self, embedding_function=None, collection_name: str = "semantic_cache",
+                 max_entries: int = SEMANTIC_CACHE_SIZE, threshold: float = SEMANTIC_CACHE_THRESHOLD):
+        """Cache answers to past questions and serve them for near-paraphrases.
+        
+        Questions are embedded with the same embedding function as the RAG system
+        and stored in their own ChromaDB collection, with the answer in metadata.
+        Each answer is tagged with the knowledge base version it was generated
+        at and only served while that version is current.
+        
+        Args:
+            embedding_function: Embedding function (defaults to the shared embedding cache)
+            collection_name: Name for the ChromaDB collection
+            max_entries: Maximum number of cached answers
+            threshold: Minimum cosine similarity for a cached answer to be served
+        """
+        self.client = chromadb.Client()
+        self.embedding_function = embedding_function or embedding_cache
+        self.collection = self.client.get_or_create_collection(
+            name=collection_name,
+            embedding_function=self.embedding_function,
+            metadata={"hnsw:space": "cosine"}
+        )
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.entry_ids: "OrderedDict[str, None]" = OrderedDict()  # LRU order of cached ids
+        self.lock = threading.Lock()
+        self.stats = {'lookups': 0, 'hits': 0, 'evictions': 0}
+    
+    def lookup(self, question: str, model: str, kb_version: int) -> Optional[str]:
+        """Return the cached answer to a similar question, if one passes the threshold."""
+        with self.lock:
+            self.stats['lookups'] += 1
+            if not self.entry_ids:
+                return None
+        
+        try:
+            results = self.collection.query(
+                query_texts=[question],
+                n_results=1,
+                where={"$and": [{"model": model}, {"kb_version": kb_version}]}
+            )
+        except Exception as e:
+            logger.error(f"Error querying semantic cache: {e}")
+            return None
+        
+        if not results["ids"] or not results["ids"][0]:
+            return None
+        
+        # Cosine distance is 1 - similarity
+        similarity = 1 - results["distances"][0][0]
+        if similarity < self.threshold:
+            return None
+        
+        entry_id = results["ids"][0][0]
+        with self.lock:
+            if entry_id not in self.entry_ids:
+                return None  # Evicted while we were querying
+            self.entry_ids.move_to_end(entry_id)
+            self.stats['hits'] += 1
+        logger.debug(f"Semantic cache hit (similarity: {similarity:.3f})")
+        return results["metadatas"][0][0]["response"]
+    
+    def store(self, question: str, response: str, model: str, kb_version: int):
+        """Cache the answer to a question, evicting the least recently used answers when full."""
+        entry_id = hashlib.sha256(f"{model}\n{question}".encode('utf-8')).hexdigest()
+        try:
+            self.collection.upsert(
+                documents=[question],
+                metadatas=[{"model": model, "response": response, "kb_version": kb_version,
+                            "created_at": time.time()}],
+                ids=[entry_id]
+            )
+        except Exception as e:
+            logger.error(f"Error writing semantic cache: {e}")
+            return
+        
+        with self.lock:
+            self.entry_ids[entry_id] = None
+            self.entry_ids.move_to_end(entry_id)
+            evicted = []
+            while len(self.entry_ids) > self.max_entries:
+                evicted.append(self.entry_ids.popitem(last=False)[0])
+            self.stats['evictions'] += len(evicted)
+        if evicted:
+            self.collection.delete(ids=evicted)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get semantic cache statistics for debug metrics."""
+        with self.lock:
+            lookups = self.stats['lookups']
+            return {
+                **self.stats,
+                'entries': len(self.entry_ids),
+                'hit_rate': self.stats['hits'] / lookups if lookups else 0.0
+            }
+
+
+class ConversationSession:
+    def __init__(self, session_id: str):
+        """Hold the conversation history for a single client session.
+
+        Args:
+            session_id: Identifier the client sends with each request
+        """
+        self.session_id = session_id
+        self.history: List[Dict[str, str]] = []
+        self.token_counts: List[int] = []  # Token count of each history entry
+        self.total_tokens = 0
+        self.lock = threading.Lock()
+        self.created_at = time.time()
+        self.last_access = self.created_at
+        self.size_bytes = 0
+
+    @staticmethod
+    def _message_size(message: Dict[str, str]) -> int:
+        """Approximate the memory footprint of a message in bytes."""
+        return len(message["role"]) + len(message["content"].encode('utf-8'))
+
+    def append_message(self, role: str, content: str):
+        """Append a message to the history and update the size and token accounting."""
+        message = {"role": role, "content": content}
+        tokens = token_counter.count_message(message)
+        self.history.append(message)
+        self.token_counts.append(tokens)
+        self.size_bytes += self._message_size(message)
+        self.total_tokens += tokens
+
+        # Drop the oldest messages if this session alone exceeds its cap
+        while self.size_bytes > SESSION_MAX_BYTES and len(self.history) > 1:
+            self._remove_message(0)
+
+    def pop_message(self) -> Dict[str, str]:
+        """Remove and return the newest message in the history."""
+        return self._remove_message(-1)
+
+    def _remove_message(self, index: int) -> Dict[str, str]:
+        """Remove a history entry and its accounting."""
+        message = self.history.pop(index)
+        self.total_tokens -= self.token_counts.pop(index)
+        self.size_bytes -= self._message_size(message)
+        return message
+
+    def touch(self):
+        """Mark the session as recently used."""
+        self.last_access = time.time()
+
+
+class SessionStore:
+    def __init__(self, max_sessions: int = SESSION_MAX_COUNT, max_bytes: int = SESSION_STORE_MAX_BYTES,
+                 idle_ttl: int = SESSION_IDLE_TTL):
+        """Keep conversation sessions in memory with LRU and idle-TTL eviction.
+
+        Args:
+            max_sessions: Maximum number of sessions held at once
+            max_bytes: Maximum total size of all session histories
+            idle_ttl: Seconds of inactivity after which a session is dropped
+        """
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.sessions: "OrderedDict[str, ConversationSession]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def get_or_create(self, session_id: Optional[str] = None) -> ConversationSession:
+        """Return the session for an id, creating it if it does not exist."""
+        if not session_id:
+            session_id = str(uuid.uuid4())
+
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                # Make room before inserting so the new session is never the eviction victim
+                self._evict()
+                session = ConversationSession(session_id)
+                self.sessions[session_id] = session
+            else:
+                self.sessions.move_to_end(session_id)
+            session.touch()
+        return session
+
+    def release(self, session: ConversationSession):
+        """Record the end of a request on a session and enforce the memory cap."""
+        session.touch()
+        with self.lock:
+            self._evict()
+
+    def total_bytes(self) -> int:
+        """Total size of all session histories in bytes."""
+        return sum(session.size_bytes for session in self.sessions.values())
+
+    def _evict(self):
+        """Evict idle sessions, then least recently used ones while over the caps.
+
+        Sessions that are currently handling a request are never evicted.
+        Must be called with self.lock held.
+        """
+        now = time.time()
+        for session_id, session in list(self.sessions.items()):
+            if now - session.last_access > self.idle_ttl and not session.lock.locked():
+                del self.sessions[session_id]
+                self.evictions += 1
+
+        total_bytes = self.total_bytes()
+        for session_id, session in list(self.sessions.items()):
+            if len(self.sessions) <= self.max_sessions and total_bytes <= self.max_bytes:
+                break
+            if session.lock.locked():
+                continue
+            total_bytes -= session.size_bytes
+            del self.sessions[session_id]
+            self.evictions += 1
+
+    def cleanup_expired_sessions(self):
+        """Remove sessions that have been idle longer than the TTL."""
+        with self.lock:
+            self._evict()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get session store statistics for debug metrics."""
+        with self.lock:
+            return {
+                'active_sessions': len(self.sessions),
+                'total_bytes': self.total_bytes(),
+                'max_sessions': self.max_sessions,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions
+            }
+
+
+def event_text(events):
+    """Text view of an agent event stream: the answer plus the notices for tool use."""
+    for event in events:
+        if event.get('content'):
+            yield event['content']
+
+
+async def aevent_text(events):
+    """Async version of event_text."""
+    async for event in events:
+        if event.get('content'):
+            yield event['content']
+
+
+# Thread pool for auto-RAG retrieval, shared by all agents
+retrieval_executor = ThreadPoolExecutor(max_workers=AUTO_RAG_WORKERS, thread_name_prefix="auto-rag")
+
+# Thread pool running the tool calls of a model turn concurrently, shared by all agents
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+
+# Start of a JSON value that may hold tool calls
+JSON_VALUE_START = re.compile(r'[\[{]')
+
+# Streamed text that may start a tool call, and the characters that matter inside its JSON
+TOOL_CALL_START = re.compile(r'[\[{`]')
+TOOL_CALL_PREFIXES = ('{"tool', '[{"tool')
+TOOL_CALL_FENCE = "```json"
+JSON_STRUCTURE = re.compile(r'["\\{}\[\]]')
+TOOL_CALL_MAX_CHARS = 16384  # Held-back JSON after which a streamed value is no longer treated as a tool call
+
+
+class ToolCallDetector:
+    """Finds a tool call in a streamed response as soon as its JSON is complete.
+    
+    Streamed text is released for the client as it arrives, except from the
+    start of a possible tool call (a {"tool" object, a list of them, or a
+    ```json fence) onwards, which is held back until it either completes as
+    a tool call or stops looking like one. Calls written as several objects
+    in a row are cut off after the first; the system prompt asks for a list.
+    """
+    
+    def __init__(self, extract=None):
+        """Initialize a detector for one streamed response.
+        
+        Args:
+            extract: Function returning the tool calls in a piece of text, or None
+                to pass everything through (e.g. once the tool iteration limit is hit)
+        """
+        self.extract = extract
+        self.released: List[str] = []
+        self.pending = ""  # Held-back text that may start a tool call
+        self.holding = False
+        self.tool_calls: List[Dict[str, Any]] = []
+        self.response = ""  # Complete response, up to the end of the tool call if one was found
+        self._reset_scan()
+    
+    def _reset_scan(self):
+        self.confirmed = False  # Whether the held text starts like a tool call
+        self.scanned = 0
+        self.depth = 0
+        self.in_string = False
+    
+    def feed(self, chunk: str) -> str:
+        """Add a streamed chunk.
+        
+        Returns:
+            Text that can be forwarded to the client
+        """
+        if self.extract is None:
+            self.released.append(chunk)
+            return chunk
+        
+        self.pending += chunk
+        start = len(self.released)
+        while self.pending and not self.tool_calls:
+            if not self.holding:
+                match = TOOL_CALL_START.search(self.pending)
+                if not match:
+                    self.released.append(self.pending)
+                    self.pending = ""
+                    break
+                self.released.append(self.pending[:match.start()])
+                self.pending = self.pending[match.start():]
+                self.holding = True
+            
+            release = self._scan()
+            if release is None:
+                break
+            # Not a tool call: release what was ruled out and look again after it
+            self.released.append(self.pending[:release])
+            self.pending = self.pending[release:]
+            self.holding = False
+            self._reset_scan()
+        
+        return "".join(self.released[start:])
+    
+    def finish(self) -> str:
+        """End of the stream: release whatever is still held back."""
+        text = "" if self.tool_calls else self.pending
+        if not self.tool_calls:
+            self.released.append(text)
+            self.response = "".join(self.released)
+        self.pending = ""
+        return text
+    
+    def _scan(self) -> Optional[int]:
+        """Scan the held text.
+        
+        Returns:
+            None while it may still become a tool call (or once it did), otherwise
+            the number of held characters to release
+        """
+        text = self.pending
+        start = 0
+        if text[0] == "`":
+            if len(text) < len(TOOL_CALL_FENCE):
+                return None if TOOL_CALL_FENCE.startswith(text) else 1
+            if not text.startswith(TOOL_CALL_FENCE):
+                return 1
+            start = len(text) - len(text[len(TOOL_CALL_FENCE):].lstrip())
+            if start == len(text):
+                return None
+            if text[start] not in "[{":
+                return 1
+        
+        if not self.confirmed:
+            head = re.sub(r'\s+', '', text[start:start + 64])
+            if not any(prefix.startswith(head) or head.startswith(prefix) for prefix in TOOL_CALL_PREFIXES):
+                return 1
+            self.confirmed = any(head.startswith(prefix) for prefix in TOOL_CALL_PREFIXES)
+            if not self.confirmed:
+                return None
+        
+        # Track nesting outside strings until the value closes
+        position = max(self.scanned, start)
+        while True:
+            match = JSON_STRUCTURE.search(text, position)
+            if not match:
+                self.scanned = max(position, len(text))
+                break
+            position = match.start()
+            char = text[position]
+            if self.in_string:
+                if char == "\\":
+                    position += 2  # Skip the escaped character, even if it has not arrived yet
+                    continue
+                if char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "[{":
+                self.depth += 1
+            elif char in "]}":
+                self.depth -= 1
+                if self.depth == 0:
+                    end = position + 1
+                    tool_calls = self.extract(text[start:end])
+                    if not tool_calls:
+                        return end
+                    self.tool_calls = tool_calls
+                    self.response = "".join(self.released) + text[:end]
+                    self.pending = ""
+                    return None
+            position += 1
+        
+        if len(text) - start > TOOL_CALL_MAX_CHARS:
+            return len(text)
+        return None
+
+
+class Agent:
+    def __init__(self, llm: OpenRouterLLM, system_prompt: Optional[str] = None,
+                 context_budget: int = CONTEXT_INPUT_BUDGET, auto_rag: bool = AUTO_RAG_ENABLED,
+                 max_tool_iterations: int = MAX_TOOL_ITERATIONS):
+        """Initialize an agent with an LLM, tools, and RAG system.
+        
+        Args:
+            llm: The language model to use for reasoning
+            system_prompt: Optional system prompt to define agent behavior
+            context_budget: Maximum number of input tokens sent to the LLM per call
+            auto_rag: Whether to retrieve knowledge for every message and add it
+                to the prompt, instead of waiting for a search_knowledge call
+            max_tool_iterations: Rounds of tool calls allowed per message before
+                the model has to answer with what it has
+        """
+        self.llm = llm
+        self.context_budget = context_budget
+        self.auto_rag = auto_rag
+        self.max_tool_iterations = max_tool_iterations
         self.tools = {}
-        self.conversation_history = []
+        self.tools_version = 0  # Bumped by register_tool to invalidate the cached system prompt
+        self._system_prompt_cache = None
+        self.session = ConversationSession("default")
         self.rag = RAGSystem()
         
         # Default system prompt if none provided
@@ -695,6 +2861,7 @@ class Agent:
             self.system_prompt = """You are a helpful AI assistant with access to various tools.
 When you need to use a tool, respond with JSON in the format:
 {"tool": "tool_name", "parameters": {"param1": "value1", ...}}
+To use several tools at once, respond with a JSON list of such objects; they run in parallel.
 When providing responses, use these formatting conventions:
 - Use # ## ### for headers to organize information
 - Wrap code in ```language blocks with proper language specification  
@@ -715,50 +2882,85 @@ If you don't know something, say so instead of making up information.
     def _register_builtin_tools(self):
         """Register the built-in tools for the agent."""
         
-        # Initialize web crawler instance
-        web_crawler = WebCrawler()
-        
-        def crawl_website(url: str, output_format: str = "markdown", add_to_knowledge: bool = True) -> str:
-            """Crawl a website and optionally add the content to the knowledge base.
+        def crawl_website(url: Union[str, List[str]], output_format: str = "markdown", add_to_knowledge: bool = True) -> str:
+            """Crawl one or more websites and optionally add the content to the knowledge base.
             
             Args:
-                url: The URL to crawl
-                output_format: Format for the content (markdown or xml)
+                url: The URL to crawl, or a list of URLs to crawl concurrently
+                output_format: Format for the content (markdown, xml or text)
                 add_to_knowledge: Whether to automatically add crawled content to knowledge base
             """
+            urls = [url] if isinstance(url, str) else list(url)
             try:
-                results = web_crawler.crawl([url], output_format=output_format)
+                results = web_crawler.crawl(urls, output_format=output_format)
                 
                 if not results:
-                    return f"Failed to crawl {url} - no results returned"
+                    return f"Failed to crawl {', '.join(urls)} - no results returned"
                 
-                result = results[0]  # Single URL, single result
+                # Check which pages were crawled successfully
+                crawled = [result for result in results if not result['content'].startswith('Error crawling')]
                 
-                # Check if crawling was successful
-                if result['content'].startswith('Error crawling'):
-                    return result['content']
+                # Unchanged pages are only re-added if the knowledge base lost them (e.g. after a restart)
+                crawled = [
+                    result for result in crawled
+                    if not (result.get('unchanged') and self.rag.has_source_url(result['url']))
+                ]
                 
                 # Optionally add to knowledge base
-                if add_to_knowledge:
-                    metadata = {
+                knowledge_msg = ""
+                if add_to_knowledge and crawled:
+                    metadatas = [{
                         "source": "web_crawl",
-                        "url": url,
+                        "url": result['url'],
+                        "host": urlparse(result['url']).netloc,
                         "title": result.get('title', ''),
                         "format": output_format
-                    }
-                    self.rag.add_documents([result['content']], metadatas=[metadata])
-                    knowledge_msg = " (Added to knowledge base)"
-                else:
-                    knowledge_msg = ""
+                    } for result in crawled]
+                    # Pages are keyed by URL so a changed page replaces its old chunks;
+                    # embedding happens in the background so the reply is not held up
+                    ingestion_queue.submit(
+                        self.rag,
+                        [result['content'] for result in crawled],
+                        metadatas=metadatas,
+                        ids=[result['url'] for result in crawled],
+                        upsert=True
+                    )
+                    knowledge_msg = " (Queued for the knowledge base)"
                 
-                return f"Successfully crawled {url}{knowledge_msg}\n\nTitle: {result.get('title', 'N/A')}\n\nContent preview: {result['content'][:500]}..."
+                summaries = []
+                for result in results:
+                    if result['content'].startswith('Error crawling'):
+                        summaries.append(result['content'])
+                    elif result.get('unchanged'):
+                        summaries.append(f"{result['url']} is unchanged since the last crawl\n\nTitle: {result.get('title', 'N/A')}\n\nContent preview: {result['content'][:500]}...")
+                    else:
+                        summaries.append(f"Successfully crawled {result['url']}{knowledge_msg}\n\nTitle: {result.get('title', 'N/A')}\n\nContent preview: {result['content'][:500]}...")
+                return "\n\n---\n\n".join(summaries)
                 
             except Exception as e:
-                return f"Error crawling {url}: {str(e)}"
+                return f"Error crawling {', '.join(urls)}: {str(e)}"
         
-        def search_knowledge(query: str, n_results: int = 3) -> str:
-            """Search the knowledge base for relevant information."""
-            results = self.rag.query(query, n_results=n_results)
+        def search_knowledge(query: str, n_results: int = 3, source: Optional[str] = None,
+                             host: Optional[str] = None, url: Optional[str] = None) -> str:
+            """Search the knowledge base for relevant information.
+            
+            Args:
+                query: What to search for
+                n_results: Number of results to return
+                source: Only search documents from this source (e.g. web_crawl, user_input)
+                host: Only search pages crawled from this host (e.g. docs.python.org)
+                url: Only search the page crawled from this URL
+            """
+            conditions = [{key: value} for key, value in (("source", source), ("host", host), ("url", url)) if value]
+            where = None
+            if len(conditions) == 1:
+                where = conditions[0]
+            elif conditions:
+                where = {"$and": conditions}
+            
+            # Read your writes: include documents still waiting to be embedded
+            ingestion_queue.flush()
+            results = self.rag.query(query, n_results=n_results, where=where)
             if not results:
                 return "No relevant information found in the knowledge base."
             
@@ -767,12 +2969,14 @@ If you don't know something, say so instead of making up information.
                 source_info = ""
                 if result['metadata'].get('url'):
                     source_info = f" (Source: {result['metadata']['url']})"
-                response += f"**Result {i+1}**{source_info}:\n{result['document'][:300]}...\n\n"
+                if result['metadata'].get('section'):
+                    source_info += f" [{result['metadata']['section']}]"
+                response += f"**Result {i+1}**{source_info}:\n{result['document']}\n\n"
             return response
         
         def add_to_knowledge(text: str, source: str = "user_input") -> str:
             """Add information to the knowledge base."""
-            self.rag.add_documents([text], metadatas=[{"source": source}])
+            ingestion_queue.submit(self.rag, [text], metadatas=[{"source": source}])
             return f"Added to knowledge base: {text[:50]}..." if len(text) > 50 else text
         
         def get_current_time() -> str:
@@ -784,7 +2988,7 @@ If you don't know something, say so instead of making up information.
         self.register_tool(
             Tool(
                 name="crawl_website",
-                description="Crawl a website URL to extract its content in markdown or XML format. Automatically adds content to knowledge base unless specified otherwise.",
+                description="Crawl a website URL, or a list of URLs, to extract content in markdown, XML or plain text format. Automatically adds content to knowledge base unless specified otherwise.",
                 function=crawl_website
             )
         )
@@ -792,7 +2996,7 @@ If you don't know something, say so instead of making up information.
         self.register_tool(
             Tool(
                 name="search_knowledge",
-                description="Search the knowledge base for relevant information about a query",
+                description="Search the knowledge base for relevant information about a query, optionally restricted to one source, crawled host or URL",
                 function=search_knowledge
             )
         )
@@ -820,6 +3024,7 @@ If you don't know something, say so instead of making up information.
             tool: Tool object to register
         """
         self.tools[tool.name] = tool
+        self.tools_version += 1
         logger.info(f"Registered tool: {tool.name}")
     
     def get_tools_description(self) -> str:
@@ -840,208 +3045,791 @@ If you don't know something, say so instead of making up information.
         
         return "\n\n".join(descriptions)
     
-    def _extract_tool_call(self, llm_response: str) -> Optional[Dict[str, Any]]:
-        """Extract tool call from LLM response if present.
+    def _get_rendered_system_prompt(self) -> Dict[str, Any]:
+        """Render the system prompt with tool descriptions, cached per tools version.
+        
+        Returns:
+            Dictionary with the system message, its UTF-8 bytes and its token count
+        """
+        cache = self._system_prompt_cache
+        if (cache is None or cache['version'] != self.tools_version
+                or cache['system_prompt'] is not self.system_prompt):
+            content = self.system_prompt + "\n\nAvailable Tools:\n" + self.get_tools_description()
+            message = {"role": "system", "content": content}
+            cache = {
+                'version': self.tools_version,
+                'system_prompt': self.system_prompt,
+                'message': message,
+                'prefix': content.encode('utf-8'),
+                'tokens': self.llm._count_message_tokens(message)
+            }
+            self._system_prompt_cache = cache
+        return cache
+    
+    def get_system_message(self) -> Dict[str, str]:
+        """Get the system message sent at the start of every LLM call."""
+        return self._get_rendered_system_prompt()['message']
+    
+    @property
+    def system_prompt_prefix(self) -> bytes:
+        """The exact system prompt bytes sent upstream, stable until a tool is registered."""
+        return self._get_rendered_system_prompt()['prefix']
+    
+    def _build_messages(self, session: ConversationSession,
+                        context: Optional[Dict[str, Any]] = None) -> List[Dict[str, str]]:
+        """Assemble the messages for an LLM call within the context budget.
+        
+        The system prompt is always sent. History is added newest first while it
+        fits; the first message that does not fit is truncated if enough budget is
+        left for it, and everything older is dropped.
+        
+        Args:
+            session: Conversation session to take the history from
+            context: Optional retrieved context from _retrieve_context, sent
+                right before the newest user message
+            
+        Returns:
+            List of message objects to send to the LLM
+        """
+        rendered = self._get_rendered_system_prompt()
+        system_message = rendered['message']
+        budget = self.context_budget - rendered['tokens']
+        if context:
+            budget -= context['tokens']
+        
+        # Everything fits: skip the per-message walk
+        if session.total_tokens <= budget:
+            return self._insert_context([system_message] + session.history, context)
+        
+        selected = []
+        for message, message_tokens in zip(reversed(session.history), reversed(session.token_counts)):
+            if message_tokens <= budget:
+                selected.append(message)
+                budget -= message_tokens
+                continue
+            
+            # The newest message is always sent, older ones only if a useful slice fits
+            content_budget = budget - (message_tokens - self.llm._count_tokens(message["content"]))
+            if not selected or content_budget >= MIN_TRUNCATED_MESSAGE_TOKENS:
+                content_budget = max(content_budget, MIN_TRUNCATED_MESSAGE_TOKENS)
+                selected.append({
+                    "role": message["role"],
+                    "content": self.llm._truncate_to_tokens(message["content"], content_budget)
+                })
+            break
+        
+        if len(selected) < len(session.history):
+            logger.debug(f"Context window: sending {len(selected)} of {len(session.history)} messages "
+                         f"(budget: {self.context_budget} tokens)")
+        
+        selected.reverse()
+        return self._insert_context([system_message] + selected, context)
+    
+    @staticmethod
+    def _insert_context(messages: List[Dict[str, str]], context: Optional[Dict[str, Any]]) -> List[Dict[str, str]]:
+        """Place retrieved context before the newest user message, keeping the history prefix stable."""
+        if not context:
+            return messages
+        for i in range(len(messages) - 1, 0, -1):
+            if messages[i]["role"] == "user":
+                return messages[:i] + [context['message']] + messages[i:]
+        return messages[:1] + [context['message']] + messages[1:]
+    
+    def _retrieve_context(self, user_message: str, where: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Retrieve knowledge for a message and render the relevant chunks as a system message.
+        
+        Chunks below AUTO_RAG_MIN_SIMILARITY (or AUTO_RAG_MIN_LEXICAL_SCORE for
+        lexical-only matches) are skipped, and the rest are added in rank order
+        until AUTO_RAG_TOKEN_BUDGET is used up. With a filter, the message is
+        about those documents, so the best DOCUMENT_CONTEXT_RESULTS chunks are
+        used whatever their similarity, up to DOCUMENT_CONTEXT_TOKEN_BUDGET.
+        
+        Args:
+            user_message: The message to retrieve knowledge for
+            where: Optional metadata filter selecting the documents to use
+        
+        Returns:
+            Dictionary with the context message and its token count, or None
+            if nothing relevant was found
+        """
+        try:
+            if where is None:
+                results = self.rag.query(user_message, n_results=AUTO_RAG_RESULTS)
+            else:
+                results = self.rag.query(user_message, n_results=DOCUMENT_CONTEXT_RESULTS, where=where)
+        except Exception as e:
+            logger.warning(f"Auto-RAG retrieval failed: {e}")
+            return None
+        
+        if where is None:
+            header = "Relevant excerpts from the knowledge base, retrieved automatically (ignore them if they do not help):"
+            budget = AUTO_RAG_TOKEN_BUDGET - self.llm._count_tokens(header)
+        else:
+            header = "Excerpts from the documents this message is about, most relevant first:"
+            budget = DOCUMENT_CONTEXT_TOKEN_BUDGET - self.llm._count_tokens(header)
+        excerpts = []
+        for result in results:
+            similarity = self.rag.similarity(result)
+            if where is not None:
+                relevant = True
+            elif similarity is not None:
+                relevant = similarity >= AUTO_RAG_MIN_SIMILARITY
+            else:
+                relevant = (result.get('lexical_score') or 0.0) >= AUTO_RAG_MIN_LEXICAL_SCORE
+            if not relevant:
+                continue
+            
+            source_info = ""
+            source = result['metadata'].get('url') or result['metadata'].get('title')
+            if source:
+                source_info = f" (Source: {source})"
+            excerpt = f"[{len(excerpts) + 1}]{source_info}\n{result['document']}"
+            tokens = self.llm._count_tokens(excerpt)
+            if tokens > budget:
+                if budget < MIN_TRUNCATED_MESSAGE_TOKENS:
+                    break
+                excerpt = self.llm._truncate_to_tokens(excerpt, budget)
+                tokens = budget
+            excerpts.append(excerpt)
+            budget -= tokens
+        
+        if not excerpts:
+            return None
+        message = {"role": "system", "content": header + "\n\n" + "\n\n".join(excerpts)}
+        return {'message': message, 'tokens': self.llm._count_message_tokens(message)}
+    
+    def _start_retrieval(self, user_message: str, where: Optional[Dict[str, Any]] = None) -> Optional[Future]:
+        """Start auto-RAG retrieval in the background, bounded by the caller's timeout.
+        
+        Callers start it only after the semantic cache has missed, so cached
+        answers cost no retrieval.
+        
+        Retrieval restricted to specific documents runs even with auto-RAG off.
+        """
+        if not self.auto_rag and where is None:
+            return None
+        return retrieval_executor.submit(self._retrieve_context, user_message, where)
+    
+    def _wait_for_context(self, retrieval: Optional[Future], timeout: float = AUTO_RAG_TIMEOUT) -> Optional[Dict[str, Any]]:
+        """Get the prefetched context, giving up after timeout seconds."""
+        if retrieval is None:
+            return None
+        try:
+            return retrieval.result(timeout=timeout)
+        except Exception as e:
+            logger.warning(f"Answering without retrieved context: {e!r}")
+            return None
+    
+    def _astart_retrieval(self, user_message: str, where: Optional[Dict[str, Any]] = None) -> Optional[asyncio.Future]:
+        """Async version of _start_retrieval."""
+        if not self.auto_rag and where is None:
+            return None
+        return asyncio.ensure_future(asyncio.to_thread(self._retrieve_context, user_message, where))
+    
+    async def _await_context(self, retrieval: Optional[asyncio.Future],
+                             timeout: float = AUTO_RAG_TIMEOUT) -> Optional[Dict[str, Any]]:
+        """Async version of _wait_for_context."""
+        if retrieval is None:
+            return None
+        try:
+            return await asyncio.wait_for(retrieval, timeout)
+        except Exception as e:
+            logger.warning(f"Answering without retrieved context: {e!r}")
+            return None
+    
+    @property
+    def conversation_history(self) -> List[Dict[str, str]]:
+        """Conversation history of the agent's default session."""
+        return self.session.history
+    
+    def _extract_tool_calls(self, llm_response: str) -> List[Dict[str, Any]]:
+        """Extract the tool calls from an LLM response.
+        
+        A response may hold a single call object, a JSON list of them, an
+        object with a "tool_calls" list, or several call objects in a row.
+        Calls to unknown tools are ignored.
         
         Args:
             llm_response: The raw response from the LLM
             
         Returns:
-            Extracted tool call as a dictionary or None if no tool call
+            Tool calls in the order they appear (at most TOOL_MAX_CALLS_PER_TURN),
+            empty if there are none
         """
-        # First, try to find JSON within the response
-        json_match = re.search(r'```json\s*(.*?)\s*```', llm_response, re.DOTALL)
-        if not json_match:
-            json_match = re.search(r'{.*"tool".*}', llm_response, re.DOTALL)
+        if '"tool' not in llm_response:
+            return []
         
-        if json_match:
-            try:
-                tool_call = json.loads(json_match.group(1) if '```' in llm_response else json_match.group(0))
-                if "tool" in tool_call and tool_call["tool"] in self.tools:
-                    return tool_call
-            except json.JSONDecodeError:
-                pass
+        # Prefer fenced JSON blocks; otherwise look for JSON anywhere in the text
+        blocks = re.findall(r'```json\s*(.*?)\s*```', llm_response, re.DOTALL) or [llm_response]
+        decoder = json.JSONDecoder()
+        tool_calls = []
+        for block in blocks:
+            position = 0
+            while True:
+                match = JSON_VALUE_START.search(block, position)
+                if not match:
+                    break
+                try:
+                    value, position = decoder.raw_decode(block, match.start())
+                except json.JSONDecodeError:
+                    position = match.start() + 1
+                    continue
+                if isinstance(value, dict) and isinstance(value.get("tool_calls"), list):
+                    value = value["tool_calls"]
+                for item in value if isinstance(value, list) else [value]:
+                    if isinstance(item, dict) and isinstance(item.get("tool"), str) and item["tool"] in self.tools:
+                        tool_calls.append(item)
         
-        return None
+        if len(tool_calls) > TOOL_MAX_CALLS_PER_TURN:
+            logger.warning(f"Ignoring {len(tool_calls) - TOOL_MAX_CALLS_PER_TURN} tool calls over the per-turn limit")
+        return tool_calls[:TOOL_MAX_CALLS_PER_TURN]
+    
+    def _execute_tool(self, tool_call: Dict[str, Any]) -> Tuple[str, bool]:
+        """Run one tool call.
+        
+        Returns:
+            Tuple of (result or error message, whether the call failed)
+        """
+        tool_name = tool_call["tool"]
+        parameters = tool_call.get("parameters", {})
+        logger.info(f"Tool call detected: {tool_name} with parameters {parameters}")
+        try:
+            return str(self.tools[tool_name](**parameters)), False
+        except Exception as e:
+            error_message = f"Error executing tool {tool_name}: {str(e)}"
+            logger.error(error_message)
+            return error_message, True
+    
+    def _run_tools(self, tool_calls: List[Dict[str, Any]]) -> List[Tuple[str, bool]]:
+        """Run the tool calls of a model turn concurrently on the shared tool pool.
+        
+        Returns:
+            (result, failed) per call, in call order
+        """
+        # Single calls too, so TOOL_MAX_WORKERS bounds tool work across requests
+        return list(tool_executor.map(self._execute_tool, tool_calls))
+    
+    async def _arun_tools(self, tool_calls: List[Dict[str, Any]]) -> List[Tuple[str, bool]]:
+        """Async version of _run_tools; the event loop waits on the shared tool pool."""
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*(
+            loop.run_in_executor(tool_executor, self._execute_tool, tool_call) for tool_call in tool_calls
+        ))
+    
+    @staticmethod
+    def _describe_tool_calls(tool_calls: List[Dict[str, Any]]) -> str:
+        """Record of the tool calls for the conversation history."""
+        return "\n".join(
+            f"I'll use the {tool_call['tool']} tool with parameters: {json.dumps(tool_call.get('parameters', {}))}"
+            for tool_call in tool_calls
+        )
+    
+    @staticmethod
+    def _format_tool_results(tool_calls: List[Dict[str, Any]], results: List[Tuple[str, bool]]) -> str:
+        """Render every result of a model turn as one system message."""
+        if len(results) == 1:
+            return f"Tool result: {results[0][0]}"
+        return "Tool results:\n\n" + "\n\n".join(
+            f"[{i}] {tool_call['tool']}: {result}"
+            for i, (tool_call, (result, _)) in enumerate(zip(tool_calls, results), 1)
+        )
+    
+    def _stream_tools(self, tool_calls: List[Dict[str, Any]], results: List[Optional[Tuple[str, bool]]]):
+        """Run a turn's tool calls on the shared tool pool, yielding events as each one starts and finishes.
+        
+        Args:
+            tool_calls: The tool calls to run
+            results: Filled with (result, failed) per call, in call order
+        """
+        started = time.perf_counter()
+        futures = {}
+        for index, tool_call in enumerate(tool_calls):
+            futures[tool_executor.submit(self._execute_tool, tool_call)] = index
+            yield self._tool_start_event(index, tool_call)
+        for future in as_completed(futures):
+            index = futures[future]
+            results[index] = future.result()
+            yield self._tool_end_event(index, tool_calls[index], results[index], time.perf_counter() - started)
+    
+    async def _astream_tools(self, tool_calls: List[Dict[str, Any]], results: List[Optional[Tuple[str, bool]]]):
+        """Async version of _stream_tools."""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        
+        async def run(index: int, tool_call: Dict[str, Any]):
+            return index, await loop.run_in_executor(tool_executor, self._execute_tool, tool_call)
+        
+        tasks = []
+        for index, tool_call in enumerate(tool_calls):
+            tasks.append(asyncio.ensure_future(run(index, tool_call)))
+            yield self._tool_start_event(index, tool_call)
+        for next_done in asyncio.as_completed(tasks):
+            index, results[index] = await next_done
+            yield self._tool_end_event(index, tool_calls[index], results[index], time.perf_counter() - started)
+    
+    @staticmethod
+    def _tool_start_event(index: int, tool_call: Dict[str, Any]) -> Dict[str, Any]:
+        return {'type': 'tool_start', 'index': index, 'tool': tool_call['tool'],
+                'parameters': tool_call.get('parameters', {})}
+    
+    @staticmethod
+    def _tool_end_event(index: int, tool_call: Dict[str, Any], outcome: Tuple[str, bool], elapsed: float) -> Dict[str, Any]:
+        result, failed = outcome
+        if failed:
+            return {'type': 'tool_error', 'index': index, 'tool': tool_call['tool'], 'error': result,
+                    'elapsed_ms': round(elapsed * 1000), 'content': f"\n\n[{result}]\n\n"}
+        return {'type': 'tool_result', 'index': index, 'tool': tool_call['tool'],
+                'result': result[:TOOL_EVENT_RESULT_CHARS], 'elapsed_ms': round(elapsed * 1000),
+                'content': f"\n\n[Used {tool_call['tool']} tool]\n\n"}
+    
+    @staticmethod
+    def _new_usage() -> Dict[str, Any]:
+        return {'type': 'usage', 'llm_calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+    
+    def _record_usage(self, usage: Dict[str, Any], messages: List[Dict[str, str]], response: str):
+        """Add one LLM call to a usage event; tokens are counted locally, cached completions included."""
+        prompt_tokens = sum(self.llm._count_message_tokens(message) for message in messages)
+        completion_tokens = self.llm._count_tokens(response)
+        usage['llm_calls'] += 1
+        usage['prompt_tokens'] += prompt_tokens
+        usage['completion_tokens'] += completion_tokens
+        usage['total_tokens'] += prompt_tokens + completion_tokens
+    
+    @staticmethod
+    def _answer_is_cacheable(tool_calls: List[Dict[str, Any]], results: List[Tuple[str, bool]]) -> bool:
+        """Whether an answer built on these tool results may go into the semantic cache."""
+        return all(tool_call["tool"] in SEMANTIC_CACHE_TOOLS and not failed
+                   for tool_call, (_, failed) in zip(tool_calls, results))
+    
+    def _tool_call_detector(self, iterations: int) -> ToolCallDetector:
+        """Detector for a streamed response; past the tool iteration limit everything is passed through."""
+        if iterations >= self.max_tool_iterations:
+            return ToolCallDetector()
+        return ToolCallDetector(self._extract_tool_calls)
     
-    def get_last_user_message(self) -> Optional[str]:
+    def _tool_messages(self, session: ConversationSession, context: Optional[Dict[str, Any]],
+                       iterations: int) -> List[Dict[str, str]]:
+        """Messages for the follow-up call after a round of tools, closing the loop at the iteration limit."""
+        messages = self._build_messages(session, context)
+        if iterations >= self.max_tool_iterations:
+            messages.append({"role": "system", "content": TOOL_LIMIT_NOTICE})
+        return messages
+    
+    def get_last_user_message(self, session: Optional[ConversationSession] = None) -> Optional[str]:
         """Get the last user message from conversation history."""
-        for message in reversed(self.conversation_history):
+        session = session or self.session
+        for message in reversed(session.history):
             if message["role"] == "user":
                 return message["content"]
         return None
     
-    def regenerate_last_response(self) -> str:
-        """Regenerate the last assistant response by removing it and re-processing the last user message."""
+    def _remember_answer(self, question: str, answer: str, kb_version: int):
+        """Store the answer to a standalone question in the semantic cache, unless it is an error.
+        
+        Args:
+            question: The user message
+            answer: The final answer
+            kb_version: Knowledge base version when the message arrived; writes
+                made since then mean the answer may be stale, so it is not stored
+        """
+        if not answer or answer.startswith("Error generating response") or "[Error:" in answer:
+            return
+        if kb_version != self.rag.version:
+            return
+        semantic_cache.store(question, answer, self.llm.model, kb_version)
+    
+    def _prepare_regeneration(self, session: ConversationSession) -> Optional[str]:
+        """Drop the last response from the history and return the user message to answer again."""
         # Remove the last assistant message(s) and any tool-related messages
-        while (self.conversation_history and 
-               self.conversation_history[-1]["role"] in ["assistant", "system"]):
-            self.conversation_history.pop()
+        while (session.history and 
+               session.history[-1]["role"] in ["assistant", "system"]):
+            session.pop_message()
         
         # Get the last user message
-        last_user_message = self.get_last_user_message()
+        return self.get_last_user_message(session)
+    
+    def regenerate_last_response(self, session: Optional[ConversationSession] = None) -> str:
+        """Regenerate the last assistant response by removing it and re-processing the last user message."""
+        session = session or self.session
+        last_user_message = self._prepare_regeneration(session)
         if not last_user_message:
             return "No previous user message found to regenerate response for."
         
         # Process the message again (this will add new messages to history)
-        return self.process_message(last_user_message, is_regeneration=True)
+        return self.process_message(last_user_message, is_regeneration=True, session=session)
     
-    def regenerate_last_response_stream(self):
+    def regenerate_last_response_stream(self, session: Optional[ConversationSession] = None):
         """Regenerate the last assistant response with streaming."""
-        # Remove the last assistant message(s) and any tool-related messages
-        while (self.conversation_history and 
-               self.conversation_history[-1]["role"] in ["assistant", "system"]):
-            self.conversation_history.pop()
-        
-        # Get the last user message
-        last_user_message = self.get_last_user_message()
+        return event_text(self.regenerate_last_response_events(session))
+    
+    def regenerate_last_response_events(self, session: Optional[ConversationSession] = None):
+        """Regenerate the last assistant response as a stream of typed events (see process_message_events)."""
+        session = session or self.session
+        last_user_message = self._prepare_regeneration(session)
         if not last_user_message:
-            def error_generator():
-                yield "No previous user message found to regenerate response for."
-            return error_generator()
+            return iter([
+                {'type': 'token', 'content': "No previous user message found to regenerate response for."},
+                {'type': 'done'}
+            ])
         
         # Process the message again with streaming
-        return self.process_message_stream(last_user_message, is_regeneration=True)
+        return self.process_message_events(last_user_message, is_regeneration=True, session=session)
     
-    def process_message(self, user_message: str, is_regeneration: bool = False) -> str:
+    def process_message(self, user_message: str, is_regeneration: bool = False,
+                        session: Optional[ConversationSession] = None, use_cache: bool = True,
+                        context_filter: Optional[Dict[str, Any]] = None) -> str:
         """Process a user message and generate a response, potentially using tools.
         
         Args:
             user_message: The message from the user
             is_regeneration: Whether this is a regeneration of a previous response
+            session: Conversation session to use (defaults to the agent's own session)
+            use_cache: Whether LLM calls may be answered from the completion cache
+            context_filter: Metadata filter for documents the message is about,
+                such as an uploaded file; their best chunks are always retrieved
             
         Returns:
             The agent's response
         """
+        session = session or self.session
+        # Regenerating must produce a new answer, so skip cache lookups
+        use_cache = use_cache and not is_regeneration
+        
         # Only add user message to conversation history if it's not a regeneration
         if not is_regeneration:
-            self.conversation_history.append({"role": "user", "content": user_message})
+            session.append_message("user", user_message)
         
-        # Construct messages for the LLM
-        messages = [{"role": "system", "content": self.system_prompt + "\n\nAvailable Tools:\n" + self.get_tools_description()}]
-        messages.extend(self.conversation_history)
+        # Standalone questions can be answered from, and added to, the semantic cache;
+        # answers about specific documents depend on them, so they are not cached
+        standalone = len(session.history) == 1 and context_filter is None
+        kb_version = self.rag.version
+        if use_cache and standalone:
+            cached_answer = semantic_cache.lookup(user_message, self.llm.model, kb_version)
+            if cached_answer is not None:
+                session.append_message("assistant", cached_answer)
+                return cached_answer
         
-        # Get initial response from LLM
-        response = self.llm.generate(messages)
+        # Retrieve knowledge only once the semantic cache has missed; the query
+        # embedding computed for the lookup is reused from the embedding cache
+        retrieval = self._start_retrieval(user_message, context_filter)
+        
+        # Construct messages for the LLM, with the retrieved context if it is relevant
+        context = self._wait_for_context(retrieval, DOCUMENT_CONTEXT_TIMEOUT if context_filter else AUTO_RAG_TIMEOUT)
+        messages = self._build_messages(session, context)
         
-        # Check if response contains a tool call
-        tool_call = self._extract_tool_call(response)
+        # Get initial response from LLM
+        response = self.llm.generate(messages, use_cache=use_cache)
         
-        if tool_call:
-            tool_name = tool_call["tool"]
-            parameters = tool_call.get("parameters", {})
+        # Run the requested tools, all of a turn's calls at once, until the model answers
+        cacheable = True
+        iterations = 0
+        tool_calls = self._extract_tool_calls(response)
+        while tool_calls and iterations < self.max_tool_iterations:
+            iterations += 1
+            results = self._run_tools(tool_calls)
+            cacheable = cacheable and self._answer_is_cacheable(tool_calls, results)
             
-            logger.info(f"Tool call detected: {tool_name} with parameters {parameters}")
+            # Add tool calls and results to conversation history
+            session.append_message("assistant", self._describe_tool_calls(tool_calls))
+            session.append_message("system", self._format_tool_results(tool_calls, results))
             
-            # Execute the tool
-            try:
-                tool_result = self.tools[tool_name](**parameters)
-                
-                # Add tool call and result to conversation history
-                self.conversation_history.append({"role": "assistant", "content": f"I'll use the {tool_name} tool with parameters: {json.dumps(parameters)}"})
-                self.conversation_history.append({"role": "system", "content": f"Tool result: {tool_result}"})
-                
-                # Get final response from LLM that incorporates tool result
-                messages = [{"role": "system", "content": self.system_prompt + "\n\nAvailable Tools:\n" + self.get_tools_description()}]
-                messages.extend(self.conversation_history)
-                
-                final_response = self.llm.generate(messages)
-                self.conversation_history.append({"role": "assistant", "content": final_response})
-                return final_response
-                
-            except Exception as e:
-                error_message = f"Error executing tool {tool_name}: {str(e)}"
-                logger.error(error_message)
-                self.conversation_history.append({"role": "system", "content": error_message})
-                
-                # Generate response that acknowledges the error
-                error_response = self.llm.generate([
-                    {"role": "system", "content": self.system_prompt},
-                    {"role": "user", "content": user_message},
-                    {"role": "assistant", "content": response},
-                    {"role": "system", "content": error_message}
-                ])
-                
-                self.conversation_history.append({"role": "assistant", "content": error_response})
-                return error_response
-        else:
-            # No tool call, just add response to history and return
-            self.conversation_history.append({"role": "assistant", "content": response})
-            return response
+            # Get the next response from LLM, with every result of this round
+            messages = self._tool_messages(session, context, iterations)
+            response = self.llm.generate(messages, use_cache=use_cache)
+            tool_calls = self._extract_tool_calls(response)
+        
+        session.append_message("assistant", response)
+        if standalone and cacheable:
+            self._remember_answer(user_message, response, kb_version)
+        return response
         
-    def process_message_stream(self, user_message: str, is_regeneration: bool = False):
+    def process_message_stream(self, user_message: str, is_regeneration: bool = False,
+                               session: Optional[ConversationSession] = None, use_cache: bool = True,
+                               context_filter: Optional[Dict[str, Any]] = None):
         """Process a user message and generate a streaming response.
         
         Args:
             user_message: The message from the user
             is_regeneration: Whether this is a regeneration of a previous response
+            session: Conversation session to use (defaults to the agent's own session)
+            use_cache: Whether LLM calls may be answered from the completion cache
+            context_filter: Metadata filter for documents the message is about
+            
+        Yields:
+            Chunks of the agent's response, with a short notice for each tool used
+        """
+        return event_text(self.process_message_events(user_message, is_regeneration, session, use_cache,
+                                                      context_filter))
+    
+    def process_message_events(self, user_message: str, is_regeneration: bool = False,
+                               session: Optional[ConversationSession] = None, use_cache: bool = True,
+                               context_filter: Optional[Dict[str, Any]] = None):
+        """Process a user message and generate a stream of typed events.
+        
+        Each event is a dictionary with a "type":
+            token: text of the answer, in "content"
+            tool_start: a tool call was started ("index", "tool", "parameters")
+            tool_result: a tool call finished ("index", "tool", "result", "elapsed_ms")
+            tool_error: a tool call failed ("index", "tool", "error", "elapsed_ms")
+            usage: LLM calls and tokens used for the message
+            done: the response is complete
+        Tool results and errors also carry a short notice in "content" for
+        clients that only render text.
+        
+        Args:
+            user_message: The message from the user
+            is_regeneration: Whether this is a regeneration of a previous response
+            session: Conversation session to use (defaults to the agent's own session)
+            use_cache: Whether LLM calls may be answered from the completion cache
+            context_filter: Metadata filter for documents the message is about
+                (see process_message)
             
         Yields:
-            Chunks of the agent's response
+            Event dictionaries, as they happen
         """
+        session = session or self.session
+        # Regenerating must produce a new answer, so skip cache lookups
+        use_cache = use_cache and not is_regeneration
+        usage = self._new_usage()
+        
         # Only add user message to conversation history if it's not a regeneration
         if not is_regeneration:
-            self.conversation_history.append({"role": "user", "content": user_message})
+            session.append_message("user", user_message)
+        
+        # Standalone questions can be answered from, and added to, the semantic cache;
+        # answers about specific documents depend on them, so they are not cached
+        standalone = len(session.history) == 1 and context_filter is None
+        kb_version = self.rag.version
+        if use_cache and standalone:
+            cached_answer = semantic_cache.lookup(user_message, self.llm.model, kb_version)
+            if cached_answer is not None:
+                for chunk in split_cached_response(cached_answer):
+                    yield {'type': 'token', 'content': chunk}
+                session.append_message("assistant", cached_answer)
+                yield usage
+                yield {'type': 'done'}
+                return
+        
+        # Retrieve knowledge only once the semantic cache has missed; the query
+        # embedding computed for the lookup is reused from the embedding cache
+        retrieval = self._start_retrieval(user_message, context_filter)
+        
+        # Construct messages for the LLM, with the retrieved context if it is relevant
+        context = self._wait_for_context(retrieval, DOCUMENT_CONTEXT_TIMEOUT if context_filter else AUTO_RAG_TIMEOUT)
+        messages = self._build_messages(session, context)
+        
+        cacheable = True
+        iterations = 0
+        while True:
+            # Get streaming response from LLM
+            response_generator = self.llm.generate(messages, stream=True, use_cache=use_cache)
+            
+            # Watch the stream for a tool call; its JSON is not forwarded, and generation
+            # stops as soon as it is complete so the tools can start right away
+            detector = self._tool_call_detector(iterations)
+            try:
+                for chunk in response_generator:
+                    if chunk:
+                        text = detector.feed(chunk)
+                        if text:
+                            yield {'type': 'token', 'content': text}
+                        if detector.tool_calls:
+                            break
+            finally:
+                if hasattr(response_generator, 'close'):
+                    response_generator.close()
+            text = detector.finish()
+            if text:
+                yield {'type': 'token', 'content': text}
+            full_response = detector.response
+            self._record_usage(usage, messages, full_response)
+            
+            # Tool calls the detector missed are still picked up from the complete response
+            if iterations >= self.max_tool_iterations:
+                break
+            tool_calls = detector.tool_calls or self._extract_tool_calls(full_response)
+            if not tool_calls:
+                break
+            
+            iterations += 1
+            results = [None] * len(tool_calls)
+            yield from self._stream_tools(tool_calls, results)
+            cacheable = cacheable and self._answer_is_cacheable(tool_calls, results)
+            
+            # Add tool calls and results to conversation history
+            session.append_message("assistant", full_response)
+            session.append_message("system", self._format_tool_results(tool_calls, results))
+            
+            messages = self._tool_messages(session, context, iterations)
+        
+        session.append_message("assistant", full_response)
+        if standalone and cacheable:
+            self._remember_answer(user_message, full_response, kb_version)
+        yield usage
+        yield {'type': 'done'}
+    
+    async def aregenerate_last_response(self, session: Optional[ConversationSession] = None) -> str:
+        """Async version of regenerate_last_response."""
+        session = session or self.session
+        last_user_message = self._prepare_regeneration(session)
+        if not last_user_message:
+            return "No previous user message found to regenerate response for."
+        
+        return await self.aprocess_message(last_user_message, is_regeneration=True, session=session)
+    
+    def aregenerate_last_response_stream(self, session: Optional[ConversationSession] = None):
+        """Async version of regenerate_last_response_stream."""
+        return aevent_text(self.aregenerate_last_response_events(session))
+    
+    def aregenerate_last_response_events(self, session: Optional[ConversationSession] = None):
+        """Async version of regenerate_last_response_events."""
+        session = session or self.session
+        last_user_message = self._prepare_regeneration(session)
+        if not last_user_message:
+            async def error_generator():
+                yield {'type': 'token', 'content': "No previous user message found to regenerate response for."}
+                yield {'type': 'done'}
+            return error_generator()
+        
+        return self.aprocess_message_events(last_user_message, is_regeneration=True, session=session)
+    
+    async def aprocess_message(self, user_message: str, is_regeneration: bool = False,
+                               session: Optional[ConversationSession] = None, use_cache: bool = True,
+                               context_filter: Optional[Dict[str, Any]] = None) -> str:
+        """Async version of process_message.
+        
+        LLM calls go through the async client and tools run in a worker thread,
+        so the event loop is never blocked.
+        """
+        session = session or self.session
+        # Regenerating must produce a new answer, so skip cache lookups
+        use_cache = use_cache and not is_regeneration
+        
+        if not is_regeneration:
+            session.append_message("user", user_message)
         
-        # Construct messages for the LLM
-        messages = [{"role": "system", "content": self.system_prompt + "\n\nAvailable Tools:\n" + self.get_tools_description()}]
-        messages.extend(self.conversation_history)
+        standalone = len(session.history) == 1 and context_filter is None
+        kb_version = self.rag.version
+        if use_cache and standalone:
+            cached_answer = await asyncio.to_thread(semantic_cache.lookup, user_message, self.llm.model, kb_version)
+            if cached_answer is not None:
+                session.append_message("assistant", cached_answer)
+                return cached_answer
         
-        # Get streaming response from LLM
-        response_generator = self.llm.generate(messages, stream=True)
+        retrieval = self._astart_retrieval(user_message, context_filter)
+        context = await self._await_context(retrieval, DOCUMENT_CONTEXT_TIMEOUT if context_filter else AUTO_RAG_TIMEOUT)
+        messages = self._build_messages(session, context)
+        response = await self.llm.agenerate(messages, use_cache=use_cache)
         
-        full_response = ""
-        for chunk in response_generator:
-            if chunk:
-                full_response += chunk
-                yield chunk
+        cacheable = True
+        iterations = 0
+        tool_calls = self._extract_tool_calls(response)
+        while tool_calls and iterations < self.max_tool_iterations:
+            iterations += 1
+            results = await self._arun_tools(tool_calls)
+            cacheable = cacheable and self._answer_is_cacheable(tool_calls, results)
+            
+            session.append_message("assistant", self._describe_tool_calls(tool_calls))
+            session.append_message("system", self._format_tool_results(tool_calls, results))
+            
+            messages = self._tool_messages(session, context, iterations)
+            response = await self.llm.agenerate(messages, use_cache=use_cache)
+            tool_calls = self._extract_tool_calls(response)
         
-        # Check if the complete response contains a tool call
-        tool_call = self._extract_tool_call(full_response)
+        session.append_message("assistant", response)
+        if standalone and cacheable:
+            await asyncio.to_thread(self._remember_answer, user_message, response, kb_version)
+        return response
+    
+    def aprocess_message_stream(self, user_message: str, is_regeneration: bool = False,
+                                session: Optional[ConversationSession] = None, use_cache: bool = True,
+                                context_filter: Optional[Dict[str, Any]] = None):
+        """Async version of process_message_stream.
         
-        if tool_call:
-            tool_name = tool_call["tool"]
-            parameters = tool_call.get("parameters", {})
+        Args:
+            user_message: The message from the user
+            is_regeneration: Whether this is a regeneration of a previous response
+            session: Conversation session to use (defaults to the agent's own session)
+            use_cache: Whether LLM calls may be answered from the completion cache
+            context_filter: Metadata filter for documents the message is about
             
-            logger.info(f"Tool call detected: {tool_name} with parameters {parameters}")
+        Yields:
+            Chunks of the agent's response, with a short notice for each tool used
+        """
+        return aevent_text(self.aprocess_message_events(user_message, is_regeneration, session, use_cache,
+                                                       context_filter))
+    
+    async def aprocess_message_events(self, user_message: str, is_regeneration: bool = False,
+                                      session: Optional[ConversationSession] = None, use_cache: bool = True,
+                                      context_filter: Optional[Dict[str, Any]] = None):
+        """Async version of process_message_events."""
+        session = session or self.session
+        # Regenerating must produce a new answer, so skip cache lookups
+        use_cache = use_cache and not is_regeneration
+        usage = self._new_usage()
+        
+        if not is_regeneration:
+            session.append_message("user", user_message)
+        
+        standalone = len(session.history) == 1 and context_filter is None
+        kb_version = self.rag.version
+        if use_cache and standalone:
+            cached_answer = await asyncio.to_thread(semantic_cache.lookup, user_message, self.llm.model, kb_version)
+            if cached_answer is not None:
+                for chunk in split_cached_response(cached_answer):
+                    yield {'type': 'token', 'content': chunk}
+                session.append_message("assistant", cached_answer)
+                yield usage
+                yield {'type': 'done'}
+                return
+        
+        retrieval = self._astart_retrieval(user_message, context_filter)
+        context = await self._await_context(retrieval, DOCUMENT_CONTEXT_TIMEOUT if context_filter else AUTO_RAG_TIMEOUT)
+        messages = self._build_messages(session, context)
+        cacheable = True
+        iterations = 0
+        while True:
+            response_generator = await self.llm.agenerate(messages, stream=True, use_cache=use_cache)
             
+            detector = self._tool_call_detector(iterations)
             try:
-                # Execute the tool
-                tool_result = self.tools[tool_name](**parameters)
-                
-                # Add tool call and result to conversation history
-                self.conversation_history.append({"role": "assistant", "content": full_response})
-                self.conversation_history.append({"role": "system", "content": f"Tool result: {tool_result}"})
-                
-                # Stream a message about tool usage
-                tool_message = f"\n\n[Used {tool_name} tool]\n\n"
-                for char in tool_message:
-                    yield char
-                    time.sleep(0.01)  # Small delay for visual effect
-                
-                # Get final streaming response that incorporates tool result
-                messages = [{"role": "system", "content": self.system_prompt + "\n\nAvailable Tools:\n" + self.get_tools_description()}]
-                messages.extend(self.conversation_history)
-                
-                final_response_generator = self.llm.generate(messages, stream=True)
-                final_response = ""
-                
-                for chunk in final_response_generator:
+                async for chunk in response_generator:
                     if chunk:
-                        final_response += chunk
-                        yield chunk
-                
-                self.conversation_history.append({"role": "assistant", "content": final_response})
-                
-            except Exception as e:
-                error_message = f"\n\n[Error executing tool {tool_name}: {str(e)}]"
-                for char in error_message:
-                    yield char
-                    time.sleep(0.01)
-        else:
-            # No tool call, just add response to history
-            self.conversation_history.append({"role": "assistant", "content": full_response})
-
+                        text = detector.feed(chunk)
+                        if text:
+                            yield {'type': 'token', 'content': text}
+                        if detector.tool_calls:
+                            break
+            finally:
+                await response_generator.aclose()
+            text = detector.finish()
+            if text:
+                yield {'type': 'token', 'content': text}
+            full_response = detector.response
+            self._record_usage(usage, messages, full_response)
+            
+            if iterations >= self.max_tool_iterations:
+                break
+            tool_calls = detector.tool_calls or self._extract_tool_calls(full_response)
+            if not tool_calls:
+                break
+            
+            iterations += 1
+            results = [None] * len(tool_calls)
+            async for event in self._astream_tools(tool_calls, results):
+                yield event
+            cacheable = cacheable and self._answer_is_cacheable(tool_calls, results)
+            
+            session.append_message("assistant", full_response)
+            session.append_message("system", self._format_tool_results(tool_calls, results))
+            
+            messages = self._tool_messages(session, context, iterations)
+        
+        session.append_message("assistant", full_response)
+        if standalone and cacheable:
+            await asyncio.to_thread(self._remember_answer, user_message, full_response, kb_version)
+        yield usage
+        yield {'type': 'done'}
 
 # Initialize the LLM and agent
 api_key = os.environ.get("OPENROUTER_API_KEY")
@@ -1052,18 +3840,88 @@ llm = OpenRouterLLM(
     api_key=current_settings.get('apiKey') or os.environ.get("OPENROUTER_API_KEY"),
     model=current_settings.get('model', "deepseek/deepseek-r1:free")
 )
-agent = Agent(llm=llm)
-
-# Add some initial knowledge
-agent.rag.add_documents([
-    "Python is a high-level, interpreted programming language known for its readability and versatility.",
-    "RAG (Retrieval-Augmented Generation) is a technique that enhances LLM outputs by retrieving relevant information from a knowledge base.",
-    "AI agents are systems that can perceive their environment, make decisions, and take actions to achieve specific goals."
-], metadatas=[
-    {"source": "initial_knowledge", "topic": "programming"},
-    {"source": "initial_knowledge", "topic": "ai_techniques"},
-    {"source": "initial_knowledge", "topic": "ai_systems"}
-])
+agent = Agent(llm=llm, context_budget=current_settings.get('contextBudget', CONTEXT_INPUT_BUDGET),
+              auto_rag=current_settings.get('autoRag', AUTO_RAG_ENABLED),
+              max_tool_iterations=current_settings.get('maxToolIterations', MAX_TOOL_ITERATIONS))
+
+# Conversation sessions live outside the agent so they survive settings changes
+session_store = SessionStore()
+
+# Semantic answer cache, shared across agents and embedded like the knowledge base
+semantic_cache = SemanticCache(embedding_function=agent.rag.embedding_function)
+
+def cleanup_sessions():
+    """Periodically evict idle conversation sessions."""
+    while True:
+        session_store.cleanup_expired_sessions()
+        time.sleep(60)  # Run every minute
+
+# Start session cleanup thread
+session_cleanup_thread = threading.Thread(target=cleanup_sessions, daemon=True)
+session_cleanup_thread.start()
+
+def seed_knowledge():
+    """Add some initial knowledge, once: a persistent knowledge base keeps it across restarts.
+
+    Called on server startup rather than on import, so importing this module
+    embeds nothing.
+    """
+    if not agent.rag.has_documents({"source": "initial_knowledge"}):
+        agent.rag.add_documents([
+            "Python is a high-level, interpreted programming language known for its readability and versatility.",
+            "RAG (Retrieval-Augmented Generation) is a technique that enhances LLM outputs by retrieving relevant information from a knowledge base.",
+            "AI agents are systems that can perceive their environment, make decisions, and take actions to achieve specific goals."
+        ], metadatas=[
+            {"source": "initial_knowledge", "topic": "programming"},
+            {"source": "initial_knowledge", "topic": "ai_techniques"},
+            {"source": "initial_knowledge", "topic": "ai_systems"}
+        ])
+
+def get_request_session_id(data: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """Get the session id from the request body, form data or X-Session-Id header.
+
+    Raises:
+        ValueError: If the session id is malformed
+    """
+    session_id = (data or {}).get('session_id') or request.form.get('session_id') or request.headers.get('X-Session-Id')
+    return validate_session_id(session_id)
+
+def validate_session_id(session_id: Optional[str]) -> Optional[str]:
+    """Check that a client-supplied session id is well formed.
+
+    Raises:
+        ValueError: If the session id is malformed
+    """
+    if session_id is not None and not re.fullmatch(r'[A-Za-z0-9_\-]{1,128}', str(session_id)):
+        raise ValueError("Invalid session id")
+    return session_id
+
+def acquire_session(session_id: Optional[str]) -> Optional[ConversationSession]:
+    """Get a session and lock it for the duration of a request.
+
+    Returns:
+        The locked session, or None if it stayed busy for SESSION_LOCK_TIMEOUT seconds
+    """
+    session = session_store.get_or_create(session_id)
+    if not session.lock.acquire(timeout=SESSION_LOCK_TIMEOUT):
+        return None
+    return session
+
+def release_session(session: ConversationSession):
+    """Unlock a session at the end of a request."""
+    session.lock.release()
+    session_store.release(session)
+
+# Totals over finished chat streams, shared with the ASGI entry point
+stream_metrics = StreamMetrics()
+
+def open_sse_stream() -> SSEStream:
+    """Output stage for one SSE response, with the configured coalescing."""
+    return SSEStream(window=SSE_COALESCE_WINDOW, max_chars=SSE_COALESCE_CHARS)
+
+def session_busy_response(session_id: Optional[str]):
+    """Response for a session that is still handling another request."""
+    return jsonify({'error': 'Session is busy with another request', 'session_id': session_id}), 409
 
 @app.route('/chat', methods=['POST'])
 def chat():
@@ -1078,13 +3936,17 @@ def chat():
         
         message = data['message']
         should_stream = data.get('stream', False)
-        logger.info(f"Received message: {message}, streaming: {should_stream}")
+        use_cache = data.get('cache', True)
+        try:
+            session_id = get_request_session_id(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        logger.info(f"Received message: {message}, streaming: {should_stream}, session: {session_id}")
         
         # Log token usage
         if current_settings.get('debugMode', False):
             try:
-                encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-                tokens = len(encoding.encode(message))
+                tokens = token_counter.count(message)
                 debug_log.metrics['total_tokens'] += tokens
                 debug_log.add_log('token_usage', {
                     'request_id': request_id,
@@ -1094,28 +3956,28 @@ def chat():
             except Exception as e:
                 logger.error(f"Error counting tokens: {e}")
         
+        session = acquire_session(session_id)
+        if session is None:
+            return session_busy_response(session_id)
+        
         if should_stream:
             def generate_stream():
+                stream = open_sse_stream()
                 try:
-                    response_chunks = []
-                    
-                    for chunk in agent.process_message_stream(message):
-                        if chunk:
-                            response_chunks.append(chunk)
-                            chunk_data = {'content': chunk}
-                            sse_data = f"data: {json.dumps(chunk_data)}\n\n"
-                            logger.debug(f"Sending SSE chunk: {repr(chunk)}")
-                            yield sse_data
+                    # Typed events (token, tool_start, tool_result, tool_error, usage, done),
+                    # with runs of tokens coalesced into one frame
+                    events = agent.process_message_events(message, session=session, use_cache=use_cache)
+                    yield from stream.frames_for(events)
+                    yield stream.finish()
                     
                     # Log successful completion
                     if current_settings.get('debugMode', False):
                         debug_log.add_log('stream_complete', {
                             'request_id': request_id,
-                            'chunks': len(response_chunks)
+                            'response_length': len(stream.text),
+                            **stream.get_stats()
                         })
                     
-                    yield "data: [DONE]\n\n"
-                    
                 except Exception as e:
                     logger.error(f"Error in streaming: {e}")
                     if current_settings.get('debugMode', False):
@@ -1125,10 +3987,9 @@ def chat():
                             'error': str(e),
                             'type': 'streaming_error'
                         })
-                    error_data = {'error': str(e)}
-                    yield f"data: {json.dumps(error_data)}\n\n"
-                    yield "data: [DONE]\n\n"
+                    yield stream.finish({'type': 'error', 'error': str(e)})
                 finally:
+                    stream_metrics.record(stream)
                     logger.debug("Streaming completed")
             
             response = Response(
@@ -1138,14 +3999,21 @@ def chat():
                     'Cache-Control': 'no-cache',
                     'Connection': 'keep-alive',
                     'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type',
+                    'Access-Control-Allow-Headers': 'Content-Type, X-Session-Id',
+                    'Access-Control-Expose-Headers': 'X-Session-Id',
+                    'X-Session-Id': session.session_id,
                     'X-Accel-Buffering': 'no'
                 }
             )
+            # Keep the session locked until the stream has been fully sent or aborted
+            response.call_on_close(lambda: release_session(session))
             return debug_response(request_id, start_time, response)
         else:
             # Non-streaming response
-            response = agent.process_message(message)
+            try:
+                response = agent.process_message(message, session=session, use_cache=use_cache)
+            finally:
+                release_session(session)
             logger.info(f"Agent response: {response}")
             
             # Log successful completion
@@ -1155,7 +4023,7 @@ def chat():
                     'response_length': len(response)
                 })
             
-            return debug_response(request_id, start_time, jsonify({'response': response}))
+            return debug_response(request_id, start_time, jsonify({'response': response, 'session_id': session.session_id}))
             
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
@@ -1174,49 +4042,53 @@ def regenerate():
     try:
         data = request.json
         should_stream = data.get('stream', False) if data else False
-        logger.info(f"Regenerating last response, streaming: {should_stream}")
+        try:
+            session_id = get_request_session_id(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        logger.info(f"Regenerating last response, streaming: {should_stream}, session: {session_id}")
+        
+        session = acquire_session(session_id)
+        if session is None:
+            return session_busy_response(session_id)
         
         if should_stream:
             def generate_stream():
+                stream = open_sse_stream()
                 try:
-                    response_chunks = []
-                    
-                    for chunk in agent.regenerate_last_response_stream():
-                        if chunk:  # Only send non-empty chunks
-                            response_chunks.append(chunk)
-                            chunk_data = {'content': chunk}
-                            sse_data = f"data: {json.dumps(chunk_data)}\n\n"
-                            logger.debug(f"Sending regenerate SSE chunk: {repr(chunk)}")
-                            yield sse_data
-                    
-                    # Send completion signal
-                    logger.debug("Sending [DONE] signal for regeneration")
-                    yield "data: [DONE]\n\n"
+                    yield from stream.frames_for(agent.regenerate_last_response_events(session=session))
+                    yield stream.finish()
                     
                 except Exception as e:
                     logger.error(f"Error in regeneration streaming: {e}")
-                    error_data = {'error': str(e)}
-                    yield f"data: {json.dumps(error_data)}\n\n"
-                    yield "data: [DONE]\n\n"
+                    yield stream.finish({'type': 'error', 'error': str(e)})
                 finally:
+                    stream_metrics.record(stream)
                     logger.debug("Regeneration streaming completed")
             
-            return Response(
+            response = Response(
                 generate_stream(),
                 content_type='text/event-stream',
                 headers={
                     'Cache-Control': 'no-cache',
                     'Connection': 'keep-alive',
                     'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type',
+                    'Access-Control-Allow-Headers': 'Content-Type, X-Session-Id',
+                    'Access-Control-Expose-Headers': 'X-Session-Id',
+                    'X-Session-Id': session.session_id,
                     'X-Accel-Buffering': 'no'
                 }
             )
+            response.call_on_close(lambda: release_session(session))
+            return response
         else:
             # Non-streaming regeneration
-            response = agent.regenerate_last_response()
+            try:
+                response = agent.regenerate_last_response(session=session)
+            finally:
+                release_session(session)
             logger.info(f"Regenerated response: {response}")
-            return jsonify({'response': response})
+            return jsonify({'response': response, 'session_id': session.session_id})
             
     except Exception as e:
         logger.error(f"Error regenerating response: {str(e)}")
@@ -1240,9 +4112,128 @@ def capabilities():
         }
     })
 
+def validate_where(where: Dict[str, Any]):
+    """Check that a client-supplied where filter only uses operators ChromaDB supports.
+
+    Raises:
+        ValueError: If the filter is malformed
+    """
+    if not isinstance(where, dict) or not where:
+        raise ValueError("where must be a non-empty object")
+    for key, condition in where.items():
+        if key in ("$and", "$or"):
+            if not isinstance(condition, list) or not condition:
+                raise ValueError(f"{key} must be a non-empty list of filters")
+            for part in condition:
+                validate_where(part)
+        elif key.startswith('$'):
+            raise ValueError(f"Unknown where operator {key}")
+        elif isinstance(condition, dict):
+            if len(condition) != 1:
+                raise ValueError(f"Filter on {key} must have exactly one operator")
+            operator, value = next(iter(condition.items()))
+            if operator not in WHERE_FIELD_OPERATORS:
+                raise ValueError(f"Unknown operator {operator} on {key}; expected one of {', '.join(WHERE_FIELD_OPERATORS)}")
+            if operator in ("$in", "$nin"):
+                if not isinstance(value, list) or not value or not all(isinstance(v, (str, int, float, bool)) for v in value):
+                    raise ValueError(f"{operator} on {key} needs a non-empty list of strings, numbers or booleans")
+            elif operator in ("$gt", "$gte", "$lt", "$lte"):
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    raise ValueError(f"{operator} on {key} needs a number")
+            elif not isinstance(value, (str, int, float, bool)):
+                raise ValueError(f"{operator} on {key} needs a string, number or boolean")
+        elif not isinstance(condition, (str, int, float, bool)):
+            raise ValueError(f"Filter on {key} must be a string, number, boolean or operator object")
+
+@app.route('/knowledge/search', methods=['POST'])
+@limiter.limit(KNOWLEDGE_SEARCH_RATE_LIMIT)
+def knowledge_search():
+    """Search the knowledge base directly, without an LLM round trip."""
+    try:
+        data = request.json or {}
+        queries = data.get('queries')
+        if queries is None and 'query' in data:
+            queries = [data['query']]
+        if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q.strip() for q in queries):
+            return jsonify({'error': 'queries must be a non-empty list of strings'}), 400
+        if len(queries) > KNOWLEDGE_SEARCH_MAX_QUERIES:
+            return jsonify({'error': f'At most {KNOWLEDGE_SEARCH_MAX_QUERIES} queries per request'}), 400
+        
+        n_results = data.get('n_results', 3)
+        if not isinstance(n_results, int) or isinstance(n_results, bool) or not 1 <= n_results <= KNOWLEDGE_SEARCH_MAX_RESULTS:
+            return jsonify({'error': f'n_results must be an integer between 1 and {KNOWLEDGE_SEARCH_MAX_RESULTS}'}), 400
+        
+        where = data.get('where')
+        if where is not None:
+            try:
+                validate_where(where)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        
+        mode = data.get('mode', RETRIEVAL_MODE)
+        if mode not in RETRIEVAL_MODES:
+            return jsonify({'error': f'mode must be one of {", ".join(RETRIEVAL_MODES)}'}), 400
+        
+        # Documents queued by tools are only visible once embedded; flush to wait for them
+        if data.get('flush', False):
+            ingestion_queue.flush()
+        
+        try:
+            results = agent.rag.query_many(queries, n_results=n_results, where=where, mode=mode)
+        except ValueError as e:
+            # ChromaDB's Python-side filter checks raise ValueError; malformed
+            # operators are rejected earlier by validate_where
+            return jsonify({'error': str(e)}), 400
+        return jsonify({
+            'results': [
+                {'query': query, 'matches': matches}
+                for query, matches in zip(queries, results)
+            ]
+        })
+    except Exception as e:
+        logger.error(f"Error searching knowledge base: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def upload_path(filename: str) -> str:
+    """Where to save an upload; a unique name keeps concurrent uploads of the same file apart."""
+    return os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4().hex}_{filename}")
+
+def upload_message(filename: str, question: Optional[str]) -> str:
+    """The user message for a question about an uploaded file (a summary by default)."""
+    question = (question or '').strip() or f"Summarize the uploaded file {filename}."
+    return f"[Uploaded file: {filename}] {question}"
+
+def ingest_upload(filepath: str, filename: str, extension: str) -> Tuple[str, Dict[str, int]]:
+    """Stream an uploaded file into the knowledge base in batches.
+    
+    Returns:
+        Tuple of (upload ID, ingestion counts); the ID is the parent_id of the file's chunks
+    """
+    upload_id = f"upload-{uuid.uuid4().hex}"
+    metadata = {"source": "file_upload", "title": filename, "format": text_format(extension)}
+    start_time = time.time()
+    counts = ingestion_queue.submit_stream(agent.rag, iter_text(filepath, extension), metadata, upload_id)
+    if not counts['chunks']:
+        raise ValueError(f"No text could be extracted from {filename}")
+    logger.info(f"Ingested {filename}: {counts['chunks']} chunks in {time.time() - start_time:.2f}s")
+    return upload_id, counts
+
+def remove_upload(filepath: str):
+    """Delete a saved upload once it has been ingested."""
+    try:
+        os.remove(filepath)
+    except OSError:
+        pass
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    """Handle file uploads from the frontend."""
+    """Handle file uploads from the frontend.
+    
+    The file is read incrementally, chunked and embedded into the knowledge
+    base in batches. The agent then answers the form's "message" (a summary
+    request by default) from the chunks retrieved for it, so neither memory
+    use nor the prompt grows with the file size.
+    """
     try:
         if 'file' not in request.files:
             return jsonify({'error': 'No file provided'}), 400
@@ -1253,69 +4244,82 @@ def upload_file():
             
         if not allowed_file(file.filename):
             return jsonify({'error': 'File type not allowed'}), 400
+        
+        extension = file.filename.rsplit('.', 1)[1].lower()
+        if not can_extract(extension):
+            return jsonify({'error': f'.{extension} files cannot be read on this server'}), 400
             
         filename = secure_filename(file.filename)
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)
-        
+        message = upload_message(filename, request.form.get('message'))
         should_stream = request.form.get('stream', 'false').lower() == 'true'
+        try:
+            session_id = get_request_session_id()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        session = acquire_session(session_id)
+        if session is None:
+            return session_busy_response(session_id)
+        
+        filepath = upload_path(filename)
+        try:
+            file.save(filepath)
+        except Exception:
+            release_session(session)
+            raise
         
         if should_stream:
             def generate_stream():
+                stream = open_sse_stream()
                 try:
-                    # Read file content
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    # Process file content with the agent
-                    for chunk in agent.process_message_stream(f"Process this file content: {content}"):
-                        if chunk:
-                            chunk_data = {'content': chunk}
-                            sse_data = f"data: {json.dumps(chunk_data)}\n\n"
-                            yield sse_data
+                    upload_id, counts = ingest_upload(filepath, filename, extension)
+                    yield stream.add({'type': 'ingest', 'file': filename, **counts})
                     
-                    yield "data: [DONE]\n\n"
+                    # Answer from the file's chunks, with the usual typed events
+                    events = agent.process_message_events(message, session=session,
+                                                          context_filter={'parent_id': upload_id})
+                    yield from stream.frames_for(events)
+                    yield stream.finish()
                     
                 except Exception as e:
                     logger.error(f"Error processing file: {e}")
-                    error_data = {'error': str(e)}
-                    yield f"data: {json.dumps(error_data)}\n\n"
-                    yield "data: [DONE]\n\n"
+                    yield stream.finish({'type': 'error', 'error': str(e)})
                 finally:
-                    # Clean up the uploaded file
-                    try:
-                        os.remove(filepath)
-                    except:
-                        pass
+                    stream_metrics.record(stream)
+                    remove_upload(filepath)
             
-            return Response(
+            response = Response(
                 generate_stream(),
                 content_type='text/event-stream',
                 headers={
                     'Cache-Control': 'no-cache',
                     'Connection': 'keep-alive',
                     'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Headers': 'Content-Type',
+                    'Access-Control-Allow-Headers': 'Content-Type, X-Session-Id',
+                    'Access-Control-Expose-Headers': 'X-Session-Id',
+                    'X-Session-Id': session.session_id,
                     'X-Accel-Buffering': 'no'
                 }
             )
+            response.call_on_close(lambda: release_session(session))
+            return response
         else:
-            # Read file content
-            with open(filepath, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            # Process file content with the agent
-            response = agent.process_message(f"Process this file content: {content}")
-            
-            # Clean up the uploaded file
             try:
-                os.remove(filepath)
-            except:
-                pass
+                try:
+                    upload_id, counts = ingest_upload(filepath, filename, extension)
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+                response = agent.process_message(message, session=session,
+                                                 context_filter={'parent_id': upload_id})
+            finally:
+                release_session(session)
+                remove_upload(filepath)
             
             return jsonify({
                 'success': True,
-                'message': response
+                'message': response,
+                'chunks': counts['chunks'],
+                'session_id': session.session_id
             })
             
     except Exception as e:
@@ -1386,7 +4390,9 @@ def update_settings():
             api_key=new_settings.get('apiKey') or os.environ.get("OPENROUTER_API_KEY"),
             model=new_settings.get('model', "deepseek/deepseek-r1:free")
         )
-        agent = Agent(llm=llm)
+        agent = Agent(llm=llm, context_budget=current_settings.get('contextBudget', CONTEXT_INPUT_BUDGET),
+                      auto_rag=current_settings.get('autoRag', AUTO_RAG_ENABLED),
+                      max_tool_iterations=current_settings.get('maxToolIterations', MAX_TOOL_ITERATIONS))
         
         return jsonify({
             'settings': current_settings,
@@ -1420,7 +4426,9 @@ def reset_settings():
             api_key=current_settings.get('apiKey') or os.environ.get("OPENROUTER_API_KEY"),
             model=current_settings.get('model', "deepseek/deepseek-r1:free")
         )
-        agent = Agent(llm=llm)
+        agent = Agent(llm=llm, context_budget=current_settings.get('contextBudget', CONTEXT_INPUT_BUDGET),
+                      auto_rag=current_settings.get('autoRag', AUTO_RAG_ENABLED),
+                      max_tool_iterations=current_settings.get('maxToolIterations', MAX_TOOL_ITERATIONS))
         
         return jsonify({
             'settings': current_settings,
@@ -1434,4 +4442,5 @@ def reset_settings():
         }), 500
 
 if __name__ == "__main__":
+    seed_knowledge()
     app.run(port=8000, debug=True)
\ No newline at end of file
@@ -0,0 +1,312 @@
+"""ASGI entry point for serving the agent on asyncio.
+
+Run with:
+    uvicorn asgi:app --port 8000
+
+/chat, /chat/regenerate and /upload are served natively on the event loop
+with the async OpenRouter client, so an open SSE stream does not pin an OS
+thread; only the file ingestion of an upload runs in a worker thread. Every
+other route is delegated to the Flask app in app2.py, and the request and SSE
+formats are the same as with `python app2.py`.
+"""
+import asyncio
+import contextlib
+import logging
+import shutil
+from typing import Any, Dict, Optional
+
+from asgiref.wsgi import WsgiToAsgi
+from limits import parse_many
+from limits.storage import MemoryStorage
+from limits.strategies import FixedWindowRateLimiter
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app2
+
+logger = logging.getLogger(__name__)
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Session-Id',
+    'Access-Control-Expose-Headers': 'X-Session-Id',
+    'X-Accel-Buffering': 'no'
+}
+
+# Apply the same default limits as the Flask limiter to the async routes
+rate_limits = parse_many("; ".join(app2.DEFAULT_RATE_LIMITS))
+rate_limiter = FixedWindowRateLimiter(MemoryStorage())
+
+
+def json_response(content: Dict[str, Any], status_code: int = 200) -> JSONResponse:
+    """JSON response with the CORS header the Flask app would add."""
+    return JSONResponse(content, status_code=status_code, headers={'Access-Control-Allow-Origin': '*'})
+
+
+def is_rate_limited(request: Request) -> bool:
+    """Record a hit for the client and check it against the default limits."""
+    key = request.client.host if request.client else "unknown"
+    return not all([rate_limiter.hit(limit, key) for limit in rate_limits])
+
+
+async def acquire_session(session_id: Optional[str]) -> Optional[app2.ConversationSession]:
+    """Get a session and lock it without blocking the event loop.
+
+    Returns:
+        The locked session, or None if it stayed busy for SESSION_LOCK_TIMEOUT seconds
+    """
+    session = app2.session_store.get_or_create(session_id)
+    if session.lock.acquire(blocking=False):
+        return session
+    # Only wait in a worker thread when another request holds the session
+    if await asyncio.to_thread(session.lock.acquire, True, app2.SESSION_LOCK_TIMEOUT):
+        return session
+    return None
+
+
+async def read_request(request: Request):
+    """Parse the JSON body and session id of a chat request.
+
+    Returns:
+        Tuple of (data, session_id, error response or None)
+    """
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    try:
+        session_id = app2.validate_session_id(
+            (data or {}).get('session_id') or request.headers.get('X-Session-Id')
+        )
+    except ValueError as e:
+        return data, None, json_response({'error': str(e)}, 400)
+    return data, session_id, None
+
+
+class SessionStreamingResponse(StreamingResponse):
+    """Streaming response that releases its session once the stream ends or is aborted."""
+
+    def __init__(self, content, session: app2.ConversationSession, **kwargs):
+        super().__init__(content, **kwargs)
+        self.session = session
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            app2.release_session(self.session)
+
+
+async def sse_events(events, error_type: str):
+    """Encode agent events as typed SSE frames, ending with [DONE].
+
+    Runs of tokens are coalesced into one frame; held text is sent once the
+    coalescing window closes even if the next event has not arrived.
+    """
+    stream = app2.open_sse_stream()
+    try:
+        async for data in stream.aframes_for(events):
+            yield data
+        yield stream.finish()
+    except Exception as e:
+        logger.error(f"Error in streaming: {e}")
+        if app2.current_settings.get('debugMode', False):
+            app2.debug_log.metrics['total_errors'] += 1
+            app2.debug_log.add_log('error', {
+                'error': str(e),
+                'type': error_type
+            })
+        yield stream.finish({'type': 'error', 'error': str(e)})
+    finally:
+        app2.stream_metrics.record(stream)
+
+
+def save_upload(source, filepath: str):
+    """Copy a spooled upload to the uploads folder in blocks."""
+    with open(filepath, 'wb') as f:
+        shutil.copyfileobj(source, f)
+
+
+async def upload_events(filepath: str, filename: str, extension: str, message: str,
+                        session: app2.ConversationSession):
+    """Ingest an upload in a worker thread, then answer from its chunks on the event loop."""
+    try:
+        upload_id, counts = await asyncio.to_thread(app2.ingest_upload, filepath, filename, extension)
+    finally:
+        app2.remove_upload(filepath)
+    yield {'type': 'ingest', 'file': filename, **counts}
+    async for event in app2.agent.aprocess_message_events(message, session=session,
+                                                          context_filter={'parent_id': upload_id}):
+        yield event
+
+
+async def chat(request: Request):
+    """Handle chat messages with optional streaming."""
+    if is_rate_limited(request):
+        return json_response({'error': 'Rate limit exceeded'}, 429)
+
+    data, session_id, error = await read_request(request)
+    if error:
+        return error
+    if not data or 'message' not in data:
+        return json_response({'error': 'No message provided'}, 400)
+
+    message = data['message']
+    should_stream = data.get('stream', False)
+    use_cache = data.get('cache', True)
+    logger.info(f"Received message: {message}, streaming: {should_stream}, session: {session_id}")
+
+    if app2.current_settings.get('debugMode', False):
+        tokens = app2.token_counter.count(message)
+        app2.debug_log.metrics['total_tokens'] += tokens
+        app2.debug_log.add_log('token_usage', {
+            'tokens': tokens,
+            'total_tokens': app2.debug_log.metrics['total_tokens']
+        })
+
+    session = await acquire_session(session_id)
+    if session is None:
+        return json_response({'error': 'Session is busy with another request', 'session_id': session_id}, 409)
+
+    agent = app2.agent
+    if should_stream:
+        return SessionStreamingResponse(
+            sse_events(agent.aprocess_message_events(message, session=session, use_cache=use_cache), 'streaming_error'),
+            session,
+            media_type='text/event-stream',
+            headers={**SSE_HEADERS, 'X-Session-Id': session.session_id}
+        )
+
+    try:
+        response = await agent.aprocess_message(message, session=session, use_cache=use_cache)
+    except Exception as e:
+        logger.error(f"Error processing message: {str(e)}")
+        return json_response({'error': str(e)}, 500)
+    finally:
+        app2.release_session(session)
+    return json_response({'response': response, 'session_id': session.session_id})
+
+
+async def regenerate(request: Request):
+    """Handle regeneration requests for the last assistant response."""
+    if is_rate_limited(request):
+        return json_response({'error': 'Rate limit exceeded'}, 429)
+
+    data, session_id, error = await read_request(request)
+    if error:
+        return error
+    should_stream = data.get('stream', False) if data else False
+    logger.info(f"Regenerating last response, streaming: {should_stream}, session: {session_id}")
+
+    session = await acquire_session(session_id)
+    if session is None:
+        return json_response({'error': 'Session is busy with another request', 'session_id': session_id}, 409)
+
+    agent = app2.agent
+    if should_stream:
+        return SessionStreamingResponse(
+            sse_events(agent.aregenerate_last_response_events(session=session), 'regeneration_streaming_error'),
+            session,
+            media_type='text/event-stream',
+            headers={**SSE_HEADERS, 'X-Session-Id': session.session_id}
+        )
+
+    try:
+        response = await agent.aregenerate_last_response(session=session)
+    except Exception as e:
+        logger.error(f"Error regenerating response: {str(e)}")
+        return json_response({'error': str(e)}, 500)
+    finally:
+        app2.release_session(session)
+    return json_response({'response': response, 'session_id': session.session_id})
+
+
+async def upload(request: Request):
+    """Handle file uploads; see upload_file in app2.py."""
+    if is_rate_limited(request):
+        return json_response({'error': 'Rate limit exceeded'}, 429)
+
+    form = await request.form()
+    try:
+        file = form.get('file')
+        if file is None or isinstance(file, str):
+            return json_response({'error': 'No file provided'}, 400)
+        if not file.filename:
+            return json_response({'error': 'No file selected'}, 400)
+        if not app2.allowed_file(file.filename):
+            return json_response({'error': 'File type not allowed'}, 400)
+
+        extension = file.filename.rsplit('.', 1)[1].lower()
+        if not app2.can_extract(extension):
+            return json_response({'error': f'.{extension} files cannot be read on this server'}, 400)
+        try:
+            session_id = app2.validate_session_id(form.get('session_id') or request.headers.get('X-Session-Id'))
+        except ValueError as e:
+            return json_response({'error': str(e)}, 400)
+
+        filename = app2.secure_filename(file.filename)
+        message = app2.upload_message(filename, form.get('message'))
+        should_stream = str(form.get('stream', 'false')).lower() == 'true'
+
+        session = await acquire_session(session_id)
+        if session is None:
+            return json_response({'error': 'Session is busy with another request', 'session_id': session_id}, 409)
+
+        filepath = app2.upload_path(filename)
+        try:
+            await asyncio.to_thread(save_upload, file.file, filepath)
+        except Exception:
+            app2.release_session(session)
+            app2.remove_upload(filepath)
+            raise
+    finally:
+        await form.close()
+
+    if should_stream:
+        return SessionStreamingResponse(
+            sse_events(upload_events(filepath, filename, extension, message, session), 'upload_streaming_error'),
+            session,
+            media_type='text/event-stream',
+            headers={**SSE_HEADERS, 'X-Session-Id': session.session_id}
+        )
+
+    try:
+        try:
+            upload_id, counts = await asyncio.to_thread(app2.ingest_upload, filepath, filename, extension)
+        except ValueError as e:
+            return json_response({'error': str(e)}, 400)
+        finally:
+            app2.remove_upload(filepath)
+        response = await app2.agent.aprocess_message(message, session=session,
+                                                     context_filter={'parent_id': upload_id})
+    except Exception as e:
+        logger.error(f"Error uploading file: {str(e)}")
+        return json_response({'error': str(e)}, 500)
+    finally:
+        app2.release_session(session)
+    return json_response({
+        'success': True,
+        'message': response,
+        'chunks': counts['chunks'],
+        'session_id': session.session_id
+    })
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette):
+    """Add the initial knowledge once the server starts."""
+    await asyncio.to_thread(app2.seed_knowledge)
+    yield
+
+
+app = Starlette(lifespan=lifespan, routes=[
+    Route('/chat', chat, methods=['POST']),
+    Route('/chat/regenerate', regenerate, methods=['POST']),
+    Route('/upload', upload, methods=['POST']),
+    # Everything else, including CORS preflight for the routes above, is handled by Flask
+    Mount('/', app=WsgiToAsgi(app2.app)),
+])
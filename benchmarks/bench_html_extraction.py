@@ -0,0 +1,88 @@
+"""Benchmark the crawler's HTML conversion against the previous BeautifulSoup + markdownify path.
+
+Usage:
+    python benchmarks/bench_html_extraction.py [page.html ...] [--repeat N]
+
+Without files, a large synthetic documentation page is generated. The legacy
+path needs beautifulsoup4 and markdownify installed; it is skipped otherwise.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from html_extractor import extract_page, lxml_etree  # noqa: E402
+
+try:
+    import markdownify
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+
+def legacy_extract(html: str) -> str:
+    """The conversion WebCrawler.crawl used before the single-pass extractor."""
+    soup = BeautifulSoup(html, 'html.parser')
+    for element in soup(['script', 'style', 'nav', 'footer']):
+        element.decompose()
+    return markdownify.markdownify(str(soup.body), heading_style="ATX")
+
+
+def synthetic_page(sections: int = 1500) -> str:
+    """Build a documentation-style page of roughly 1 MB."""
+    parts = ["<html><head><title>Synthetic docs</title><style>body{}</style></head><body>",
+             "<nav><ul>" + "".join(f"<li><a href='/s{i}'>Section {i}</a></li>" for i in range(50)) + "</ul></nav>"]
+    for i in range(sections):
+        parts.append(
+            f"<h2>Section {i}</h2>"
+            f"<p>This is <strong>paragraph</strong> {i} with a <a href='https://example.com/{i}'>link</a> "
+            f"and some <em>emphasis</em> and <code>inline_code()</code>. " + "Lorem ipsum dolor sit amet. " * 10 + "</p>"
+            "<ul><li>First item</li><li>Second item<ol><li>Nested one</li><li>Nested two</li></ol></li></ul>"
+            "<pre><code>def example():\n    return 42\n</code></pre>"
+            "<table><tr><th>Key</th><th>Value</th></tr><tr><td>a</td><td>1</td></tr></table>"
+            "<script>console.log('noise');</script>"
+        )
+    parts.append("<footer>Footer links</footer></body></html>")
+    return "".join(parts)
+
+
+def time_it(func, html: str, repeat: int) -> float:
+    """Best wall time of repeat runs, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(html)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='HTML files to convert')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per page (best time is reported)')
+    args = parser.parse_args()
+
+    pages = []
+    for path in args.files:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            pages.append((os.path.basename(path), f.read()))
+    if not pages:
+        pages.append(('synthetic', synthetic_page()))
+
+    print(f"parser backend: {'lxml' if lxml_etree is not None else 'html.parser (stdlib)'}")
+    for name, html in pages:
+        size_kb = len(html.encode('utf-8')) / 1024
+        new_time = time_it(lambda h: extract_page(h, name, "markdown"), html, args.repeat)
+        line = f"{name}: {size_kb:.0f} KB  single-pass {new_time * 1000:.1f} ms"
+        if BeautifulSoup is not None:
+            old_time = time_it(legacy_extract, html, args.repeat)
+            line += f"  legacy {old_time * 1000:.1f} ms  speedup {old_time / new_time:.1f}x"
+        else:
+            line += "  (legacy path skipped: beautifulsoup4/markdownify not installed)"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Benchmark the BM25 lexical index used for hybrid retrieval.
+
+Usage:
+    python benchmarks/bench_lexical_index.py [--chunks N] [--queries N]
+
+Builds an index over synthetic knowledge-base chunks (100k by default) that
+mix prose with identifiers such as CVE ids, hostnames and error codes, then
+reports build time, postings size and query latency for exact-identifier and
+multi-term queries.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lexical_index import BM25Index  # noqa: E402
+
+WORDS = (
+    "server request response timeout retry cache index query network latency "
+    "token session agent crawler document vector embedding cluster deploy "
+    "config error warning kernel memory process thread socket packet route"
+).split()
+
+
+def synthetic_chunk(i: int, rng: random.Random) -> str:
+    """A ~300-token chunk of prose with a few identifiers in it."""
+    words = [rng.choice(WORDS) for _ in range(280)]
+    words.insert(rng.randrange(len(words)), f"CVE-{2000 + i % 25}-{i:05d}")
+    words.insert(rng.randrange(len(words)), f"host-{i}.internal.example.com")
+    words.insert(rng.randrange(len(words)), f"E_CODE_{i % 5000}")
+    return " ".join(words)
+
+
+def percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def time_queries(index: BM25Index, queries) -> str:
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query, n_results=10)
+        samples.append((time.perf_counter() - start) * 1e6)
+    return (f"median {statistics.median(samples):.0f} us  p95 {percentile(samples, 0.95):.0f} us  "
+            f"max {max(samples):.0f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=100000, help='number of chunks to index')
+    parser.add_argument('--queries', type=int, default=1000, help='queries per query type')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print(f"generating {args.chunks} chunks...")
+    chunks = [synthetic_chunk(i, rng) for i in range(args.chunks)]
+
+    index = BM25Index()
+    start = time.perf_counter()
+    for i in range(0, len(chunks), 1000):
+        batch = chunks[i:i + 1000]
+        index.add([f"chunk-{i + j}" for j in range(len(batch))], batch)
+    build_time = time.perf_counter() - start
+
+    stats = index.get_stats()
+    print(f"build: {build_time:.2f} s ({args.chunks / build_time:.0f} chunks/s)  "
+          f"terms {stats['terms']}  postings {stats['postings']}  "
+          f"postings size {stats['postings_bytes'] / 1024 / 1024:.1f} MB")
+
+    ids = [rng.randrange(args.chunks) for _ in range(args.queries)]
+    print("exact CVE id:     " + time_queries(index, [f"CVE-{2000 + i % 25}-{i:05d}" for i in ids]))
+    print("exact hostname:   " + time_queries(index, [f"host-{i}.internal.example.com" for i in ids]))
+    print("error code:       " + time_queries(index, [f"E_CODE_{i % 5000}" for i in ids]))
+    print("two common words: " + time_queries(index, [" ".join(rng.sample(WORDS, 2)) for _ in ids]))
+
+
+if __name__ == '__main__':
+    main()
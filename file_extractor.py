@@ -0,0 +1,151 @@
+"""Incremental text extraction for uploaded files.
+
+Extractors yield a document's text in pieces so that large uploads can be
+chunked and embedded without holding the whole file in memory. Text and
+markdown files are decoded in fixed-size blocks. DOCX paragraphs are streamed
+out of word/document.xml with iterparse, and each body element is dropped as
+soon as its text is out. PDF pages are extracted one at a time with pypdf,
+which is optional; pypdf keeps the objects it has parsed, so a PDF still
+costs memory in proportion to its page count.
+"""
+import codecs
+import zipfile
+from typing import Iterator
+from xml.etree import ElementTree
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # PDF uploads are rejected without pypdf
+    PdfReader = None
+
+READ_BLOCK_SIZE = 64 * 1024  # Bytes read from a text file at a time
+TEXT_EXTENSIONS = {'txt', 'md'}
+MARKDOWN_EXTENSIONS = {'md', 'docx'}  # Extracted text keeps headings as markdown
+
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+DOCX_BODY_DEPTH = 2  # w:document > w:body
+DOCX_HEADING_STYLES = {'title': 1, **{f'heading{level}': level for level in range(1, 7)}}
+
+
+def can_extract(extension: str) -> bool:
+    """Whether text can be extracted from files with this extension here."""
+    if extension == 'pdf':
+        return PdfReader is not None
+    return extension in TEXT_EXTENSIONS or extension == 'docx'
+
+
+def text_format(extension: str) -> str:
+    """Format of the extracted text, as stored in chunk metadata."""
+    return "markdown" if extension in MARKDOWN_EXTENSIONS else "text"
+
+
+def iter_text(path: str, extension: str) -> Iterator[str]:
+    """Yield the text of a file in pieces.
+
+    Args:
+        path: Path of the file
+        extension: Lowercase file extension, without the dot
+
+    Raises:
+        ValueError: If text cannot be extracted from this type of file
+    """
+    if extension in TEXT_EXTENSIONS:
+        return _iter_plain_text(path)
+    if extension == 'docx':
+        return _iter_docx(path)
+    if extension == 'pdf':
+        if PdfReader is None:
+            raise ValueError("PDF uploads need the pypdf package")
+        return _iter_pdf(path)
+    if extension == 'doc':
+        raise ValueError("Legacy .doc files cannot be read; save the file as .docx")
+    raise ValueError(f"Cannot extract text from .{extension} files")
+
+
+def _iter_plain_text(path: str) -> Iterator[str]:
+    # The incremental decoder keeps characters split across blocks intact
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            text = decoder.decode(block)
+            if text:
+                yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def _iter_pdf(path: str) -> Iterator[str]:
+    reader = PdfReader(path)
+    for page in reader.pages:
+        text = page.extract_text() or ""
+        if text.strip():
+            yield text.strip() + "\n\n"
+
+
+def _iter_docx(path: str) -> Iterator[str]:
+    with zipfile.ZipFile(path) as archive:
+        try:
+            document = archive.open('word/document.xml')
+        except KeyError:
+            raise ValueError("Not a Word document: word/document.xml is missing")
+        with document:
+            depth = 0
+            body = None
+            for event, element in ElementTree.iterparse(document, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if depth == DOCX_BODY_DEPTH and element.tag == WORD_NAMESPACE + 'body':
+                        body = element
+                    continue
+                depth -= 1
+                if depth == DOCX_BODY_DEPTH and body is not None:
+                    # A paragraph or table directly in the body is complete
+                    text = _docx_block_text(element)
+                    body.remove(element)
+                    if text:
+                        yield text + "\n\n"
+
+
+def _docx_block_text(element: ElementTree.Element) -> str:
+    """Text of a body paragraph or table; headings become markdown headings."""
+    if element.tag == WORD_NAMESPACE + 'tbl':
+        rows = []
+        for row in element.iter(WORD_NAMESPACE + 'tr'):
+            cells = [_docx_paragraphs_text(cell) for cell in row.iter(WORD_NAMESPACE + 'tc')]
+            if any(cells):
+                rows.append(" | ".join(cells))
+        return "\n".join(rows)
+    if element.tag != WORD_NAMESPACE + 'p':
+        return _docx_paragraphs_text(element)
+
+    text = _docx_paragraph_text(element).strip()
+    style = element.find(f'{WORD_NAMESPACE}pPr/{WORD_NAMESPACE}pStyle')
+    if text and style is not None:
+        level = DOCX_HEADING_STYLES.get(style.get(WORD_NAMESPACE + 'val', '').lower())
+        if level:
+            return "#" * level + " " + text
+    return text
+
+
+def _docx_paragraphs_text(element: ElementTree.Element) -> str:
+    """Text of every paragraph inside an element, one per line."""
+    paragraphs = (_docx_paragraph_text(p).strip() for p in element.iter(WORD_NAMESPACE + 'p'))
+    return "\n".join(p for p in paragraphs if p)
+
+
+def _docx_paragraph_text(paragraph: ElementTree.Element) -> str:
+    # Only run content counts; paragraph properties also contain w:tab elements (tab stops)
+    parts = []
+    for run in paragraph.iter(WORD_NAMESPACE + 'r'):
+        for node in run:
+            if node.tag == WORD_NAMESPACE + 't':
+                parts.append(node.text or "")
+            elif node.tag == WORD_NAMESPACE + 'tab':
+                parts.append("\t")
+            elif node.tag in (WORD_NAMESPACE + 'br', WORD_NAMESPACE + 'cr'):
+                parts.append("\n")
+    return "".join(parts)
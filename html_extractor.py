@@ -0,0 +1,352 @@
+"""Single-pass HTML to markdown / plain text extraction for the web crawler.
+
+The page is parsed once and converted while parsing: the parser feeds start,
+end and data events to a MarkdownBuilder, which drops boilerplate elements
+and writes markdown and plain text in the same walk. lxml's C parser is used
+when it is installed, otherwise the standard library's html.parser.
+"""
+import re
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional, Tuple
+from xml.etree import ElementTree as ET
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:  # lxml is optional; fall back to the standard library parser
+    lxml_etree = None
+
+# Elements whose content is never part of the extracted page
+SKIP_TAGS = {'script', 'style', 'nav', 'footer', 'noscript', 'template', 'head'}
+
+# Elements that start and end a paragraph-level block
+BLOCK_TAGS = {
+    'p', 'div', 'section', 'article', 'main', 'header', 'aside', 'form', 'table',
+    'figure', 'figcaption', 'dl', 'dt', 'dd', 'address', 'details', 'summary'
+}
+
+# Elements without an end tag in HTML
+VOID_TAGS = {'br', 'hr', 'img', 'input', 'meta', 'link', 'area', 'base', 'col', 'embed', 'source', 'track', 'wbr'}
+
+# Elements that may appear in head; any other element starts the body
+HEAD_TAGS = {'title', 'meta', 'link', 'style', 'script', 'base', 'noscript', 'template'}
+
+# Elements that end the open row and cell of a table
+TABLE_SECTION_TAGS = {'table', 'thead', 'tbody', 'tfoot'}
+
+HEADING_TAGS = {'h1': 1, 'h2': 2, 'h3': 3, 'h4': 4, 'h5': 5, 'h6': 6}
+INLINE_MARKERS = {'strong': '**', 'b': '**', 'em': '*', 'i': '*'}
+
+_WHITESPACE = re.compile(r'\s+')
+_TRAILING_SPACES = re.compile(r'[ \t]+\n')
+_EXTRA_NEWLINES = re.compile(r'\n{3,}')
+
+
+class MarkdownBuilder:
+    """Parser target that turns HTML events into markdown and plain text."""
+
+    def __init__(self):
+        # Stack of (tag, parts) buffers; links and blockquotes are rendered when they close
+        self.buffers: List[Tuple[Optional[str], List[str], Dict[str, Any]]] = [(None, [], {})]
+        self.text_parts: List[str] = []
+        self.title_parts: List[str] = []
+        self.in_title = False
+        self.skip_depth = 0
+        self.pre_depth = 0
+        self.list_stack: List[List[Any]] = []  # [tag, next item number]
+        self.row_cells = 0
+        self.row_is_header = False
+        self.rows_seen = 0
+
+    def _write(self, text: str):
+        self.buffers[-1][1].append(text)
+
+    def _block(self):
+        self._write("\n\n")
+        self.text_parts.append("\n")
+
+    def _push(self, tag: str, **info):
+        self.buffers.append((tag, [], info))
+
+    def _pop(self, tag: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        if len(self.buffers) > 1 and self.buffers[-1][0] == tag:
+            _, parts, info = self.buffers.pop()
+            return "".join(parts), info
+        return None
+
+    def start(self, tag: str, attrib: Dict[str, Any]):
+        tag = tag.lower() if isinstance(tag, str) else ''
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+            return
+        if tag == 'title':
+            self.in_title = True
+            return
+        if self.skip_depth:
+            return
+
+        if tag == 'table':
+            self.rows_seen = 0
+        if tag in HEADING_TAGS:
+            self._block()
+            self._write("#" * HEADING_TAGS[tag] + " ")
+        elif tag in BLOCK_TAGS:
+            self._block()
+        elif tag in INLINE_MARKERS:
+            self._write(INLINE_MARKERS[tag])
+        elif tag == 'code':
+            if not self.pre_depth:
+                self._write("`")
+        elif tag == 'pre':
+            self._block()
+            self._write("```\n")
+            self.pre_depth += 1
+        elif tag == 'a':
+            self._push('a', href=attrib.get('href'))
+        elif tag == 'img':
+            alt = attrib.get('alt') or ''
+            src = attrib.get('src')
+            if src:
+                self._write(f"![{alt}]({src})")
+        elif tag == 'br':
+            self._write("\n")
+            self.text_parts.append("\n")
+        elif tag == 'hr':
+            self._block()
+            self._write("---")
+            self._block()
+        elif tag in ('ul', 'ol'):
+            if not self.list_stack:
+                self._block()
+            self.list_stack.append([tag, 1])
+        elif tag == 'li':
+            indent = "  " * max(len(self.list_stack) - 1, 0)
+            if self.list_stack and self.list_stack[-1][0] == 'ol':
+                marker = f"{self.list_stack[-1][1]}. "
+                self.list_stack[-1][1] += 1
+            else:
+                marker = "- "
+            self._write("\n" + indent + marker)
+            self.text_parts.append("\n")
+        elif tag == 'blockquote':
+            self._block()
+            self._push('blockquote')
+        elif tag == 'tr':
+            self._write("\n|")
+            self.text_parts.append("\n")
+            self.row_cells = 0
+            self.row_is_header = False
+        elif tag in ('td', 'th'):
+            self._write(" ")
+            self.row_cells += 1
+            self.row_is_header = self.row_is_header or tag == 'th'
+
+    def end(self, tag: str):
+        tag = tag.lower() if isinstance(tag, str) else ''
+        if tag in SKIP_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+            return
+        if tag == 'title':
+            self.in_title = False
+            return
+        if self.skip_depth or tag in VOID_TAGS:
+            return
+
+        if tag in HEADING_TAGS or tag in BLOCK_TAGS:
+            self._block()
+        elif tag in INLINE_MARKERS:
+            self._write(INLINE_MARKERS[tag])
+        elif tag == 'code':
+            if not self.pre_depth:
+                self._write("`")
+        elif tag == 'pre':
+            if self.pre_depth:
+                self.pre_depth -= 1
+                self._write("\n```")
+                self._block()
+        elif tag == 'a':
+            popped = self._pop('a')
+            if popped is not None:
+                text, info = popped
+                href = info.get('href')
+                if href and text.strip():
+                    self._write(f"[{text.strip()}]({href})")
+                else:
+                    self._write(text)
+        elif tag in ('ul', 'ol'):
+            if self.list_stack:
+                self.list_stack.pop()
+            if not self.list_stack:
+                self._block()
+        elif tag == 'blockquote':
+            popped = self._pop('blockquote')
+            if popped is not None:
+                quoted = _EXTRA_NEWLINES.sub("\n\n", popped[0]).strip()
+                self._write("\n".join("> " + line if line else ">" for line in quoted.split("\n")))
+                self._block()
+        elif tag in ('td', 'th'):
+            self._write(" |")
+            self.text_parts.append("\t")
+        elif tag == 'tr':
+            self.rows_seen += 1
+            if self.row_is_header and self.rows_seen == 1 and self.row_cells:
+                self._write("\n|" + " --- |" * self.row_cells)
+
+    def data(self, data: str):
+        if self.in_title:
+            self.title_parts.append(data)
+            return
+        if self.skip_depth:
+            return
+        if self.pre_depth:
+            self._write(data)
+            self.text_parts.append(data)
+            return
+        text = _WHITESPACE.sub(" ", data)
+        if text.strip() or (text and self.buffers[-1][1]):
+            self._write(text)
+            self.text_parts.append(text)
+
+    def comment(self, text: str):
+        pass
+
+    def close(self) -> Dict[str, str]:
+        # Flush elements left open by malformed HTML into their parents
+        while len(self.buffers) > 1:
+            _, parts, _ = self.buffers.pop()
+            self._write("".join(parts))
+
+        markdown = "".join(self.buffers[0][1])
+        markdown = _EXTRA_NEWLINES.sub("\n\n", _TRAILING_SPACES.sub("\n", markdown)).strip()
+        text = "".join(self.text_parts)
+        text = _EXTRA_NEWLINES.sub("\n\n", _TRAILING_SPACES.sub("\n", text)).strip()
+        title = _WHITESPACE.sub(" ", "".join(self.title_parts)).strip()
+        return {"title": title, "markdown": markdown, "text": text}
+
+
+class _StdlibParser(HTMLParser):
+    """Feeds html.parser events to a MarkdownBuilder, mirroring lxml's target interface.
+
+    html.parser reports only the tags that are written, so the end tags HTML
+    lets pages leave out are implied here, as lxml does: head ends at the
+    first element that belongs to the body, and table cells and rows end at
+    the next cell, row or table section.
+    """
+
+    def __init__(self, target: MarkdownBuilder):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+        self.in_head = False
+        self.tables: List[List[Optional[str]]] = []  # [open row, open cell] of each open table
+
+    def handle_starttag(self, tag, attrs):
+        self._imply_end_tags(tag)
+        if tag == 'head':
+            self.in_head = True
+        elif tag == 'table':
+            self.tables.append([None, None])
+        elif tag == 'tr' and self.tables:
+            self.tables[-1][0] = tag
+        elif tag in ('td', 'th') and self.tables:
+            self.tables[-1][1] = tag
+        self.target.start(tag, dict(attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        self._imply_end_tags(tag)
+        self.target.start(tag, dict(attrs))
+        self.target.end(tag)
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            if not self.in_head:
+                return
+            self.in_head = False
+        elif self.tables and tag in ('td', 'th'):
+            if self.tables[-1][1] is None:
+                return  # Already ended by a following cell or row
+            self.tables[-1][1] = None
+        elif self.tables and tag == 'tr':
+            self._end_cell()
+            if self.tables[-1][0] is None:
+                return
+            self.tables[-1][0] = None
+        elif self.tables and tag in TABLE_SECTION_TAGS:
+            self._end_row()
+            if tag == 'table':
+                self.tables.pop()
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+    def _imply_end_tags(self, tag: str):
+        if self.in_head and tag not in HEAD_TAGS:
+            self._end_head()
+        if not self.tables:
+            return
+        if tag in ('td', 'th'):
+            self._end_cell()
+        elif tag == 'tr' or tag in TABLE_SECTION_TAGS - {'table'}:
+            self._end_row()
+
+    def _end_head(self):
+        self.in_head = False
+        self.target.end('head')
+
+    def _end_cell(self):
+        cell = self.tables[-1][1]
+        if cell is not None:
+            self.tables[-1][1] = None
+            self.target.end(cell)
+
+    def _end_row(self):
+        self._end_cell()
+        row = self.tables[-1][0]
+        if row is not None:
+            self.tables[-1][0] = None
+            self.target.end(row)
+
+
+
+def parse_html(html: str) -> Dict[str, str]:
+    """Parse an HTML document once and return its title, markdown and plain text."""
+    builder = MarkdownBuilder()
+    if lxml_etree is not None:
+        parser = lxml_etree.HTMLParser(target=builder)
+        parser.feed(html)
+        return parser.close()
+
+    parser = _StdlibParser(builder)
+    parser.feed(html)
+    parser.close()
+    return builder.close()
+
+
+def extract_page(html: str, url: str, output_format: str = "markdown") -> Tuple[str, str]:
+    """Convert an HTML page to the crawler's output format.
+
+    Args:
+        html: The page's HTML
+        url: URL of the page, included in XML output
+        output_format: markdown, xml or text
+
+    Returns:
+        Tuple of (title, content)
+
+    Raises:
+        ValueError: If the output format is not supported
+    """
+    output_format = output_format.lower()
+    if output_format not in ("markdown", "xml", "text"):
+        raise ValueError(f"Unsupported format: {output_format}")
+
+    page = parse_html(html)
+    if output_format == "markdown":
+        return page["title"], page["markdown"]
+    if output_format == "text":
+        return page["title"], page["text"]
+
+    root = ET.Element("page")
+    ET.SubElement(root, "url").text = url
+    ET.SubElement(root, "title").text = page["title"]
+    ET.SubElement(root, "content").text = page["text"]
+    return page["title"], ET.tostring(root, encoding='unicode')
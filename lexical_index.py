@@ -0,0 +1,228 @@
+"""In-process BM25 inverted index for exact-term retrieval.
+
+Complements the vector store for queries on identifiers such as CVE ids,
+hostnames and error codes, which embeddings tend to blur. Postings are kept
+as parallel array('I') columns of document numbers and term frequencies
+(8 bytes per posting) instead of per-document dicts. Queries touching few
+postings are scored in Python; larger ones are scored with numpy over
+zero-copy views of the same arrays.
+"""
+import math
+import re
+import threading
+from array import array
+from collections import Counter
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+# Words, optionally joined by the punctuation found in identifiers (CVE-2024-1234, api.example.com, E_ACCESS)
+TOKEN_PATTERN = re.compile(r"[^\W_]+(?:[._:/\-][^\W_]+)*")
+TOKEN_SEPARATORS = re.compile(r"[._:/\-]")
+
+BM25_K1 = 1.2  # Term frequency saturation
+BM25_B = 0.75  # Document length normalization
+RRF_K = 60  # Rank offset for reciprocal-rank fusion
+SPARSE_SEARCH_POSTINGS = 4096  # Queries with fewer postings than this are scored without numpy
+
+# numpy dtype matching array('I') items
+POSTING_DTYPE = np.dtype(f"u{array('I').itemsize}")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase terms of a text; compound identifiers are indexed whole and by part."""
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    # Tokens are alphanumeric runs, so anything else contains a separator
+    for token in [token for token in tokens if not token.isalnum()]:
+        tokens.extend(TOKEN_SEPARATORS.split(token))
+    return tokens
+
+
+def reciprocal_rank_fusion(rankings: Iterable[List[str]], k: int = RRF_K) -> List[Tuple[str, float]]:
+    """Merge ranked id lists by summing 1 / (k + rank) per id.
+
+    Returns:
+        List of (id, fused score), best first
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=itemgetter(1), reverse=True)
+
+
+class BM25Index:
+    """Thread-safe BM25 index over documents identified by string ids."""
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+        self.ids: List[Optional[str]] = []  # Document number -> id, None once removed
+        self.numbers: Dict[str, int] = {}  # id -> document number
+        self.lengths = array('I')  # Document number -> token count, 0 once removed
+        self.postings: Dict[str, Tuple[array, array]] = {}  # term -> (document numbers, term frequencies)
+        self.total_length = 0
+        self.removed = 0
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.numbers
+
+    def add(self, ids: List[str], documents: List[str]):
+        """Index documents; ids that are already indexed are left as they are."""
+        tokenized = [(doc_id, tokenize(document)) for doc_id, document in zip(ids, documents)]
+        with self.lock:
+            for doc_id, tokens in tokenized:
+                if doc_id in self.numbers:
+                    continue
+                number = len(self.ids)
+                self.ids.append(doc_id)
+                self.numbers[doc_id] = number
+                self.lengths.append(len(tokens))
+                self.total_length += len(tokens)
+
+                for term, count in Counter(tokens).items():
+                    posting = self.postings.get(term)
+                    if posting is None:
+                        posting = self.postings[term] = (array('I'), array('I'))
+                    posting[0].append(number)
+                    posting[1].append(count)
+
+    def remove(self, ids: Iterable[str]):
+        """Drop documents; their postings are purged by the next compaction."""
+        with self.lock:
+            for doc_id in ids:
+                number = self.numbers.pop(doc_id, None)
+                if number is None:
+                    continue
+                self.ids[number] = None
+                self.total_length -= self.lengths[number]
+                self.lengths[number] = 0
+                self.removed += 1
+            if self.removed > max(len(self.numbers), 1000):
+                self._compact()
+
+    def _compact(self):
+        """Renumber live documents and rewrite the postings without removed ones."""
+        renumber = array('i', [-1]) * len(self.ids)
+        ids: List[Optional[str]] = []
+        lengths = array('I')
+        for number, doc_id in enumerate(self.ids):
+            if doc_id is not None:
+                renumber[number] = len(ids)
+                ids.append(doc_id)
+                lengths.append(self.lengths[number])
+
+        postings = {}
+        for term, (numbers, frequencies) in self.postings.items():
+            new_numbers, new_frequencies = array('I'), array('I')
+            for number, frequency in zip(numbers, frequencies):
+                if renumber[number] >= 0:
+                    new_numbers.append(renumber[number])
+                    new_frequencies.append(frequency)
+            if new_numbers:
+                postings[term] = (new_numbers, new_frequencies)
+
+        self.ids = ids
+        self.numbers = {doc_id: number for number, doc_id in enumerate(ids)}
+        self.lengths = lengths
+        self.postings = postings
+        self.removed = 0
+
+    def _query_terms(self, query: str) -> Set[str]:
+        """Terms to look up; a compound identifier that is indexed whole is not also matched by its parts."""
+        terms = set()
+        for token in TOKEN_PATTERN.findall(query.lower()):
+            terms.add(token)
+            if token not in self.postings and not token.isalnum():
+                terms.update(TOKEN_SEPARATORS.split(token))
+        return terms
+
+    def search(self, query: str, n_results: int = 10, allowed: Optional[Set[str]] = None) -> List[Tuple[str, float]]:
+        """Rank documents by BM25 score for a query.
+
+        Args:
+            query: Query text, tokenized like the documents
+            n_results: Number of results to return
+            allowed: Optional set of ids to restrict the results to
+
+        Returns:
+            List of (id, score), best first
+        """
+        with self.lock:
+            live = len(self.numbers)
+            if not live or n_results <= 0:
+                return []
+            postings = [self.postings[term] for term in self._query_terms(query) if term in self.postings]
+            if not postings:
+                return []
+            average_length = self.total_length / live
+            weighted = []
+            for numbers, frequencies in postings:
+                idf = math.log(1 + (live - len(numbers) + 0.5) / (len(numbers) + 0.5))
+                weighted.append((idf, numbers, frequencies))
+
+            if sum(len(numbers) for _, numbers, _ in weighted) < SPARSE_SEARCH_POSTINGS:
+                ranked = self._score_sparse(weighted, average_length)
+            else:
+                # Without a filter only the top n_results need to be ordered
+                ranked = self._score_dense(weighted, average_length, n_results if allowed is None else None)
+
+            results = []
+            for number, score in ranked:
+                doc_id = self.ids[number]
+                if allowed is None or doc_id in allowed:
+                    results.append((doc_id, score))
+                    if len(results) == n_results:
+                        break
+            return results
+
+    def _score_sparse(self, weighted, average_length: float) -> Iterable[Tuple[int, float]]:
+        """Score few postings with a dict accumulator, best first."""
+        scores: Dict[int, float] = {}
+        for idf, numbers, frequencies in weighted:
+            for number, frequency in zip(numbers, frequencies):
+                length = self.lengths[number]
+                if not length:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * length / average_length)
+                scores[number] = scores.get(number, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return sorted(scores.items(), key=itemgetter(1), reverse=True)
+
+    def _score_dense(self, weighted, average_length: float, limit: Optional[int] = None) -> Iterable[Tuple[int, float]]:
+        """Score many postings with numpy, best first; called with the lock held."""
+        lengths = np.frombuffer(self.lengths, dtype=POSTING_DTYPE)
+        scores = np.zeros(len(self.ids))
+        for idf, numbers, frequencies in weighted:
+            numbers = np.frombuffer(numbers, dtype=POSTING_DTYPE)
+            frequencies = np.frombuffer(frequencies, dtype=POSTING_DTYPE).astype(np.float64)
+            doc_lengths = lengths[numbers]
+            norm = self.k1 * (1 - self.b + self.b * doc_lengths / average_length)
+            contribution = idf * frequencies * (self.k1 + 1) / (frequencies + norm)
+            contribution[doc_lengths == 0] = 0.0
+            # Document numbers are unique within a posting, so fancy-index addition is safe
+            scores[numbers] += contribution
+        # Drop the views before returning: the arrays cannot grow while numpy holds their buffers
+        del lengths, numbers, frequencies
+
+        candidates = np.flatnonzero(scores)
+        if limit is not None and limit < len(candidates):
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        order = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return zip(order.tolist(), scores[order].tolist())
+
+    def get_stats(self) -> Dict[str, int]:
+        """Get index size for debug metrics."""
+        with self.lock:
+            postings = sum(len(numbers) for numbers, _ in self.postings.values())
+            return {
+                'documents': len(self.numbers),
+                'terms': len(self.postings),
+                'postings': postings,
+                'removed_pending_compaction': self.removed,
+                'postings_bytes': postings * 8
+            }
@@ -0,0 +1,247 @@
+"""Output stage for server-sent event (SSE) chat streams.
+
+Agent events are turned into SSE frames here. Token events usually carry one
+or two characters, so consecutive tokens are coalesced into one frame until
+a time window or size limit is reached (20 ms or 256 characters by default).
+Any other event flushes the pending text first, so tool and usage events are
+never delayed. Frames are encoded to bytes once, with a pre-encoded prefix
+for the common token frame. The transcript is kept in an append-only buffer,
+and each stream counts the CPU time spent in this stage and the writes it
+hands to the server.
+"""
+import asyncio
+import io
+import json
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional
+
+COALESCE_WINDOW = 0.02  # Seconds token text may wait for more before it is sent
+COALESCE_CHARS = 256  # Characters of pending token text that are sent right away
+RECENT_STREAMS = 20  # Per-stream summaries kept for debug metrics
+
+DONE_FRAME = b"data: [DONE]\n\n"
+# json.dumps({'type': 'token', 'content': text}) without building the dict
+_TOKEN_PREFIX = b'event: token\ndata: {"type": "token", "content": '
+_FRAME_END = b"}\n\n"
+
+
+def encode_event(event: Dict[str, Any]) -> bytes:
+    """Encode an agent event as an SSE frame named after its type.
+
+    The JSON payload repeats the type, so clients that ignore event names
+    still see it, and text-only clients keep reading "content".
+    """
+    if event['type'] == 'token' and len(event) == 2:
+        return _TOKEN_PREFIX + json.dumps(event['content']).encode() + _FRAME_END
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
+
+
+class SSEStream:
+    """Coalesces the events of one response into SSE frames.
+
+    Token text is sent right away while tokens arrive slower than the
+    window, so a slow stream gains no latency. When they arrive faster, text
+    is held until the window has passed since the first held token or the
+    pending text reaches max_chars.
+    """
+
+    def __init__(self, window: float = COALESCE_WINDOW, max_chars: int = COALESCE_CHARS):
+        self.window = window
+        self.max_chars = max_chars
+        self.pending: List[str] = []
+        self.pending_chars = 0
+        self.pending_since: Optional[float] = None
+        self.last_token: Optional[float] = None
+        self.transcript = io.StringIO()  # Append-only copy of the streamed answer
+        self.started = time.monotonic()
+        self.events = 0
+        self.frames = 0
+        self.writes = 0
+        self.bytes = 0
+        self.cpu = 0.0
+
+    @property
+    def text(self) -> str:
+        """The answer streamed so far."""
+        return self.transcript.getvalue()
+
+    def deadline(self) -> Optional[float]:
+        """Monotonic time at which the pending text has to be sent, if there is any."""
+        if self.pending_since is None:
+            return None
+        return self.pending_since + self.window
+
+    def add(self, event: Dict[str, Any]) -> bytes:
+        """Add an agent event.
+
+        Returns:
+            Bytes to write now, empty while token text is being held
+        """
+        cpu = time.thread_time()
+        self.events += 1
+        if event['type'] == 'token' and len(event) == 2:
+            now = time.monotonic()
+            text = event['content']
+            self.transcript.write(text)
+            self.pending.append(text)
+            self.pending_chars += len(text)
+            if self.pending_since is None:
+                self.pending_since = now
+            fast = self.last_token is not None and now - self.last_token < self.window
+            self.last_token = now
+            if fast and self.pending_chars < self.max_chars and now - self.pending_since < self.window:
+                data = b""
+            else:
+                data = self._take_tokens()
+        else:
+            if event.get('content'):
+                self.transcript.write(event['content'])
+            data = self._take_tokens() + self._frame(encode_event(event))
+        self.cpu += time.thread_time() - cpu
+        return self._write(data)
+
+    def flush(self) -> bytes:
+        """Bytes of the pending token text, e.g. once the deadline has passed."""
+        cpu = time.thread_time()
+        data = self._take_tokens()
+        self.cpu += time.thread_time() - cpu
+        return self._write(data)
+
+    def finish(self, event: Optional[Dict[str, Any]] = None) -> bytes:
+        """Bytes ending the stream: pending text, an optional last event (e.g. an error) and [DONE]."""
+        cpu = time.thread_time()
+        data = self._take_tokens()
+        if event is not None:
+            self.events += 1
+            data += self._frame(encode_event(event))
+        data += self._frame(DONE_FRAME)
+        self.cpu += time.thread_time() - cpu
+        return self._write(data)
+
+    def frames_for(self, events: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+        """Frames for an event stream, not including finish().
+
+        Held text is sent when the next event arrives; the sync servers have
+        no way to wake a stream up in between.
+        """
+        for event in events:
+            data = self.add(event)
+            if data:
+                yield data
+        data = self.flush()
+        if data:
+            yield data
+
+    async def aframes_for(self, events: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+        """Async version of frames_for that also sends held text once its deadline passes."""
+        iterator = events.__aiter__()
+        next_event = None
+        try:
+            while True:
+                deadline = self.deadline()
+                if next_event is None and deadline is None:
+                    # Nothing is held, so wait for the next event directly
+                    try:
+                        event = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        break
+                else:
+                    if next_event is None:
+                        next_event = asyncio.ensure_future(iterator.__anext__())
+                    if deadline is not None:
+                        done, _ = await asyncio.wait({next_event}, timeout=max(deadline - time.monotonic(), 0))
+                        if not done:
+                            data = self.flush()
+                            if data:
+                                yield data
+                            continue
+                    try:
+                        event = await next_event
+                    except StopAsyncIteration:
+                        next_event = None
+                        break
+                    next_event = None
+                data = self.add(event)
+                if data:
+                    yield data
+        finally:
+            if next_event is not None:
+                next_event.cancel()
+        data = self.flush()
+        if data:
+            yield data
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Summary of the stream for debug metrics."""
+        return {
+            'events': self.events,
+            'frames': self.frames,
+            'writes': self.writes,
+            'bytes': self.bytes,
+            'cpu_ms': round(self.cpu * 1000, 3),
+            'duration_ms': round((time.monotonic() - self.started) * 1000)
+        }
+
+    def _take_tokens(self) -> bytes:
+        if not self.pending:
+            return b""
+        text = "".join(self.pending)
+        self.pending = []
+        self.pending_chars = 0
+        self.pending_since = None
+        return self._frame(_TOKEN_PREFIX + json.dumps(text).encode() + _FRAME_END)
+
+    def _frame(self, frame: bytes) -> bytes:
+        self.frames += 1
+        return frame
+
+    def _write(self, data: bytes) -> bytes:
+        # Each non-empty chunk handed to the server is one send on the socket
+        if data:
+            self.writes += 1
+            self.bytes += len(data)
+        return data
+
+
+class StreamMetrics:
+    """Totals over finished SSE streams for debug metrics."""
+
+    def __init__(self, recent: int = RECENT_STREAMS):
+        self.lock = threading.Lock()
+        self.streams = 0
+        self.events = 0
+        self.frames = 0
+        self.writes = 0
+        self.bytes = 0
+        self.cpu = 0.0
+        self.recent = deque(maxlen=recent)
+
+    def record(self, stream: SSEStream):
+        """Add a finished stream."""
+        stats = stream.get_stats()
+        with self.lock:
+            self.streams += 1
+            self.events += stream.events
+            self.frames += stream.frames
+            self.writes += stream.writes
+            self.bytes += stream.bytes
+            self.cpu += stream.cpu
+            self.recent.append(stats)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            streams = max(self.streams, 1)
+            return {
+                'streams': self.streams,
+                'events': self.events,
+                'frames': self.frames,
+                'writes': self.writes,
+                'bytes': self.bytes,
+                'cpu_ms': round(self.cpu * 1000, 3),
+                'avg_cpu_ms_per_stream': round(self.cpu * 1000 / streams, 3),
+                'avg_writes_per_stream': round(self.writes / streams, 1),
+                'events_per_write': round(self.events / max(self.writes, 1), 2),
+                'recent_streams': list(self.recent)
+            }
@@ -0,0 +1,11 @@
+"""Shared test setup.
+
+app2 configures itself from the environment on import, so the environment
+is set here, before any test module imports it: an in-memory knowledge base
+and embedding cache, and a placeholder API key.
+"""
+import os
+
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+os.environ["KNOWLEDGE_BASE_DIR"] = ""
+os.environ["EMBEDDING_CACHE_DIR"] = ""
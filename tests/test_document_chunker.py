@@ -0,0 +1,91 @@
+"""Tests for DocumentChunker overlap and heading handling.
+
+Run with:
+    python -m pytest tests
+
+Tokens are counted with the 4-characters-per-token fallback, so the tests
+need no tokenizer download and chunk sizes are predictable.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+app2 = pytest.importorskip("app2")
+
+
+@pytest.fixture(autouse=True)
+def fallback_token_counting(monkeypatch):
+    monkeypatch.setattr(app2, "token_counter", SimpleNamespace(encoder=None))
+
+
+def paragraph(n):
+    """A paragraph of about 30 tokens, each one different."""
+    return " ".join(f"p{n}w{i}" for i in range(24))
+
+
+def test_overlap_carries_the_last_words_of_a_long_paragraph():
+    chunker = app2.DocumentChunker(max_tokens=40, overlap_tokens=10)
+    chunks = chunker.chunk("\n\n".join(paragraph(n) for n in range(4)), markdown=False)
+
+    assert len(chunks) == 4
+    for previous, chunk in zip(chunks, chunks[1:]):
+        overlap = chunk["text"].split("\n\n")[0]
+        # Whole words from the end of the previous chunk, within the overlap budget
+        assert previous["text"].endswith(" " + overlap)
+        assert 0 < chunker._count(overlap) <= 10
+        assert chunk["tokens"] <= chunker.max_tokens
+
+
+def test_no_overlap_without_an_overlap_budget():
+    chunker = app2.DocumentChunker(max_tokens=40, overlap_tokens=0)
+    paragraphs = [paragraph(n) for n in range(4)]
+
+    chunks = chunker.chunk("\n\n".join(paragraphs), markdown=False)
+
+    assert [chunk["text"] for chunk in chunks] == paragraphs
+
+
+def test_chunks_never_cross_a_heading():
+    chunker = app2.DocumentChunker(max_tokens=200, overlap_tokens=20)
+    text = "# Guide\n\nIntro text.\n\n## Install\n\nRun the installer.\n\n## Use\n\nStart the app."
+
+    chunks = chunker.chunk(text)
+
+    assert [(chunk["section"], chunk["text"]) for chunk in chunks] == [
+        ("Guide", "# Guide\n\nIntro text."),
+        ("Guide > Install", "## Install\n\nRun the installer."),
+        ("Guide > Use", "## Use\n\nStart the app."),
+    ]
+
+
+def test_stream_keeps_a_heading_at_a_window_cut_with_its_content():
+    chunker = app2.DocumentChunker(max_tokens=200, overlap_tokens=0)
+    pieces = [
+        "Opening paragraph of the document.\n\n## Setup\n\n",
+        "Setup instructions follow the heading.\n\n",
+        "Closing paragraph."
+    ]
+    text = "".join(pieces)
+
+    # The first window ends right after the heading
+    chunks = list(chunker.chunk_stream(pieces, window=len(pieces[0])))
+
+    assert [(chunk["section"], chunk["text"]) for chunk in chunks] == [
+        ("", "Opening paragraph of the document."),
+        ("Setup", "## Setup\n\nSetup instructions follow the heading."),
+        ("Setup", "Closing paragraph."),
+    ]
+    for chunk in chunks:
+        assert text[chunk["offset"]:chunk["offset"] + len(chunk["text"])] == chunk["text"]
+
+
+def test_stream_holds_a_window_of_only_headings():
+    chunker = app2.DocumentChunker(max_tokens=200, overlap_tokens=0)
+
+    pieces = ["# Guide\n\n## Setup\n\n", "Setup body."]
+
+    chunks = list(chunker.chunk_stream(pieces, window=8))
+
+    # Chunked as if the document had arrived whole: no heading is left without its content
+    assert chunks == chunker.chunk("".join(pieces))
+    assert chunks[-1]["text"] == "## Setup\n\nSetup body."
@@ -0,0 +1,48 @@
+"""Tests for the standard library fallback of the HTML extractor.
+
+Run with:
+    python -m pytest tests
+
+The fallback is used when lxml is not installed; the tests force it, so they
+exercise it whether or not lxml is available.
+"""
+import pytest
+
+import html_extractor
+from html_extractor import extract_page
+
+
+@pytest.fixture(autouse=True)
+def stdlib_parser(monkeypatch):
+    monkeypatch.setattr(html_extractor, "lxml_etree", None)
+
+
+def test_body_follows_unclosed_head():
+    html = "<html><head><title>T</title><body><h1>Hi</h1><p>visible</p>"
+
+    assert extract_page(html, "u") == ("T", "# Hi\n\nvisible")
+
+
+def test_head_ends_at_first_body_element():
+    html = "<html><head><title>T</title><meta charset=utf-8><p>visible"
+
+    assert extract_page(html, "u") == ("T", "visible")
+
+
+def test_unclosed_head_keeps_skipping_head_content():
+    html = "<head><title>T</title><style>p { color: red }</style><script>var x;</script><p>visible"
+
+    assert extract_page(html, "u") == ("T", "visible")
+
+
+def test_unclosed_cells_and_rows_render_as_table():
+    html = "<table><tr><th>A<th>B<tr><td>1<td>2</table><p>after"
+
+    assert extract_page(html, "u")[1] == "| A | B |\n| --- | --- |\n| 1 | 2 |\n\nafter"
+    assert extract_page(html, "u", "text")[1] == "A\tB\n1\t2\n\nafter"
+
+
+def test_closed_cells_are_not_ended_twice():
+    html = "<table><thead><tr><th>A</th><th>B</th></tr></thead><tbody><tr><td>1</td><td>2</td></tr></tbody></table>"
+
+    assert extract_page(html, "u")[1] == "| A | B |\n| --- | --- |\n| 1 | 2 |"
@@ -0,0 +1,107 @@
+"""Tests for the BM25 index behind lexical and hybrid retrieval.
+
+Run with:
+    python -m pytest tests
+"""
+import lexical_index
+from lexical_index import BM25Index, reciprocal_rank_fusion, tokenize
+
+DOCUMENTS = {
+    "cve": "Patch CVE-2024-1234 before the next release.",
+    "host": "The api.example.com host returns E_ACCESS for expired tokens.",
+    "deploy": "Deployments roll out region by region.",
+}
+
+
+def build(documents=DOCUMENTS):
+    index = BM25Index()
+    index.add(list(documents), list(documents.values()))
+    return index
+
+
+def test_identifiers_are_indexed_whole_and_by_part():
+    assert tokenize("CVE-2024-1234 on api.example.com") == [
+        "cve-2024-1234", "on", "api.example.com", "cve", "2024", "1234", "api", "example", "com"
+    ]
+
+
+def test_search_ranks_exact_identifier_matches():
+    index = build()
+
+    assert [doc_id for doc_id, _ in index.search("CVE-2024-1234")] == ["cve"]
+    assert [doc_id for doc_id, _ in index.search("example")] == ["host"]
+    assert index.search("kubernetes") == []
+
+
+def test_readding_an_id_keeps_the_first_version():
+    index = build()
+
+    index.add(["deploy"], ["Something about kubernetes instead."])
+
+    assert len(index) == 3
+    assert index.search("kubernetes") == []
+    assert [doc_id for doc_id, _ in index.search("region")] == ["deploy"]
+
+
+def test_removed_documents_are_not_returned():
+    index = build()
+
+    index.remove(["cve", "missing"])
+
+    assert "cve" not in index
+    assert len(index) == 2
+    assert index.search("CVE-2024-1234") == []
+    assert index.get_stats()["removed_pending_compaction"] == 1
+
+
+def test_search_is_restricted_to_allowed_ids():
+    index = build()
+
+    assert index.search("the", allowed={"deploy"}) == []
+    assert [doc_id for doc_id, _ in index.search("the", allowed={"host"})] == ["host"]
+
+
+def test_compaction_drops_removed_postings_and_keeps_scores():
+    documents = {f"doc{n}": f"shared term{n % 7} filler{n}" for n in range(3000)}
+    index = build(documents)
+    removed = [f"doc{n}" for n in range(0, 3000, 3)]
+    kept = {doc_id: text for doc_id, text in documents.items() if doc_id not in set(removed)}
+
+    index.remove(removed[:1000])
+    # Too few removals to compact on their own, so compact explicitly
+    index._compact()
+
+    assert index.get_stats()["removed_pending_compaction"] == 0
+    assert index.get_stats()["postings"] == build(kept).get_stats()["postings"]
+    assert index.search("term3 filler10", n_results=5) == build(kept).search("term3 filler10", n_results=5)
+
+
+def test_remove_compacts_once_most_documents_are_removed():
+    documents = {f"doc{n}": f"term{n}" for n in range(1500)}
+    index = build(documents)
+
+    index.remove([f"doc{n}" for n in range(1200)])
+
+    assert len(index.ids) == 300
+    assert index.get_stats()["removed_pending_compaction"] == 0
+    assert [doc_id for doc_id, _ in index.search("term1400")] == ["doc1400"]
+
+
+def test_dense_scoring_matches_sparse_scoring(monkeypatch):
+    documents = {f"doc{n}": f"alpha beta{n % 5} " + "gamma " * (n % 4) for n in range(500)}
+    index = build(documents)
+    sparse = dict(index.search("alpha beta2 gamma", n_results=len(documents)))
+
+    monkeypatch.setattr(lexical_index, "SPARSE_SEARCH_POSTINGS", 0)
+    dense = index.search("alpha beta2 gamma", n_results=len(documents))
+
+    # Equal scores may come out in either order, so compare scores by id
+    assert len(dense) == len(sparse) == len(documents)
+    assert all(abs(score - sparse[doc_id]) < 1e-9 for doc_id, score in dense)
+    assert [score for _, score in dense] == sorted((score for _, score in dense), reverse=True)
+
+
+def test_reciprocal_rank_fusion_favours_ids_found_by_both():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a"]])
+
+    assert [doc_id for doc_id, _ in fused] == ["a", "c", "b"]
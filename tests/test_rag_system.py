@@ -0,0 +1,89 @@
+"""Tests for RAGSystem upserts of documents that share chunks.
+
+Run with:
+    python -m pytest tests
+
+app2 is imported with an in-memory knowledge base and embedding cache (see
+conftest.py); it only adds its initial knowledge on server startup, so nothing
+is embedded on import. The tests use their own collections and a
+deterministic embedding function, the only one they call.
+"""
+import hashlib
+import uuid
+
+import pytest
+
+pytest.importorskip("chromadb")
+app2 = pytest.importorskip("app2")
+
+from chromadb.api.types import EmbeddingFunction  # noqa: E402
+
+SHARED = "Deployments are rolled out region by region and paused on the first failed health check."
+PAGE_A = "Page A explains how the build pipeline caches its dependencies.\n\n" + SHARED
+PAGE_B = "Page B lists the on-call rotation and the escalation contacts.\n\n" + SHARED
+
+
+class HashEmbedding(EmbeddingFunction):
+    """Deterministic embeddings, so the tests need no model download."""
+
+    def __init__(self):
+        pass
+
+    def __call__(self, input):
+        return [[byte / 255 for byte in hashlib.sha256(text.encode('utf-8')).digest()] for text in input]
+
+
+@pytest.fixture
+def rag():
+    # One paragraph per chunk, so the shared paragraph is a chunk of both pages
+    chunker = app2.DocumentChunker(max_tokens=24, overlap_tokens=0)
+    return app2.RAGSystem(collection_name=f"test_{uuid.uuid4().hex}", chunker=chunker,
+                          persist_directory="", embedding_function=HashEmbedding())
+
+
+def add_pages(rag, pages):
+    """Upsert crawled pages given as {url: text}."""
+    return rag.add_documents(
+        list(pages.values()),
+        metadatas=[{"source": "web_crawl", "url": url} for url in pages],
+        ids=[f"page:{url}" for url in pages],
+        upsert=True
+    )
+
+
+def chunks_of(rag, url):
+    stored = rag.collection.get(where={"parent_id": f"page:{url}"}, include=["documents", "metadatas"])
+    return stored["documents"], stored["metadatas"]
+
+
+def test_shared_chunk_is_stored_per_parent(rag):
+    counts = add_pages(rag, {"a": PAGE_A, "b": PAGE_B})
+
+    assert counts["inserted"] == 4
+    for url in ("a", "b"):
+        documents, metadatas = chunks_of(rag, url)
+        assert SHARED in documents
+        assert all(metadata["url"] == url for metadata in metadatas)
+
+
+def test_upserting_one_parent_keeps_the_other_parents_copy(rag):
+    add_pages(rag, {"a": PAGE_A, "b": PAGE_B})
+
+    # Page B is re-crawled without the shared paragraph
+    counts = add_pages(rag, {"b": PAGE_B.split("\n\n")[0]})
+
+    assert counts["deleted"] == 1
+    documents, metadatas = chunks_of(rag, "a")
+    assert SHARED in documents
+    assert all(metadata["url"] == "a" for metadata in metadatas)
+    documents, _ = chunks_of(rag, "b")
+    assert SHARED not in documents
+
+
+def test_readding_a_parent_skips_its_stored_chunks(rag):
+    add_pages(rag, {"a": PAGE_A, "b": PAGE_B})
+
+    counts = add_pages(rag, {"a": PAGE_A})
+
+    assert counts["inserted"] == 0
+    assert counts["skipped"] == 2
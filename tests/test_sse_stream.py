@@ -0,0 +1,138 @@
+"""Tests for SSE frame coalescing in the chat stream output stage.
+
+Run with:
+    python -m pytest tests
+
+Most tests drive SSEStream with a fake clock; the async test uses real time
+to check that held text is sent once its deadline passes.
+"""
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import sse_stream
+from sse_stream import DONE_FRAME, SSEStream, encode_event
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sse_stream, "time", SimpleNamespace(monotonic=clock.monotonic, thread_time=time.thread_time))
+    return clock
+
+
+def payloads(data: bytes):
+    """The JSON payloads of the frames in data, in order."""
+    return [json.loads(line[len(b"data: "):]) for line in data.split(b"\n")
+            if line.startswith(b"data: ") and line != DONE_FRAME.strip()]
+
+
+def token(text):
+    return {"type": "token", "content": text}
+
+
+def test_token_frames_match_the_generic_encoding():
+    event = token('a "quoted"\ntoken')
+
+    assert encode_event(event) == f"event: token\ndata: {json.dumps(event)}\n\n".encode()
+
+
+def test_slow_tokens_are_sent_right_away(clock):
+    stream = SSEStream(window=0.02)
+
+    for text in ("Hel", "lo"):
+        assert payloads(stream.add(token(text))) == [token(text)]
+        clock.now += 0.05
+
+    assert stream.text == "Hello"
+
+
+def test_fast_tokens_are_coalesced_until_the_window_passes(clock):
+    stream = SSEStream(window=0.02)
+
+    assert payloads(stream.add(token("a"))) == [token("a")]
+    clock.now += 0.005
+    assert stream.add(token("b")) == b""
+    assert stream.deadline() == pytest.approx(clock.now + 0.02)
+    clock.now += 0.01
+    assert stream.add(token("c")) == b""
+    # Still arriving fast, but the window has passed since "b" was held
+    clock.now += 0.015
+    assert payloads(stream.add(token("d"))) == [token("bcd")]
+    assert stream.deadline() is None
+
+
+def test_fast_tokens_are_sent_at_max_chars(clock):
+    stream = SSEStream(window=1.0, max_chars=8)
+
+    stream.add(token("x"))
+    clock.now += 0.001
+    assert stream.add(token("1234")) == b""
+    clock.now += 0.001
+    assert payloads(stream.add(token("5678"))) == [token("12345678")]
+
+
+def test_other_events_flush_held_text_first(clock):
+    stream = SSEStream(window=0.02)
+    stream.add(token("a"))
+    clock.now += 0.001
+    stream.add(token("b"))
+
+    data = stream.add({"type": "usage", "total_tokens": 3})
+
+    assert payloads(data) == [token("b"), {"type": "usage", "total_tokens": 3}]
+    assert data.startswith(b"event: token\n")
+
+
+def test_finish_sends_held_text_the_last_event_and_done(clock):
+    stream = SSEStream(window=0.02)
+    stream.add(token("a"))
+    clock.now += 0.001
+    stream.add(token("b"))
+
+    data = stream.finish({"type": "error", "error": "boom"})
+
+    assert payloads(data) == [token("b"), {"type": "error", "error": "boom"}]
+    assert data.endswith(DONE_FRAME)
+    assert stream.get_stats()["writes"] == 2
+
+
+def test_sync_frames_send_held_text_at_the_end(clock):
+    stream = SSEStream(window=0.02)
+
+    frames = list(stream.frames_for(token(text) for text in "abc"))
+
+    assert [payloads(frame) for frame in frames] == [[token("a")], [token("bc")]]
+
+
+def test_async_frames_send_held_text_once_the_deadline_passes():
+    stream = SSEStream(window=0.02)
+    sent = []
+
+    async def events():
+        for text in "abc":
+            yield token(text)
+        await asyncio.sleep(0.3)
+        sent.append(("done", time.monotonic()))
+        yield {"type": "done"}
+
+    async def collect():
+        async for frame in stream.aframes_for(events()):
+            sent.append((payloads(frame), time.monotonic()))
+
+    asyncio.run(collect())
+
+    assert [item for item, _ in sent] == [[token("a")], [token("bc")], "done", [{"type": "done"}]]
+    # The held text went out after about one window, not with the next event
+    assert sent[1][1] - sent[0][1] < 0.2
@@ -0,0 +1,88 @@
+"""Tests for ToolCallDetector, which spots tool calls in streamed responses.
+
+Run with:
+    python -m pytest tests
+
+Responses are fed in small deltas, as the model streams them, and tool calls
+are extracted with the agent's own parser.
+"""
+import functools
+from types import SimpleNamespace
+
+import pytest
+
+app2 = pytest.importorskip("app2")
+
+CALL = '{"tool": "search_knowledge", "parameters": {"query": "braces } and \\" quotes"}}'
+
+
+@pytest.fixture
+def detector():
+    agent = SimpleNamespace(tools={"search_knowledge": None})
+    return app2.ToolCallDetector(functools.partial(app2.Agent._extract_tool_calls, agent))
+
+
+def feed(detector, text, size=3):
+    """Feed text in deltas of size characters; returns what was released."""
+    return "".join(detector.feed(text[i:i + size]) for i in range(0, len(text), size))
+
+
+def test_call_split_across_deltas_is_detected(detector):
+    released = feed(detector, "Let me look that up. " + CALL + " and some more text")
+
+    assert released == "Let me look that up. "
+    assert detector.tool_calls == [
+        {"tool": "search_knowledge", "parameters": {"query": 'braces } and " quotes'}}
+    ]
+    # The response ends with the call; text streamed after it is dropped
+    assert detector.response == "Let me look that up. " + CALL
+    assert detector.finish() == ""
+
+
+def test_fenced_tool_list_is_detected(detector):
+    text = "Searching.\n```json\n[" + CALL + ", " + CALL + "]\n```"
+
+    released = feed(detector, text, size=2)
+
+    assert released == "Searching.\n"
+    assert len(detector.tool_calls) == 2
+
+
+def test_prose_with_braces_is_released(detector):
+    text = "Use {name} or [1, 2] in `code`, and a dict like {\"a\": 1}.\n```python\nx = {}\n```"
+
+    released = feed(detector, text) + detector.finish()
+
+    assert released == text
+    assert detector.tool_calls == []
+    assert detector.response == text
+
+
+def test_held_text_is_released_once_it_is_not_a_call(detector):
+    assert detector.feed('Try {"tool') == "Try "
+
+    # Complete JSON that names no tool is released with the text after it
+    assert detector.feed('s": 1} instead.') == '{"tools": 1} instead.'
+    assert detector.tool_calls == []
+
+
+def test_unknown_tool_is_released(detector):
+    text = '{"tool": "delete_everything", "parameters": {}} done'
+
+    assert feed(detector, text) == text
+    assert detector.tool_calls == []
+
+
+def test_incomplete_call_is_released_at_the_end(detector):
+    assert feed(detector, 'Almost: {"tool": "search_knowledge", "para') == "Almost: "
+
+    assert detector.finish() == '{"tool": "search_knowledge", "para'
+    assert detector.response == 'Almost: {"tool": "search_knowledge", "para'
+
+
+def test_without_extract_everything_passes_through():
+    detector = app2.ToolCallDetector()
+
+    assert feed(detector, CALL) == CALL
+    assert detector.finish() == ""
+    assert detector.tool_calls == []
@@ -4,14 +4,42 @@ const API_URL = 'http://localhost:8000';
 
 interface ChatResponse {
   response: string;
+  session_id?: string;
 }
 
 interface FileUploadResponse {
   success: boolean;
   message: string;
   content?: string;
+  session_id?: string;
 }
 
+// The server keeps conversation history per session. The id it assigns on the
+// first request is sent back with every chat, regenerate and upload call.
+let sessionId: string | null = null;
+
+const rememberSession = (response: Response, data?: { session_id?: string }) => {
+  const id = data?.session_id || response.headers.get('X-Session-Id');
+  if (id) {
+    sessionId = id;
+  }
+};
+
+const withSession = (body: Record<string, unknown>) =>
+  sessionId ? { ...body, session_id: sessionId } : body;
+
+const sessionFormData = (file: File, stream: boolean) => {
+  const formData = new FormData();
+  formData.append('file', file);
+  if (stream) {
+    formData.append('stream', 'true');
+  }
+  if (sessionId) {
+    formData.append('session_id', sessionId);
+  }
+  return formData;
+};
+
 interface Capabilities {
   streaming: boolean;
   tools: string[];
@@ -134,14 +162,16 @@ export const chatService = {
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify({ message }),
+        body: JSON.stringify(withSession({ message })),
       });
       
       if (!response.ok) {
         throw new Error(`API error: ${response.status}`);
       }
       
-      return await response.json();
+      const data = await response.json();
+      rememberSession(response, data);
+      return data;
     } catch (error) {
       console.error('Error sending message:', error);
       throw error;
@@ -160,12 +190,13 @@ export const chatService = {
       headers: {
         'Content-Type': 'application/json',
       },
-      body: JSON.stringify({ message, stream: true }),
+      body: JSON.stringify(withSession({ message, stream: true })),
       signal,
     }).then(response => {
       if (!response.ok) {
         throw new Error(`API error: ${response.status}`);
       }
+      rememberSession(response);
       
       if (!response.body) {
         throw new Error('No response body available');
@@ -180,8 +211,10 @@ export const chatService = {
         const lines = buffer.split('\n\n');
         buffer = lines.pop() || '';
 
-        for (const line of lines) {
-          if (line.startsWith('data: ')) {
+        for (const frame of lines) {
+          // Typed events put an "event: <type>" line before the data line
+          const line = frame.split('\n').find(l => l.startsWith('data: '));
+          if (line) {
             const data = line.slice(6);
             if (data === '[DONE]') {
               onComplete();
@@ -239,14 +272,16 @@ export const chatService = {
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify({}),
+        body: JSON.stringify(withSession({})),
       });
       
       if (!response.ok) {
         throw new Error(`API error: ${response.status}`);
       }
       
-      return await response.json();
+      const data = await response.json();
+      rememberSession(response, data);
+      return data;
     } catch (error) {
       console.error('Error regenerating message:', error);
       throw error;
@@ -265,12 +300,13 @@ export const chatService = {
       headers: {
         'Content-Type': 'application/json',
       },
-      body: JSON.stringify({ stream: true }),
+      body: JSON.stringify(withSession({ stream: true })),
       signal,
     }).then(response => {
       if (!response.ok) {
         throw new Error(`API error: ${response.status}`);
       }
+      rememberSession(response);
       
       if (!response.body) {
         throw new Error('No response body available');
@@ -285,8 +321,10 @@ export const chatService = {
         const lines = buffer.split('\n\n');
         buffer = lines.pop() || '';
 
-        for (const line of lines) {
-          if (line.startsWith('data: ')) {
+        for (const frame of lines) {
+          // Typed events put an "event: <type>" line before the data line
+          const line = frame.split('\n').find(l => l.startsWith('data: '));
+          if (line) {
             const data = line.slice(6);
             if (data === '[DONE]') {
               onComplete();
@@ -357,19 +395,18 @@ export const chatService = {
    */
   uploadFile: async (file: File): Promise<FileUploadResponse> => {
     try {
-      const formData = new FormData();
-      formData.append('file', file);
-
       const response = await fetch(`${API_URL}/upload`, {
         method: 'POST',
-        body: formData,
+        body: sessionFormData(file, false),
       });
       
       if (!response.ok) {
         throw new Error(`API error: ${response.status}`);
       }
       
-      return await response.json();
+      const data = await response.json();
+      rememberSession(response, data);
+      return data;
     } catch (error) {
       console.error('Error uploading file:', error);
       throw error;
@@ -388,18 +425,15 @@ export const chatService = {
     const controller = new AbortController();
     const signal = controller.signal;
 
-    const formData = new FormData();
-    formData.append('file', file);
-    formData.append('stream', 'true');
-
     fetch(`${API_URL}/upload`, {
       method: 'POST',
-      body: formData,
+      body: sessionFormData(file, true),
       signal,
     }).then(response => {
       if (!response.ok) {
         throw new Error(`API error: ${response.status}`);
       }
+      rememberSession(response);
       
       if (!response.body) {
         throw new Error('No response body available');
@@ -414,8 +448,10 @@ export const chatService = {
         const lines = buffer.split('\n\n');
         buffer = lines.pop() || '';
 
-        for (const line of lines) {
-          if (line.startsWith('data: ')) {
+        for (const frame of lines) {
+          // Typed events put an "event: <type>" line before the data line
+          const line = frame.split('\n').find(l => l.startsWith('data: '));
+          if (line) {
             const data = line.slice(6);
             if (data === '[DONE]') {
               onComplete();
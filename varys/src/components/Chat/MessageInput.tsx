@@ -82,7 +82,7 @@ export const MessageInput: React.FC<MessageInputProps> = ({
             ref={fileInputRef}
             onChange={handleFileSelect}
             className="hidden"
-            accept=".txt,.pdf,.doc,.docx,.md"
+            accept=".txt,.pdf,.docx,.md"
           />
           <button
             type="button"